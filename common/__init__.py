@@ -0,0 +1,4 @@
+"""
+Shared building blocks for the Isleborn Online Flask services
+(main.py, server.py, island_service, payment_service).
+"""
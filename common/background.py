@@ -0,0 +1,89 @@
+"""
+Periodic background work (sweeps, buffered flushes) for the Flask services.
+"""
+
+import atexit
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicWorker:
+    """Runs fn every `interval` seconds on a daemon thread.
+
+    fn is run one last time on stop() (and at interpreter exit) when
+    final_run is set, so buffered work is not lost on shutdown.
+    """
+
+    def __init__(self, name, interval, fn, final_run=False):
+        self.name = name
+        self.interval = float(interval)
+        self.fn = fn
+        self.final_run = final_run
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        self.runs = 0
+        self.errors = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.last_run_at = None
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return self
+        self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def trigger(self):
+        """Run as soon as possible instead of waiting for the interval."""
+        self._wake.set()
+
+    def run_once(self):
+        with self._lock:
+            started = time.monotonic()
+            try:
+                return self.fn()
+            except Exception:
+                self.errors += 1
+                logger.exception('%s failed', self.name)
+            finally:
+                elapsed = time.monotonic() - started
+                self.runs += 1
+                self.last_duration = elapsed
+                self.max_duration = max(self.max_duration, elapsed)
+                self.last_run_at = time.time()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            self.run_once()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout=self.interval + 5)
+        self._thread = None
+        if self.final_run:
+            self.run_once()
+
+    def stats(self):
+        return {
+            'interval_s': self.interval,
+            'runs': self.runs,
+            'errors': self.errors,
+            'last_duration_ms': round(self.last_duration * 1000, 3),
+            'max_duration_ms': round(self.max_duration * 1000, 3),
+            'last_run_at': self.last_run_at,
+        }
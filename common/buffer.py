@@ -0,0 +1,178 @@
+"""
+Write coalescing: collect per-key updates in memory and hand them to a
+flush function in batches.
+
+    buffer = CoalescingBuffer('heartbeats', flush_heartbeats, interval=5)
+    buffer.put(user_id, now)
+
+Only the latest value per key is kept, unless a merge function is given
+(for example to add up counters). The flush function receives a list of
+(key, value) pairs; if it raises, the batch is merged back into the
+buffer and retried on the next flush. A final flush runs on shutdown.
+With interval <= 0 every put is written through immediately.
+
+Pass a common.journal.Journal to make acknowledged puts durable: they
+are journaled before put() returns and recover() loads whatever a crash
+left unflushed.
+"""
+
+import threading
+import time
+
+from common.background import PeriodicWorker
+
+
+class CoalescingBuffer:
+
+    def __init__(self, name, flush_fn, interval=5.0, max_items=10000, merge=None, journal=None):
+        self.name = name
+        self.flush_fn = flush_fn
+        self.max_items = max_items
+        self.merge = merge
+        self.journal = journal
+        self._items = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._worker = PeriodicWorker(name + '-flush', interval, self.flush, final_run=True)
+
+        self.puts = 0
+        self.flushes = 0
+        self.failures = 0
+        self.rows_flushed = 0
+        self.last_rows = 0
+        self.max_rows = 0
+        self.last_flush = 0.0
+        self.max_flush = 0.0
+
+    def start(self):
+        self._worker.start()
+        return self
+
+    def stop(self):
+        self._worker.stop()
+
+    def put(self, key, value):
+        with self._lock:
+            if self.journal is not None:
+                self.journal.append([(key, value)])
+            if self.merge is not None and key in self._items:
+                value = self.merge(self._items[key], value)
+            self._items[key] = value
+            self.puts += 1
+            full = len(self._items) >= self.max_items
+        if self._worker.interval <= 0:
+            self.flush()
+        elif full:
+            self._worker.trigger()
+
+    def put_many(self, pairs):
+        """Put several (key, value) pairs so that they land in the same flush."""
+        pairs = list(pairs)
+        with self._lock:
+            if self.journal is not None:
+                self.journal.append(pairs)
+            for key, value in pairs:
+                if self.merge is not None and key in self._items:
+                    value = self.merge(self._items[key], value)
+                self._items[key] = value
+                self.puts += 1
+            full = len(self._items) >= self.max_items
+        if self._worker.interval <= 0:
+            self.flush()
+        elif full:
+            self._worker.trigger()
+
+    def get(self, key, default=None):
+        """Pending (not yet committed) value for key, including a batch being flushed."""
+        with self._lock:
+            if key in self._items:
+                return self._items[key]
+            return self._inflight.get(key, default)
+
+    def pending(self):
+        """Snapshot of the unflushed (key, value) pairs."""
+        with self._lock:
+            return list(self._items.items())
+
+    def hold(self):
+        """Context manager keeping flushes out (waiting for a running one),
+        e.g. to read the flushed state and pending() as of the same moment."""
+        return self._flush_lock
+
+    def recover(self):
+        """Load records the journal holds from before a restart; returns how many."""
+        if self.journal is None:
+            return 0
+        pairs = self.journal.replay()
+        with self._lock:
+            for key, value in pairs:
+                if self.merge is not None and key in self._items:
+                    value = self.merge(self._items[key], value)
+                self._items[key] = value
+        return len(pairs)
+
+    def _requeue(self, items):
+        with self._lock:
+            for key, value in items:
+                if key not in self._items:
+                    self._items[key] = value
+                elif self.merge is not None:
+                    self._items[key] = self.merge(value, self._items[key])
+
+    def flush(self):
+        # one batch at a time, so a manual flush() returns only once earlier puts are committed
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._lock:
+            if not self._items:
+                return 0
+            self._inflight, self._items = self._items, {}
+            items = list(self._inflight.items())
+            sealed = self.journal.rotate() if self.journal is not None else None
+        started = time.monotonic()
+        try:
+            self.flush_fn(items)
+        except Exception:
+            self.failures += 1
+            self._requeue(items)
+            with self._lock:
+                self._inflight = {}
+            raise
+        with self._lock:
+            self._inflight = {}
+        if sealed is not None:
+            self.journal.discard(sealed)
+        elapsed = time.monotonic() - started
+        self.flushes += 1
+        self.rows_flushed += len(items)
+        self.last_rows = len(items)
+        self.max_rows = max(self.max_rows, len(items))
+        self.last_flush = elapsed
+        self.max_flush = max(self.max_flush, elapsed)
+        return len(items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        pending = len(self._items)
+        stats = {
+            'size': pending,
+            'puts': self.puts,
+            'flushes': self.flushes,
+            'failures': self.failures,
+            'rows_flushed': self.rows_flushed,
+            'last_rows_per_flush': self.last_rows,
+            'max_rows_per_flush': self.max_rows,
+            'avg_rows_per_flush': round(self.rows_flushed / self.flushes, 2) if self.flushes else 0.0,
+            'last_flush_ms': round(self.last_flush * 1000, 3),
+            'max_flush_ms': round(self.max_flush * 1000, 3),
+            # puts per row written (pending keys count as one row each)
+            'coalescing_ratio': round(self.puts / (self.rows_flushed + pending), 2) if self.puts else 0.0,
+        }
+        if self.journal is not None:
+            stats['journal'] = self.journal.stats()
+        return stats
@@ -0,0 +1,129 @@
+"""
+Small in-process caches shared by the Flask services.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Bounded, thread-safe LRU cache with per-entry expiry.
+
+    Entries can carry a tag (for example a user id) so that every entry
+    belonging to it can be dropped at once with invalidate_tag().
+    """
+
+    def __init__(self, maxsize=10000, ttl=60.0):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self._data = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _remove(self, key):
+        value, expires, tag = self._data.pop(key)
+        if tag is not None:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+        return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            if entry[1] <= time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None, tag=None):
+        ttl = self.ttl if ttl is None else min(float(ttl), self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, time.monotonic() + ttl, tag)
+            if tag is not None:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            return self._remove(key)
+
+    def invalidate_tag(self, tag):
+        with self._lock:
+            keys = list(self._tags.get(tag, ()))
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+            }
+
+
+class Generations:
+    """Bounded per-key invalidation counters for read-through caches.
+
+    Take current(key) before reading the source, bump(key) after a write,
+    and only store what was read if current(key) is unchanged. Counters come
+    from one clock, and a key that was evicted reads as the newest evicted
+    value, so eviction can make a racing read skip the cache but never
+    store a stale copy. Not locked: callers hold their own lock.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = max(1, int(maxsize))
+        self._data = OrderedDict()
+        self._clock = 0
+        self._floor = 0
+
+    def current(self, key):
+        return self._data.get(key, self._floor)
+
+    def bump(self, key):
+        self._clock += 1
+        self._data[key] = self._clock
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._floor = max(self._floor, self._data.popitem(last=False)[1])
+
+    def bump_all(self):
+        """Invalidate every key at once, e.g. after missing some bump()s."""
+        self._clock += 1
+        self._floor = self._clock
+        self._data.clear()
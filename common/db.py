@@ -0,0 +1,222 @@
+"""
+Pooled Postgres connections shared by all Flask services.
+
+Usage:
+    pool = ConnectionPool(DATABASE_URL, cursor_factory=RealDictCursor)
+
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT 1')
+        conn.commit()
+
+Connections are handed back to the pool when the block exits. Anything left
+uncommitted is rolled back, so a returned connection is always idle.
+
+Settings (environment):
+    DB_POOL_MIN              connections opened eagerly on first use (default 1)
+    DB_POOL_MAX              hard upper bound of open connections (default 10)
+    DB_POOL_TIMEOUT          seconds to wait for a free connection (default 5)
+    DB_POOL_MAX_LIFETIME     recycle connections older than this, seconds (default 1800)
+    DB_POOL_HEALTHCHECK      ping connections idle longer than this, seconds (default 30)
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes free within the checkout timeout."""
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return float(default)
+
+
+class _PooledConn:
+    __slots__ = ('conn', 'created_at', 'last_used')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of psycopg2 connections."""
+
+    def __init__(self, dsn, minconn=None, maxconn=None, timeout=None,
+                 max_lifetime=None, healthcheck_after=None, **connect_kwargs):
+        self.dsn = dsn
+        self.minconn = int(minconn if minconn is not None else _env_float('DB_POOL_MIN', 1))
+        self.maxconn = max(1, int(maxconn if maxconn is not None else _env_float('DB_POOL_MAX', 10)))
+        self.timeout = timeout if timeout is not None else _env_float('DB_POOL_TIMEOUT', 5)
+        self.max_lifetime = max_lifetime if max_lifetime is not None else _env_float('DB_POOL_MAX_LIFETIME', 1800)
+        self.healthcheck_after = healthcheck_after if healthcheck_after is not None else _env_float('DB_POOL_HEALTHCHECK', 30)
+        self.connect_kwargs = connect_kwargs
+
+        self._idle = deque()
+        self._size = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._warmed = False
+
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+        self._created = 0
+        self._recycled = 0
+        self._failed_checks = 0
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, **self.connect_kwargs)
+        with self._cond:
+            self._created += 1
+        return _PooledConn(conn)
+
+    def _discard(self, item):
+        try:
+            item.conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _is_usable(self, item):
+        now = time.monotonic()
+        if item.conn.closed:
+            return False
+        if self.max_lifetime and now - item.created_at > self.max_lifetime:
+            with self._cond:
+                self._recycled += 1
+            return False
+        if self.healthcheck_after is not None and now - item.last_used > self.healthcheck_after:
+            try:
+                cur = item.conn.cursor()
+                cur.execute('SELECT 1')
+                cur.close()
+                item.conn.rollback()
+            except Exception:
+                with self._cond:
+                    self._failed_checks += 1
+                return False
+        return True
+
+    def _warm(self):
+        self._warmed = True
+        for _ in range(min(self.minconn, self.maxconn)):
+            with self._cond:
+                if self._size >= self.maxconn:
+                    return
+                self._size += 1
+            try:
+                item = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                return
+            with self._cond:
+                self._idle.append(item)
+                self._cond.notify()
+
+    def getconn(self):
+        """Check a connection out of the pool. Prefer connection()."""
+        if not self._warmed:
+            self._warm()
+        started = time.monotonic()
+        deadline = started + self.timeout
+        while True:
+            item = None
+            with self._cond:
+                while not self._idle and self._size >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(f'no database connection available after {self.timeout}s')
+                    self._cond.wait(remaining)
+                if self._idle:
+                    item = self._idle.pop()
+                else:
+                    self._size += 1
+
+            if item is None:
+                try:
+                    item = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_usable(item):
+                self._discard(item)
+                continue
+
+            waited = time.monotonic() - started
+            with self._cond:
+                self._checkouts += 1
+                self._wait_total += waited
+                if waited > self._wait_max:
+                    self._wait_max = waited
+            return item
+
+    def putconn(self, item):
+        """Return a connection, rolling back any open transaction."""
+        conn = item.conn
+        if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+        if conn.closed or conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            self._discard(item)
+            return
+        item.last_used = time.monotonic()
+        with self._cond:
+            self._idle.append(item)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        item = self.getconn()
+        try:
+            yield item.conn
+        except Exception:
+            try:
+                item.conn.rollback()
+            except Exception:
+                pass
+            raise
+        finally:
+            self.putconn(item)
+
+    def closeall(self):
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        for item in idle:
+            self._discard(item)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'max': self.maxconn,
+                'checkouts': self._checkouts,
+                'checkout_wait_avg_ms': round(self._wait_total / self._checkouts * 1000, 3) if self._checkouts else 0.0,
+                'checkout_wait_max_ms': round(self._wait_max * 1000, 3),
+                'timeouts': self._timeouts,
+                'created': self._created,
+                'recycled': self._recycled,
+                'failed_healthchecks': self._failed_checks,
+            }
@@ -0,0 +1,66 @@
+"""
+Cached JSON responses with strong ETags.
+
+    news_cache = ResponseCache(ttl=60)
+
+    @app.route('/api/news')
+    def get_news():
+        return news_cache.respond('news', load_news, max_age=30)
+
+The body is serialized once per build and reused byte for byte; requests
+carrying a matching If-None-Match get a 304 without a body. Call
+invalidate(key) after writes. Each worker process has its own cache, so
+the TTL bounds how long another worker can serve the old body.
+"""
+
+import hashlib
+import threading
+
+from flask import current_app, jsonify, request
+
+from common.cache import Generations, TTLCache
+
+
+class ResponseCache:
+
+    def __init__(self, ttl=60, maxsize=64):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._generations = Generations(maxsize=maxsize)
+        self.builds = 0
+        self.not_modified = 0
+
+    def get(self, key, build):
+        """(body bytes, etag) for key, calling build() for the data on a miss."""
+        entry = self._cache.get(key)
+        if entry is not None:
+            return entry
+        with self._lock:
+            generation = self._generations.current(key)
+        body = jsonify(build()).get_data()
+        entry = (body, hashlib.sha256(body).hexdigest()[:32])
+        self.builds += 1
+        # an invalidate() while we were building means the data may be stale
+        with self._lock:
+            if self._generations.current(key) == generation:
+                self._cache.set(key, entry)
+        return entry
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generations.bump(key)
+            self._cache.pop(key)
+
+    def respond(self, key, build, max_age=0):
+        body, etag = self.get(key, build)
+        response = current_app.response_class(body, mimetype=current_app.json.mimetype)
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        response = response.make_conditional(request)
+        if response.status_code == 304:
+            self.not_modified += 1
+        return response
+
+    def stats(self):
+        return dict(self._cache.stats(), builds=self.builds, not_modified=self.not_modified)
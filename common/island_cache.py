@@ -0,0 +1,153 @@
+"""
+Read-through cache of serialized island documents for island_service.
+
+Entries are (body bytes, etag) per owner. The ETag is "v<version>" for
+documents read from Postgres (islands.version changes on every write) and
+a content hash for documents from the file fallback.
+
+Two tiers: a bounded in-process LRU and, when a Redis client is given, a
+shared Redis copy so several island_service instances warm each other.
+Writes invalidate both tiers; another instance's LRU can still serve the
+previous document for up to ISLAND_CACHE_TTL seconds, so keep it short.
+In Redis an invalidation leaves the new version behind, and a document is
+only stored if it is not older than that, so a slow reader cannot put a
+stale copy back.
+"""
+
+import hashlib
+import logging
+import threading
+
+from common.cache import Generations, TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+# KEYS[1] hash; ARGV body, etag, version, ttl
+_PUT_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 'version')
+if current and tonumber(current) > tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'body', ARGV[1], 'etag', ARGV[2], 'version', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+
+def etag_for(body, version=None):
+    if version is not None:
+        return f'v{version}'
+    return 'h' + hashlib.sha256(body).hexdigest()[:24]
+
+
+class IslandCache:
+
+    def __init__(self, maxsize=1000, ttl=10, redis_client=None, redis_ttl=300, prefix='island:doc:'):
+        self._local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.redis = redis_client
+        self.redis_ttl = int(redis_ttl)
+        self.prefix = prefix
+        self._generations = Generations(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self.redis_hits = 0
+        self.redis_errors = 0
+
+    def generation(self, owner):
+        """Pass to put() so a read racing a write does not cache the old document."""
+        with self._lock:
+            return self._generations.current(owner)
+
+    def get(self, owner):
+        entry = self._local.get(owner)
+        if entry is not None or self.redis is None:
+            return entry
+        try:
+            body, etag = self.redis.hmget(self.prefix + owner, 'body', 'etag')
+        except Exception as e:
+            self.redis_errors += 1
+            logger.warning('island cache redis read failed: %s', e)
+            return None
+        if body is None or etag is None:
+            return None
+        entry = (body.encode('utf-8') if isinstance(body, str) else body, etag)
+        self.redis_hits += 1
+        self._local.set(owner, entry)
+        return entry
+
+    def get_many(self, owners):
+        """{owner: entry} for the cached owners; Redis is asked once for the rest."""
+        found = {}
+        for owner in owners:
+            entry = self._local.get(owner)
+            if entry is not None:
+                found[owner] = entry
+        rest = [owner for owner in owners if owner not in found]
+        if not rest or self.redis is None:
+            return found
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for owner in rest:
+                pipe.hmget(self.prefix + owner, 'body', 'etag')
+            replies = pipe.execute()
+        except Exception as e:
+            self.redis_errors += 1
+            logger.warning('island cache redis read failed: %s', e)
+            return found
+        for owner, (body, etag) in zip(rest, replies):
+            if body is None or etag is None:
+                continue
+            entry = (body.encode('utf-8') if isinstance(body, str) else body, etag)
+            self.redis_hits += 1
+            self._local.set(owner, entry)
+            found[owner] = entry
+        return found
+
+    def put(self, owner, body, version, generation):
+        entry = (body, etag_for(body, version))
+        with self._lock:
+            if self._generations.current(owner) != generation:
+                return entry
+            self._local.set(owner, entry)
+        if self.redis is not None:
+            try:
+                key = self.prefix + owner
+                if version is None:
+                    pipe = self.redis.pipeline()
+                    pipe.hset(key, mapping={'body': body, 'etag': entry[1]})
+                    pipe.expire(key, self.redis_ttl)
+                    pipe.execute()
+                else:
+                    self.redis.eval(_PUT_SCRIPT, 1, key, body, entry[1], version, self.redis_ttl)
+            except Exception as e:
+                self.redis_errors += 1
+                logger.warning('island cache redis write failed: %s', e)
+        return entry
+
+    def invalidate(self, owner, version=None):
+        """Drop the cached document; version is the one just written, if known."""
+        with self._lock:
+            self._generations.bump(owner)
+            self._local.pop(owner)
+        if self.redis is not None:
+            try:
+                key = self.prefix + owner
+                if version is None:
+                    self.redis.delete(key)
+                else:
+                    pipe = self.redis.pipeline()
+                    pipe.hdel(key, 'body', 'etag')
+                    pipe.hset(key, 'version', version)
+                    pipe.expire(key, self.redis_ttl)
+                    pipe.execute()
+            except Exception as e:
+                self.redis_errors += 1
+                logger.warning('island cache redis delete failed: %s', e)
+
+    def stats(self):
+        return dict(
+            self._local.stats(),
+            redis=self.redis is not None,
+            redis_hits=self.redis_hits,
+            redis_errors=self.redis_errors,
+        )
@@ -0,0 +1,161 @@
+"""
+Compact binary encoding of island documents (MessagePack).
+
+Clients opt in with Accept: application/msgpack; JSON stays the default.
+Plain MessagePack alone barely beats compact JSON on islands, because
+every float is 9 bytes and most of the document is "pos" triples, so
+arrays of two or more floats are packed as extension types:
+
+    ext 1  little-endian int32 values k, decoded as k / 1000
+           (used when every element round-trips exactly that way, which
+           holds for the 3-decimal coordinates tools/generate_island.py
+           writes)
+    ext 2  little-endian float64 values (any other float array)
+
+decode(encode(doc)) == doc exactly, down to float bits and int vs float;
+anything that cannot be packed exactly is left as plain MessagePack.
+
+The packing is Python, so it costs CPU rather than saving it: on a level 5
+island (tools/bench_island_codec.py) encode takes about 1.5x compact
+json.dumps and 8x plain msgpack, decode about 1.3x json.loads. What it
+buys is a body about 25% smaller than compact JSON. island_service keeps
+encoded bodies per (owner, etag), so a stored version is encoded once.
+"""
+
+import struct
+
+import msgpack
+
+MSGPACK = 'application/msgpack'
+MSGPACK_TYPES = (MSGPACK, 'application/x-msgpack', 'application/vnd.msgpack')
+
+EXT_SCALED = 1
+EXT_FLOAT64 = 2
+SCALE = 1000
+
+
+_structs = {}
+
+
+def _struct(code, n):
+    s = _structs.get((code, n))
+    if s is None:
+        s = _structs[code, n] = struct.Struct(f'<{n}{code}')
+    return s
+
+
+def _float_array(values):
+    n = len(values)
+    doubles = _struct('d', n)
+    raw = doubles.pack(*values)
+    try:
+        scaled = [round(x * SCALE) for x in values]
+        # compared as bytes, so -0.0 and anything not exactly k / 1000 falls through to float64
+        if doubles.pack(*[k / SCALE for k in scaled]) == raw:
+            return msgpack.ExtType(EXT_SCALED, _struct('i', n).pack(*scaled))
+    except (OverflowError, ValueError, struct.error):  # inf, nan, beyond int32
+        pass
+    return msgpack.ExtType(EXT_FLOAT64, raw)
+
+
+def _is_float_array(obj):
+    return len(obj) >= 2 and type(obj[0]) is float and set(map(type, obj)) == {float}
+
+
+def _copy_tree(obj, slots):
+    # copies containers only; each float array is left as a None placeholder
+    # and recorded in slots as (container, key, values) for _pack_floats
+    if type(obj) is dict:
+        out = {}
+        for key, value in obj.items():
+            t = type(value)
+            if t is list and _is_float_array(value):
+                slots.append((out, key, value))
+                out[key] = None
+            elif t is dict or t is list:
+                out[key] = _copy_tree(value, slots)
+            else:
+                out[key] = value
+        return out
+    out = []
+    for value in obj:
+        t = type(value)
+        if t is list and _is_float_array(value):
+            slots.append((out, len(out), value))
+            out.append(None)
+        elif t is dict or t is list:
+            out.append(_copy_tree(value, slots))
+        else:
+            out.append(value)
+    return out
+
+
+# ExtType.__new__ only re-checks the code and the bytes type, which hold here
+_ext = tuple.__new__
+
+
+def _pack_floats(slots):
+    """Pack every float array of a document in one struct pass each for the
+    float64, int32 and k / 1000 round-trip images, then slice per array."""
+    flat = [x for _, _, values in slots for x in values]
+    n = len(flat)
+    raw = _struct('d', n).pack(*flat)
+    try:
+        scaled = [round(x * SCALE) for x in flat]
+        ints = _struct('i', n).pack(*scaled)
+        check = _struct('d', n).pack(*[k / SCALE for k in scaled])
+    except (OverflowError, ValueError, struct.error):  # inf, nan, beyond int32: array by array
+        for container, key, values in slots:
+            container[key] = _float_array(values)
+        return
+    exact = raw == check
+    start = 0
+    for container, key, values in slots:
+        end = start + len(values)
+        if exact or raw[start * 8:end * 8] == check[start * 8:end * 8]:
+            container[key] = _ext(msgpack.ExtType, (EXT_SCALED, ints[start * 4:end * 4]))
+        else:
+            container[key] = _ext(msgpack.ExtType, (EXT_FLOAT64, raw[start * 8:end * 8]))
+        start = end
+
+
+def _ext_hook(code, data):
+    if code == EXT_SCALED:
+        if len(data) % 4:
+            raise ValueError('ext 1 payload is not a whole number of int32 values')
+        return [k / SCALE for k in _struct('i', len(data) // 4).unpack(data)]
+    if code == EXT_FLOAT64:
+        if len(data) % 8:
+            raise ValueError('ext 2 payload is not a whole number of float64 values')
+        return list(_struct('d', len(data) // 8).unpack(data))
+    return msgpack.ExtType(code, data)
+
+
+def encode(doc):
+    if type(doc) is list and _is_float_array(doc):
+        doc = _float_array(doc)
+    elif type(doc) in (dict, list):
+        slots = []
+        doc = _copy_tree(doc, slots)
+        if slots:
+            _pack_floats(slots)
+    return msgpack.packb(doc, use_bin_type=True)
+
+
+# what decode() raises on a malformed body
+DecodeError = (ValueError, msgpack.exceptions.UnpackException)
+
+
+def decode(data):
+    return msgpack.unpackb(data, ext_hook=_ext_hook, raw=False)
+
+
+def map_header(n):
+    """Bytes opening an n-entry map, for streaming a map entry by entry."""
+    return msgpack.Packer().pack_map_header(n)
+
+
+def wants_msgpack(accept_mimetypes):
+    """True if the request's Accept header prefers MessagePack over JSON."""
+    best = accept_mimetypes.best_match(('application/json',) + MSGPACK_TYPES)
+    return best in MSGPACK_TYPES
@@ -0,0 +1,226 @@
+"""
+File-backed island store for when Postgres is unavailable.
+
+    store = IslandFileStore('godot_server/islands')
+    store.put(owner, island)        # DB write failed: keep it on disk
+    store.get(owner)                # DB read failed or no row
+    store.discard(owner)            # DB write succeeded: the file is stale now
+
+Documents are compact JSON in 256 hash-sharded subdirectories
+(<root>/<xx>/island_<owner>.json, owner percent-encoded), written to a
+temp file, fsync'd and renamed over the old one, so a crash never leaves
+a torn document. Flat <root>/island_<owner>.json files from
+tools/generate_island.py are still read, but never modified.
+
+Every put() also drops a marker in <root>/.replay/; replay() pushes those
+documents back to Postgres once it is reachable and then removes them.
+An in-memory index of the owners on disk lets lookups for everyone else
+skip the filesystem. It is per process: documents another process writes
+are picked up through their replay markers on the next replay().
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from datetime import datetime, timezone
+from urllib.parse import quote, unquote
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'island_'
+SUFFIX = '.json'
+
+
+def _filename(owner):
+    return PREFIX + quote(owner, safe='') + SUFFIX
+
+
+def _owner(filename):
+    if filename.startswith(PREFIX) and filename.endswith(SUFFIX):
+        return unquote(filename[len(PREFIX):-len(SUFFIX)])
+    return None
+
+
+class IslandFileStore:
+
+    def __init__(self, root, fsync=True):
+        self.root = root
+        self.fsync = fsync
+        self._replay_dir = os.path.join(root, '.replay')
+        self._index = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+
+        self.writes = 0
+        self.replayed = 0
+        self.replay_failures = 0
+        self.refresh()
+
+    def shard_path(self, owner):
+        shard = hashlib.sha1(owner.encode('utf-8')).hexdigest()[:2]
+        return os.path.join(self.root, shard, _filename(owner))
+
+    def refresh(self):
+        """Rebuild the index from disk (startup)."""
+        index = {}
+        if os.path.isdir(self.root):
+            for entry in os.scandir(self.root):
+                if entry.is_file():
+                    owner = _owner(entry.name)
+                    if owner is not None:
+                        index[owner] = entry.path
+            for entry in os.scandir(self.root):
+                if entry.is_dir() and len(entry.name) == 2:
+                    for doc in os.scandir(entry.path):
+                        owner = _owner(doc.name)
+                        if owner is not None:
+                            index[owner] = doc.path
+        with self._lock:
+            self._index = index
+            self._pending = set(self._markers())
+
+    def _markers(self):
+        try:
+            return [unquote(name) for name in os.listdir(self._replay_dir) if not name.startswith('.')]
+        except FileNotFoundError:
+            return []
+
+    def _sync_dir(self, directory):
+        if self.fsync and hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _write_atomic(self, path, data):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        self._sync_dir(directory)
+
+    def __contains__(self, owner):
+        return owner in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def has_pending(self, owner):
+        """True while owner has a fallback write Postgres has not seen yet."""
+        return owner in self._pending
+
+    def get(self, owner):
+        path = self._index.get(owner)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            with self._lock:
+                if self._index.get(owner) == path:
+                    del self._index[owner]
+            return None
+
+    def put(self, owner, island):
+        data = json.dumps(island, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        path = self.shard_path(owner)
+        with self._lock:
+            # marker first: a crash before the rename leaves a marker for the old document, never a document without one
+            os.makedirs(self._replay_dir, exist_ok=True)
+            open(os.path.join(self._replay_dir, quote(owner, safe='')), 'ab').close()
+            self._write_atomic(path, data)
+            self._index[owner] = path
+            self._pending.add(owner)
+            self.writes += 1
+        return path
+
+    def _remove(self, owner, stat=None):
+        # caller holds the lock; with stat, only if the document was not rewritten since
+        path = self.shard_path(owner)
+        try:
+            if stat is not None:
+                current = os.stat(path)
+                if (current.st_ino, current.st_mtime_ns) != (stat.st_ino, stat.st_mtime_ns):
+                    return False
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        try:
+            os.unlink(os.path.join(self._replay_dir, quote(owner, safe='')))
+        except FileNotFoundError:
+            pass
+        if self._index.get(owner) == path:
+            del self._index[owner]
+        self._pending.discard(owner)
+        return True
+
+    def discard(self, owner):
+        """Forget owner's sharded document once Postgres has a newer copy."""
+        if owner not in self._index and owner not in self._pending:
+            return
+        with self._lock:
+            self._remove(owner)
+
+    def replay(self, replay_fn, limit=500):
+        """Hand up to limit pending (owner, island, written_at) rows to
+        replay_fn (which writes them to Postgres), then remove them here.
+        Returns whatever replay_fn returned; exceptions propagate and the
+        documents stay queued."""
+        markers = self._markers()
+        with self._lock:
+            for owner in markers:
+                self._pending.add(owner)
+                self._index[owner] = self.shard_path(owner)
+            owners = list(self._pending)[:limit]
+        rows, stats = [], {}
+        for owner in owners:
+            path = self.shard_path(owner)
+            try:
+                stat = os.stat(path)
+                with open(path, 'rb') as f:
+                    island = json.loads(f.read())
+            except (OSError, ValueError) as e:
+                logger.warning('dropping unreadable fallback island %s: %s', owner, e)
+                with self._lock:
+                    self._remove(owner)
+                continue
+            rows.append((owner, island, datetime.fromtimestamp(stat.st_mtime, timezone.utc)))
+            stats[owner] = stat
+        if not rows:
+            return None
+        try:
+            result = replay_fn(rows)
+        except Exception:
+            self.replay_failures += 1
+            raise
+        with self._lock:
+            for owner, stat in stats.items():
+                if self._remove(owner, stat):
+                    self.replayed += 1
+        return result
+
+    def stats(self):
+        return {
+            'owners_on_disk': len(self._index),
+            'pending_replay': len(self._pending),
+            'writes': self.writes,
+            'replayed': self.replayed,
+            'replay_failures': self.replay_failures,
+        }
@@ -0,0 +1,40 @@
+"""
+Conditional island writes over HTTP, shared by island_service, main.py and
+server.py.
+
+A write is conditional when it carries If-Match: "v<n>" (the ETag of a
+GET) or expected_version in the body; it is then checked against
+islands.version by common.islands and must never fall back to the file
+store, which cannot check it: answer storage_unavailable() instead.
+"""
+
+from flask import jsonify, request
+
+
+def expected_version(payload=None):
+    """Version a conditional write is based on: If-Match: "v<n>" (the ETag
+    from GET) or expected_version in the body (0 = create only); None for
+    unconditional writes and If-Match: *."""
+    if request.if_match and not request.if_match.star_tag:
+        for tag in request.if_match.as_set():
+            tag = tag.split('-', 1)[0]  # "v7-msgpack" is the same version
+            if tag[:1] == 'v' and tag[1:].isdigit():
+                return int(tag[1:])
+        return -1  # e.g. a file-store ETag, which no stored version matches
+    version = (payload or {}).get('expected_version')
+    if isinstance(version, int) and not isinstance(version, bool):
+        return version
+    return None
+
+
+def conflict_response(conflict):
+    # 412 for If-Match, 409 for expected_version; either way the client gets the current version to retry from
+    resp = jsonify({'status': 'conflict', 'owner': conflict.owner, 'version': conflict.current})
+    resp.status_code = 412 if request.if_match else 409
+    if conflict.current is not None:
+        resp.set_etag(f'v{conflict.current}')
+    return resp
+
+
+def storage_unavailable():
+    return jsonify({'status': 'error', 'error': 'storage unavailable'}), 503
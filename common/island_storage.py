@@ -0,0 +1,151 @@
+"""
+How an island document is stored in its islands row.
+
+Small documents stay in json_state (JSONB). With ISLAND_COMPRESSION=true,
+documents whose compact JSON is at least ISLAND_COMPRESS_THRESHOLD bytes
+go to state_zstd instead: zstd-compressed compact JSON, using the newest
+trained dictionary for ISLAND_DICT_SCHEMA from island_zstd_dicts (see
+db/schema_islands.sql and db/compress_islands.py), whose id is kept in
+state_dict. Compression is skipped when it saves less than
+ISLAND_COMPRESS_MIN_SAVING. Reads decode either layout, so a service
+with compression off still reads rows another service compressed, as
+long as the zstandard package is installed.
+"""
+
+import json
+import os
+import threading
+import time
+
+from psycopg2.extras import Json, RealDictCursor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class IslandStorage:
+
+    def __init__(self, compress=None, threshold=None, level=None, schema=None,
+                 min_saving=None, dict_refresh=300):
+        if compress is None:
+            compress = os.environ.get('ISLAND_COMPRESSION', 'false').lower() == 'true'
+        self.compress = bool(compress) and zstandard is not None
+        self.threshold = int(threshold if threshold is not None else os.environ.get('ISLAND_COMPRESS_THRESHOLD', 8192))
+        self.level = int(level if level is not None else os.environ.get('ISLAND_COMPRESS_LEVEL', 9))
+        self.schema = schema or os.environ.get('ISLAND_DICT_SCHEMA', 'island')
+        self.min_saving = float(min_saving if min_saving is not None else os.environ.get('ISLAND_COMPRESS_MIN_SAVING', 0.1))
+        self.dict_refresh = dict_refresh
+        self._dicts = {}
+        self._current = None
+        self._current_checked = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        self.compressed_writes = 0
+        self.plain_writes = 0
+        self.bytes_raw = 0
+        self.bytes_stored = 0
+        self.decompressed_reads = 0
+
+    # dictionaries
+
+    def _dict(self, conn, dict_id):
+        d = self._dicts.get(dict_id)
+        if d is None:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute('SELECT dict FROM island_zstd_dicts WHERE id = %s', (dict_id,))
+            row = cur.fetchone()
+            if row is None:
+                raise LookupError(f'zstd dictionary {dict_id} not found')
+            d = zstandard.ZstdCompressionDict(bytes(row['dict']))
+            with self._lock:
+                self._dicts[dict_id] = d
+        return d
+
+    def current_dict(self, conn):
+        """Id of the newest dictionary for self.schema (None: no dictionary),
+        looked up again every dict_refresh seconds."""
+        now = time.monotonic()
+        if self._current_checked is not None and now - self._current_checked < self.dict_refresh:
+            return self._current
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute(
+            'SELECT id, dict FROM island_zstd_dicts WHERE schema = %s ORDER BY id DESC LIMIT 1',
+            (self.schema,),
+        )
+        row = cur.fetchone()
+        with self._lock:
+            if row is not None:
+                self._dicts.setdefault(row['id'], zstandard.ZstdCompressionDict(bytes(row['dict'])))
+            self._current = row['id'] if row is not None else None
+            self._current_checked = now
+        return self._current
+
+    def invalidate_dicts(self):
+        with self._lock:
+            self._current_checked = None
+
+    # ZstdCompressor/ZstdDecompressor objects are not thread-safe: one per thread and dictionary
+
+    def _compressor(self, conn, dict_id):
+        cache = self._local.__dict__.setdefault('compressors', {})
+        c = cache.get(dict_id)
+        if c is None:
+            d = self._dict(conn, dict_id) if dict_id is not None else None
+            c = cache[dict_id] = zstandard.ZstdCompressor(level=self.level, dict_data=d)
+        return c
+
+    def _decompressor(self, conn, dict_id):
+        if zstandard is None:
+            raise RuntimeError('the zstandard package is needed to read compressed islands')
+        cache = self._local.__dict__.setdefault('decompressors', {})
+        c = cache.get(dict_id)
+        if c is None:
+            d = self._dict(conn, dict_id) if dict_id is not None else None
+            c = cache[dict_id] = zstandard.ZstdDecompressor(dict_data=d)
+        return c
+
+    # rows
+
+    def columns(self, conn, island):
+        """(json_state, state_zstd, state_dict) query parameters for island."""
+        if not self.compress:
+            self.plain_writes += 1
+            return Json(island), None, None
+        raw = json.dumps(island, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        if len(raw) < self.threshold:
+            self.plain_writes += 1
+            return Json(island), None, None
+        dict_id = self.current_dict(conn)
+        blob = self._compressor(conn, dict_id).compress(raw)
+        if len(blob) > len(raw) * (1 - self.min_saving):
+            self.plain_writes += 1
+            return Json(island), None, None
+        self.compressed_writes += 1
+        self.bytes_raw += len(raw)
+        self.bytes_stored += len(blob)
+        return None, blob, dict_id
+
+    def raw(self, conn, blob, dict_id):
+        """Compact JSON bytes of a compressed document."""
+        self.decompressed_reads += 1
+        return self._decompressor(conn, dict_id).decompress(bytes(blob))
+
+    def state(self, conn, row):
+        """The island dict of a row with json_state, state_zstd, state_dict."""
+        if row['state_zstd'] is None:
+            return row['json_state']
+        return json.loads(self.raw(conn, row['state_zstd'], row['state_dict']))
+
+    def stats(self):
+        return {
+            'compress': self.compress,
+            'threshold': self.threshold,
+            'dictionary': self._current,
+            'compressed_writes': self.compressed_writes,
+            'plain_writes': self.plain_writes,
+            'compression_ratio': round(self.bytes_raw / self.bytes_stored, 2) if self.bytes_stored else None,
+            'decompressed_reads': self.decompressed_reads,
+        }
@@ -0,0 +1,210 @@
+"""
+Island rows in Postgres, shared by island_service, main.py and server.py.
+
+Every write bumps islands.version (db/schema_islands.sql), which is
+returned to the caller. Writers that pass expected_version only succeed
+if the row is still at that version (0: the island must not exist yet);
+otherwise VersionConflict carries the current version.
+
+Documents are written through an IslandStorage (common/island_storage.py),
+which may keep large ones zstd-compressed in state_zstd instead of
+json_state; every read here decodes either layout.
+"""
+
+from psycopg2.extras import RealDictCursor, execute_values
+
+from common.island_storage import IslandStorage
+from common.json_patch import PatchError, apply_patch
+
+# configured from ISLAND_COMPRESSION etc.; pass storage= to override
+default_storage = IslandStorage()
+
+
+class VersionConflict(Exception):
+
+    def __init__(self, owner, current):
+        super().__init__(f'island {owner} is at version {current}')
+        self.owner = owner
+        self.current = current  # None when the island does not exist
+
+
+def current_version(conn, owner):
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute('SELECT version FROM islands WHERE owner = %s', (owner,))
+    row = cur.fetchone()
+    return row['version'] if row else None
+
+
+def load_island(conn, owner, storage=None):
+    """(state, version) of owner's island, or None."""
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute(
+        'SELECT json_state, state_zstd, state_dict, version FROM islands WHERE owner = %s',
+        (owner,),
+    )
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return (storage or default_storage).state(conn, row), row['version']
+
+
+def upsert_island(conn, owner, owner_name, island, expected_version=None, storage=None):
+    """Insert or replace the whole island document; returns the new version."""
+    columns = (storage or default_storage).columns(conn, island)
+    if expected_version is not None:
+        return _replace_island(conn, owner, owner_name, island, columns, expected_version)
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("""
+        INSERT INTO islands (owner, owner_name, level, json_state, state_zstd, state_dict, version, updated_at)
+        VALUES (%s, %s, %s, %s, %s, %s, 1, now())
+        ON CONFLICT (owner) DO UPDATE SET
+          owner_name = EXCLUDED.owner_name,
+          level = EXCLUDED.level,
+          json_state = EXCLUDED.json_state,
+          state_zstd = EXCLUDED.state_zstd,
+          state_dict = EXCLUDED.state_dict,
+          version = islands.version + 1,
+          updated_at = now()
+        RETURNING version
+    """, (owner, owner_name, island.get('level', 1), *columns))
+    version = cur.fetchone()['version']
+    conn.commit()
+    return version
+
+
+def _replace_island(conn, owner, owner_name, island, columns, expected_version):
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    if expected_version == 0:
+        cur.execute("""
+            INSERT INTO islands (owner, owner_name, level, json_state, state_zstd, state_dict, version, updated_at)
+            VALUES (%s, %s, %s, %s, %s, %s, 1, now())
+            ON CONFLICT (owner) DO NOTHING
+            RETURNING version
+        """, (owner, owner_name, island.get('level', 1), *columns))
+    else:
+        # compare-and-set: a single statement, no lock held across requests
+        cur.execute("""
+            UPDATE islands SET
+              owner_name = %s,
+              level = %s,
+              json_state = %s,
+              state_zstd = %s,
+              state_dict = %s,
+              version = version + 1,
+              updated_at = now()
+            WHERE owner = %s AND version = %s
+            RETURNING version
+        """, (owner_name, island.get('level', 1), *columns, owner, expected_version))
+    row = cur.fetchone()
+    if row is None:
+        current = current_version(conn, owner)
+        conn.rollback()
+        raise VersionConflict(owner, current)
+    conn.commit()
+    return row['version']
+
+
+def fetch_islands(conn, owners, storage=None):
+    """(owner, json_state as JSON text, version) for those owners that exist,
+    in one query; the text goes to the client without a parse/serialize."""
+    storage = storage or default_storage
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("""
+        SELECT owner, json_state::text AS json_text, state_zstd, state_dict, version
+        FROM islands WHERE owner = ANY(%s)
+    """, (list(owners),))
+    return [
+        (row['owner'],
+         row['json_text'] if row['state_zstd'] is None
+         else storage.raw(conn, row['state_zstd'], row['state_dict']).decode('utf-8'),
+         row['version'])
+        for row in cur.fetchall()
+    ]
+
+
+def upsert_islands(conn, rows, page_size=500, storage=None):
+    """Batched upsert_island for (owner, owner_name, island) rows with distinct
+    owners; returns {owner: new version}."""
+    storage = storage or default_storage
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    returned = execute_values(cur, """
+        INSERT INTO islands (owner, owner_name, level, json_state, state_zstd, state_dict, version, updated_at)
+        VALUES %s
+        ON CONFLICT (owner) DO UPDATE SET
+          owner_name = EXCLUDED.owner_name,
+          level = EXCLUDED.level,
+          json_state = EXCLUDED.json_state,
+          state_zstd = EXCLUDED.state_zstd,
+          state_dict = EXCLUDED.state_dict,
+          version = islands.version + 1,
+          updated_at = now()
+        RETURNING owner, version
+    """, [(owner, owner_name, island.get('level', 1), *storage.columns(conn, island))
+          for owner, owner_name, island in rows],
+        template='(%s, %s, %s, %s, %s, %s, 1, now())', page_size=page_size, fetch=True)
+    conn.commit()
+    return {row['owner']: row['version'] for row in returned}
+
+
+def replay_islands(conn, rows, page_size=500, storage=None):
+    """Write back (owner, island, written_at) rows saved to the file store
+    while Postgres was down. A row only wins if it is newer than what the
+    table has, so a save that reached Postgres later is not overwritten.
+    Returns {owner: new version} for the rows applied."""
+    storage = storage or default_storage
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    returned = execute_values(cur, """
+        INSERT INTO islands (owner, owner_name, level, json_state, state_zstd, state_dict, version, updated_at)
+        VALUES %s
+        ON CONFLICT (owner) DO UPDATE SET
+          owner_name = EXCLUDED.owner_name,
+          level = EXCLUDED.level,
+          json_state = EXCLUDED.json_state,
+          state_zstd = EXCLUDED.state_zstd,
+          state_dict = EXCLUDED.state_dict,
+          version = islands.version + 1,
+          updated_at = EXCLUDED.updated_at
+        WHERE islands.updated_at IS NULL OR islands.updated_at < EXCLUDED.updated_at
+        RETURNING owner, version
+    """, [(owner, island.get('owner_name', owner), island.get('level', 1), *storage.columns(conn, island), written_at)
+          for owner, island, written_at in rows],
+        template='(%s, %s, %s, %s, %s, %s, 1, %s)', page_size=page_size, fetch=True)
+    conn.commit()
+    return {row['owner']: row['version'] for row in returned}
+
+
+def patch_island(conn, owner, patch, content_type=None, expected_version=None, storage=None):
+    """Apply a JSON Patch / merge patch under the row lock.
+
+    Returns (state, version), or None when the island does not exist.
+    Raises common.json_patch.PatchError for patches that do not apply.
+    """
+    storage = storage or default_storage
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute(
+        'SELECT json_state, state_zstd, state_dict, version FROM islands WHERE owner = %s FOR UPDATE',
+        (owner,),
+    )
+    row = cur.fetchone()
+    if row is None:
+        return None
+    if expected_version is not None and row['version'] != expected_version:
+        conn.rollback()
+        raise VersionConflict(owner, row['version'])
+    state = apply_patch(storage.state(conn, row), patch, content_type)
+    if not isinstance(state, dict):
+        raise PatchError('island state must stay an object')
+    cur.execute("""
+        UPDATE islands SET
+          json_state = %s,
+          state_zstd = %s,
+          state_dict = %s,
+          level = %s,
+          version = version + 1,
+          updated_at = now()
+        WHERE owner = %s
+        RETURNING version
+    """, (*storage.columns(conn, state), state.get('level', 1), owner))
+    version = cur.fetchone()['version']
+    conn.commit()
+    return state, version
@@ -0,0 +1,157 @@
+"""
+Append-only journal of (key, value) records for CoalescingBuffer.
+
+Every put is appended (and fsync'd, unless fsync=False) before it is
+acknowledged, so buffered writes survive a crash. Records are JSON lines
+in the active file; when the buffer takes a batch to flush, the active
+file is sealed as "<path>.<seq>" and, once the flush has committed,
+every sealed segment up to that one is deleted. After a restart,
+replay() returns whatever was never flushed, oldest first. Keys and
+values must be JSON-serializable (and keys come back as JSON gives them).
+
+A journal has a single writer: <path>.lock is flock'd while it is open.
+Journal.claim() hands each worker of a multi-process server a free one.
+"""
+
+import glob
+import json
+import logging
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class JournalLocked(Exception):
+    """Raised when another live process already holds the journal."""
+
+
+class Journal:
+
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._dir = directory
+        self._holder = self._acquire()
+        self._seq = max(self._sealed(), default=0)
+        self._file = open(path, 'ab')
+
+        self.appends = 0
+        self.bytes_written = 0
+        self.syncs = 0
+
+    def _acquire(self):
+        # one writer per journal; the lock goes away with the process
+        holder = open(self.path + '.lock', 'ab')
+        if fcntl is not None:
+            try:
+                fcntl.flock(holder.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                holder.close()
+                raise JournalLocked(self.path)
+        return holder
+
+    def _sealed(self):
+        segments = []
+        for name in glob.glob(glob.escape(self.path) + '.*'):
+            suffix = name.rsplit('.', 1)[1]
+            if suffix.isdigit():
+                segments.append(int(suffix))
+        return sorted(segments)
+
+    def _segment(self, seq):
+        return f'{self.path}.{seq:08d}'
+
+    def _sync_dir(self):
+        if not self.fsync or not hasattr(os, 'O_DIRECTORY'):
+            return
+        fd = os.open(self._dir, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def claim(cls, path, slots=64, **kwargs):
+        """Open the first of <root>-0<ext> .. <root>-<slots-1><ext> that no
+        live process holds, so each worker of a multi-process server gets
+        its own journal and a restarted one replays what a dead one left."""
+        root, ext = os.path.splitext(path)
+        for slot in range(slots):
+            try:
+                return cls(f'{root}-{slot}{ext}', **kwargs)
+            except JournalLocked:
+                continue
+        raise JournalLocked(path)
+
+    def append(self, pairs):
+        data = b''.join(
+            json.dumps([key, value], separators=(',', ':')).encode('utf-8') + b'\n'
+            for key, value in pairs
+        )
+        with self._lock:
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+                self.syncs += 1
+            self.appends += 1
+            self.bytes_written += len(data)
+
+    def rotate(self):
+        """Seal the active file; returns the seq to pass to discard()."""
+        with self._lock:
+            if self._file.tell() == 0:
+                return self._seq
+            self._file.close()
+            self._seq += 1
+            os.replace(self.path, self._segment(self._seq))
+            self._file = open(self.path, 'ab')
+            self._sync_dir()
+            return self._seq
+
+    def discard(self, upto):
+        """Delete sealed segments whose records have been flushed."""
+        for seq in self._sealed():
+            if seq <= upto:
+                os.remove(self._segment(seq))
+        self._sync_dir()
+
+    def replay(self):
+        pairs = []
+        paths = [self._segment(seq) for seq in self._sealed()] + [self.path]
+        for path in paths:
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        key, value = json.loads(line)
+                    except ValueError:
+                        # torn last line from a crash mid-append; it was never acknowledged
+                        logger.warning('skipping unreadable journal record in %s', path)
+                        continue
+                    pairs.append((key, value))
+        return pairs
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            self._holder.close()
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'fsync': self.fsync,
+            'segments': len(self._sealed()),
+            'active_bytes': os.path.getsize(self.path),
+            'appends': self.appends,
+            'bytes_written': self.bytes_written,
+            'syncs': self.syncs,
+        }
@@ -0,0 +1,134 @@
+"""
+JSON Patch (RFC 6902) and JSON Merge Patch (RFC 7396).
+
+Both functions return a new document and leave the input untouched.
+PatchError (a ValueError) is raised for malformed patches, missing paths
+and failed "test" operations; the services answer it with 422.
+"""
+
+import copy
+
+JSON_PATCH = 'application/json-patch+json'
+MERGE_PATCH = 'application/merge-patch+json'
+
+
+class PatchError(ValueError):
+    pass
+
+
+def _parse_pointer(pointer):
+    if pointer == '':
+        return []
+    if not isinstance(pointer, str) or not pointer.startswith('/'):
+        raise PatchError(f'invalid JSON pointer: {pointer!r}')
+    return [part.replace('~1', '/').replace('~0', '~') for part in pointer[1:].split('/')]
+
+
+def _index(container, token, allow_end=False):
+    if allow_end and token == '-':
+        return len(container)
+    if not token.isdigit() or (token != '0' and token.startswith('0')):
+        raise PatchError(f'invalid array index: {token!r}')
+    index = int(token)
+    if index > len(container) or (index == len(container) and not allow_end):
+        raise PatchError(f'array index out of range: {token}')
+    return index
+
+
+def _resolve(doc, parts):
+    for token in parts:
+        if isinstance(doc, dict):
+            if token not in doc:
+                raise PatchError(f'path not found: /{"/".join(parts)}')
+            doc = doc[token]
+        elif isinstance(doc, list):
+            doc = doc[_index(doc, token)]
+        else:
+            raise PatchError(f'path not found: /{"/".join(parts)}')
+    return doc
+
+
+def _add(doc, parts, value):
+    if not parts:
+        return value
+    parent = _resolve(doc, parts[:-1])
+    token = parts[-1]
+    if isinstance(parent, dict):
+        parent[token] = value
+    elif isinstance(parent, list):
+        parent.insert(_index(parent, token, allow_end=True), value)
+    else:
+        raise PatchError('cannot add to a scalar')
+    return doc
+
+
+def _remove(doc, parts):
+    if not parts:
+        raise PatchError('cannot remove the whole document')
+    parent = _resolve(doc, parts[:-1])
+    token = parts[-1]
+    if isinstance(parent, dict):
+        if token not in parent:
+            raise PatchError(f'path not found: /{"/".join(parts)}')
+        return parent.pop(token)
+    if isinstance(parent, list):
+        return parent.pop(_index(parent, token))
+    raise PatchError('cannot remove from a scalar')
+
+
+def apply_json_patch(doc, operations):
+    if not isinstance(operations, list):
+        raise PatchError('JSON Patch must be an array of operations')
+    doc = copy.deepcopy(doc)
+    for op in operations:
+        if not isinstance(op, dict) or 'op' not in op or 'path' not in op:
+            raise PatchError('each operation needs "op" and "path"')
+        name = op['op']
+        parts = _parse_pointer(op['path'])
+        if name in ('add', 'replace', 'test') and 'value' not in op:
+            raise PatchError(f'"{name}" needs a value')
+        if name == 'add':
+            doc = _add(doc, parts, copy.deepcopy(op['value']))
+        elif name == 'remove':
+            _remove(doc, parts)
+        elif name == 'replace':
+            if not parts:
+                doc = copy.deepcopy(op['value'])
+            else:
+                _remove(doc, parts)
+                doc = _add(doc, parts, copy.deepcopy(op['value']))
+        elif name in ('move', 'copy'):
+            source = _parse_pointer(op.get('from'))
+            if name == 'move':
+                if parts[:len(source)] == source and parts != source:
+                    raise PatchError('cannot move a value into itself')
+                value = _remove(doc, source)
+            else:
+                value = copy.deepcopy(_resolve(doc, source))
+            doc = _add(doc, parts, value)
+        elif name == 'test':
+            if _resolve(doc, parts) != op['value']:
+                raise PatchError(f'test failed at {op["path"]}')
+        else:
+            raise PatchError(f'unknown operation: {name!r}')
+    return doc
+
+
+def apply_merge_patch(target, patch):
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    result = copy.deepcopy(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = apply_merge_patch(result.get(key), value)
+    return result
+
+
+def apply_patch(doc, patch, content_type=None):
+    """Apply by Content-Type, or by shape (array = JSON Patch, object = merge patch)."""
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type == JSON_PATCH or (content_type != MERGE_PATCH and isinstance(patch, list)):
+        return apply_json_patch(doc, patch)
+    return apply_merge_patch(doc, patch)
@@ -0,0 +1,178 @@
+"""
+Asymmetric JWT signing with rotating keys and a JWKS document.
+
+Keys are PEM private keys in JWT_KEYS_DIR, one file per key named
+<kid>.pem. The newest kid signs new tokens; every key still in the
+directory verifies, so tokens signed before a rotation stay valid until
+the old file is pruned. Services re-scan the directory at most every
+JWT_KEYS_RELOAD seconds, and immediately when they see an unknown kid.
+
+    python -m common.jwt_keys rotate --dir keys/ [--alg RS256|EdDSA]
+    python -m common.jwt_keys prune --dir keys/ --keep 2
+
+An empty JWT_KEYS_DIR gets a first key on startup. The directory must be
+shared by every worker and survive restarts (a mounted volume), or tokens
+signed by one process fail on the others. Without JWT_KEYS_DIR the ring
+stays on HS256 with the shared secret (SESSION_SECRET) and publishes an
+empty key set; asking for RS256/EdDSA without a directory is an error.
+"""
+
+import argparse
+import glob
+import os
+import secrets
+import threading
+import time
+from datetime import datetime
+
+import jwt
+from jwt.algorithms import OKPAlgorithm, RSAAlgorithm
+
+
+def generate_key(algorithm):
+    if algorithm == 'EdDSA':
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+        return ed25519.Ed25519PrivateKey.generate()
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def new_kid():
+    return datetime.utcnow().strftime('%Y%m%d%H%M%S') + '-' + secrets.token_hex(4)
+
+
+def _algorithm_for(key):
+    from cryptography.hazmat.primitives.asymmetric import ed25519
+    return 'EdDSA' if isinstance(key, ed25519.Ed25519PrivateKey) else 'RS256'
+
+
+def _to_jwk(kid, algorithm, key):
+    exporter = OKPAlgorithm if algorithm == 'EdDSA' else RSAAlgorithm
+    jwk = exporter.to_jwk(key.public_key(), as_dict=True)
+    jwk.update({'kid': kid, 'alg': algorithm, 'use': 'sig'})
+    return jwk
+
+
+class KeyRing:
+
+    def __init__(self, directory=None, algorithm=None, legacy_secret=None, reload_interval=None):
+        self.directory = directory if directory is not None else os.environ.get('JWT_KEYS_DIR')
+        self.algorithm = algorithm or os.environ.get('JWT_ALGORITHM') or ('RS256' if self.directory else 'HS256')
+        if self.algorithm != 'HS256' and not self.directory:
+            raise RuntimeError(f'JWT_ALGORITHM={self.algorithm} needs JWT_KEYS_DIR, a key directory shared '
+                               'by all workers; unset JWT_ALGORITHM to keep HS256')
+        self.legacy_secret = legacy_secret
+        self.reload_interval = float(reload_interval if reload_interval is not None
+                                     else os.environ.get('JWT_KEYS_RELOAD', 60))
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._active = None
+        self._jwks = {'keys': []}
+        self._loaded_at = 0.0
+        if self.algorithm != 'HS256':
+            self._load()
+
+    def _load(self):
+        from cryptography.hazmat.primitives import serialization
+        keys = {}
+        for path in glob.glob(os.path.join(self.directory, '*.pem')):
+            kid = os.path.splitext(os.path.basename(path))[0]
+            with open(path, 'rb') as f:
+                key = serialization.load_pem_private_key(f.read(), password=None)
+            keys[kid] = (_algorithm_for(key), key)
+        if not keys:
+            if self._keys:
+                keys = self._keys
+            else:
+                kid, key = new_kid(), generate_key(self.algorithm)
+                write_key(self.directory, kid, key)
+                keys = {kid: (self.algorithm, key)}
+        active = max(keys)
+        jwks = {'keys': [_to_jwk(kid, alg, key) for kid, (alg, key) in sorted(keys.items())]}
+        with self._lock:
+            self._keys = keys
+            self._active = active
+            self._jwks = jwks
+            self._loaded_at = time.monotonic()
+
+    def _maybe_reload(self, force=False):
+        if self.algorithm == 'HS256':
+            return
+        since = time.monotonic() - self._loaded_at
+        # an unknown kid forces a rescan, but never more than once a second
+        if since > self.reload_interval or (force and since > 1):
+            self._load()
+
+    def encode(self, payload):
+        if self.algorithm == 'HS256':
+            return jwt.encode(payload, self.legacy_secret, algorithm='HS256')
+        self._maybe_reload()
+        with self._lock:
+            kid = self._active
+            algorithm, key = self._keys[kid]
+        return jwt.encode(payload, key, algorithm=algorithm, headers={'kid': kid})
+
+    def decode(self, token):
+        header = jwt.get_unverified_header(token)
+        kid = header.get('kid')
+        if kid is None:
+            if self.legacy_secret is None:
+                raise jwt.InvalidTokenError('token has no key id')
+            return jwt.decode(token, self.legacy_secret, algorithms=['HS256'])
+        self._maybe_reload()
+        entry = self._keys.get(kid)
+        if entry is None:
+            self._maybe_reload(force=True)
+            entry = self._keys.get(kid)
+            if entry is None:
+                raise jwt.InvalidTokenError('unknown key id')
+        algorithm, key = entry
+        return jwt.decode(token, key.public_key(), algorithms=[algorithm])
+
+    def jwks(self):
+        self._maybe_reload()
+        return self._jwks
+
+
+def write_key(directory, kid, key):
+    from cryptography.hazmat.primitives import serialization
+    os.makedirs(directory, exist_ok=True)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    )
+    path = os.path.join(directory, kid + '.pem')
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(pem)
+    os.chmod(tmp, 0o600)
+    os.replace(tmp, path)
+
+
+def _rotate(directory, algorithm):
+    kid = new_kid()
+    write_key(directory, kid, generate_key(algorithm))
+    print('Created signing key', kid)
+
+
+def _prune(directory, keep):
+    paths = sorted(glob.glob(os.path.join(directory, '*.pem')))
+    for path in paths[:-keep] if keep > 0 else []:
+        os.remove(path)
+        print('Removed key', os.path.splitext(os.path.basename(path))[0])
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='Manage JWT signing keys')
+    p.add_argument('command', choices=['rotate', 'prune'])
+    p.add_argument('--dir', default=os.environ.get('JWT_KEYS_DIR'), help='key directory (default env JWT_KEYS_DIR)')
+    p.add_argument('--alg', default=os.environ.get('JWT_ALGORITHM', 'RS256'), choices=['RS256', 'EdDSA'])
+    p.add_argument('--keep', type=int, default=2, help='keys to keep when pruning (newest first)')
+    args = p.parse_args()
+    if not args.dir:
+        print('Key directory not provided. Set JWT_KEYS_DIR or use --dir.')
+    elif args.command == 'rotate':
+        _rotate(args.dir, args.alg)
+    else:
+        _prune(args.dir, args.keep)
@@ -0,0 +1,137 @@
+"""
+In-memory leaderboard with O(log n) updates and rank lookups.
+
+    board = Leaderboard(key=lambda row: (row['score'],))
+    board.load(rows)                       # rows carry a 'user_id'
+    board.update(user_id, score=1200)
+    board.add(user_id, score=50)
+    board.top(50)                          # [(rank, row), ...]
+    board.rank(user_id)
+    board.around(user_id, 5)               # (rank, [(rank, row), ...])
+    board.page_after(board.cursor_values(last_row), 50)
+
+Rows are ordered by key(row) descending, ties by user id ascending. Ranks
+are 1-based positions in that order. Rows returned are copies.
+"""
+
+import threading
+
+from sortedcontainers import SortedList
+
+
+class Leaderboard:
+
+    def __init__(self, key):
+        self.key = key
+        self._order = SortedList()
+        self._rows = {}
+        self._entries = {}
+        self._lock = threading.RLock()
+        self.loaded = False
+        self.loads = 0
+
+    def _entry(self, user_id, row):
+        return tuple(-v for v in self.key(row)), user_id
+
+    def _place(self, user_id, row):
+        old = self._entries.get(user_id)
+        if old is not None:
+            self._order.remove(old)
+        entry = self._entry(user_id, row)
+        self._order.add(entry)
+        self._entries[user_id] = entry
+        self._rows[user_id] = row
+
+    def load(self, rows):
+        """Replace the whole board, e.g. with a fresh read of the table."""
+        rows = {row['user_id']: dict(row) for row in rows}
+        entries = {user_id: self._entry(user_id, row) for user_id, row in rows.items()}
+        order = SortedList(entries.values())
+        with self._lock:
+            self._rows, self._entries, self._order = rows, entries, order
+            self.loaded = True
+            self.loads += 1
+
+    def upsert(self, user_id, row):
+        row = dict(row, user_id=user_id)
+        with self._lock:
+            self._place(user_id, row)
+
+    def update(self, user_id, **fields):
+        """Change some fields of an existing row; returns the new row or None."""
+        with self._lock:
+            row = self._rows.get(user_id)
+            if row is None:
+                return None
+            row = dict(row, **fields)
+            self._place(user_id, row)
+            return dict(row)
+
+    def add(self, user_id, **deltas):
+        """Add to numeric fields of an existing row; returns the new row or None."""
+        with self._lock:
+            row = self._rows.get(user_id)
+            if row is None:
+                return None
+            row = dict(row, **{k: row.get(k, 0) + v for k, v in deltas.items()})
+            self._place(user_id, row)
+            return dict(row)
+
+    def remove(self, user_id):
+        with self._lock:
+            entry = self._entries.pop(user_id, None)
+            if entry is not None:
+                self._order.remove(entry)
+                del self._rows[user_id]
+
+    def get(self, user_id):
+        with self._lock:
+            row = self._rows.get(user_id)
+            return dict(row) if row is not None else None
+
+    def rank(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            return self._order.index(entry) + 1
+
+    def page(self, offset, limit):
+        """(rank, row) pairs for ranks offset+1 .. offset+limit."""
+        with self._lock:
+            entries = self._order[offset:offset + limit]
+            return [(offset + i + 1, dict(self._rows[user_id]))
+                    for i, (_, user_id) in enumerate(entries)]
+
+    def top(self, limit):
+        return self.page(0, limit)
+
+    def cursor_values(self, row):
+        """Keyset position of a row: its sort key followed by the user id."""
+        return (*self.key(row), row['user_id'])
+
+    def page_after(self, values, limit):
+        """(rank, row) pairs following the position given by cursor_values()."""
+        *key, user_id = values
+        with self._lock:
+            start = self._order.bisect_right((tuple(-v for v in key), user_id))
+            return self.page(start, limit)
+
+    def around(self, user_id, n):
+        """The user's rank and up to n rows either side, or (None, [])."""
+        with self._lock:
+            rank = self.rank(user_id)
+            if rank is None:
+                return None, []
+            start = max(0, rank - 1 - n)
+            return rank, self.page(start, rank - start + n)
+
+    def __len__(self):
+        return len(self._order)
+
+    def stats(self):
+        return {
+            'size': len(self._order),
+            'loaded': self.loaded,
+            'loads': self.loads,
+        }
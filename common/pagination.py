@@ -0,0 +1,37 @@
+"""
+Opaque cursors for keyset pagination.
+
+A cursor is the sort key of the last row on a page, serialized so clients
+pass it back unchanged (?cursor=...) instead of an offset. Datetimes are
+kept as ISO strings and restored on decode.
+"""
+
+import base64
+import json
+from datetime import datetime
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(*values):
+    payload = [{'t': v.isoformat()} if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor, *types):
+    """Values of a cursor made by encode_cursor, one per type in `types`;
+    anything else raises InvalidCursor."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        values = [datetime.fromisoformat(v['t']) if isinstance(v, dict) else v for v in payload]
+    except (ValueError, TypeError, KeyError):
+        raise InvalidCursor('malformed cursor')
+    if len(values) != len(types) or not all(
+            isinstance(v, t) and not isinstance(v, bool) for v, t in zip(values, types)):
+        raise InvalidCursor('malformed cursor')
+    return values
+
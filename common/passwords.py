@@ -0,0 +1,163 @@
+"""
+bcrypt hashing off the request thread.
+
+Hashing runs in a small process pool so a burst of logins cannot hold the
+GIL and starve the other request threads. The number of requests waiting
+on the pool is capped; past the cap HashPoolBusy is raised and the caller
+should answer 503.
+
+Settings (environment):
+    PASSWORD_HASH_WORKERS    worker processes, 0 hashes inline (default: CPU count)
+    PASSWORD_HASH_QUEUE      max hash/check calls in flight (default: 4 per worker)
+    PASSWORD_HASH_TIMEOUT    seconds to wait for a result (default 10)
+    BCRYPT_ROUNDS            cost factor for new hashes (default 12)
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+
+class HashPoolBusy(Exception):
+    """Raised when too many hash requests are already queued."""
+
+
+# upper bounds in milliseconds; the last bucket catches everything slower
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, float('inf'))
+
+
+class LatencyHistogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total_ms = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        ms = seconds * 1000
+        with self._lock:
+            self.count += 1
+            self.total_ms += ms
+            for i, bound in enumerate(self.buckets):
+                if ms <= bound:
+                    self.counts[i] += 1
+                    break
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'count': self.count,
+                'avg_ms': round(self.total_ms / self.count, 3) if self.count else 0.0,
+                'buckets': {
+                    ('+Inf' if bound == float('inf') else str(bound)): n
+                    for bound, n in zip(self.buckets, self.counts)
+                },
+            }
+
+
+# _hash and _check run in the pool's helper processes, which import only this
+# module (forkserver preload). Helpers still re-import the launching script as
+# __mp_main__, so the services keep their startup work in start_background().
+
+def _hash(password, rounds):
+    started = time.perf_counter()
+    hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=rounds)).decode('utf-8')
+    return hashed, time.perf_counter() - started
+
+
+def _check(password, hashed):
+    started = time.perf_counter()
+    ok = bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    return ok, time.perf_counter() - started
+
+
+class PasswordHasher:
+
+    def __init__(self, workers=None, max_pending=None, rounds=None, timeout=None):
+        if workers is None:
+            workers = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+        if max_pending is None:
+            max_pending = int(os.environ.get('PASSWORD_HASH_QUEUE', max(workers, 1) * 4))
+        self.workers = max(0, workers)
+        self.max_pending = max(1, max_pending)
+        self.rounds = int(rounds if rounds is not None else os.environ.get('BCRYPT_ROUNDS', 12))
+        self.timeout = float(timeout if timeout is not None else os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+        self.rejected = 0
+        self.hash_latency = LatencyHistogram()
+        self.check_latency = LatencyHistogram()
+        self.wait_latency = LatencyHistogram()
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                methods = multiprocessing.get_all_start_methods()
+                ctx = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                if ctx.get_start_method() == 'forkserver':
+                    # the default preload is __main__, i.e. the whole Flask app
+                    ctx.set_forkserver_preload(['common.passwords'])
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+            return self._executor
+
+    def _reset_executor(self, broken):
+        with self._executor_lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, fn, histogram, *args):
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise HashPoolBusy('password hashing queue is full')
+        try:
+            started = time.perf_counter()
+            if self.workers == 0:
+                result, elapsed = fn(*args)
+            else:
+                executor = self._get_executor()
+                try:
+                    result, elapsed = executor.submit(fn, *args).result(timeout=self.timeout)
+                except FutureTimeout:
+                    raise HashPoolBusy('password hashing timed out')
+                except BrokenProcessPool:
+                    self._reset_executor(executor)
+                    raise
+            histogram.observe(elapsed)
+            self.wait_latency.observe(max(0.0, time.perf_counter() - started - elapsed))
+            return result
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(_hash, self.hash_latency, password, self.rounds)
+
+    def check(self, password, hashed):
+        return self._run(_check, self.check_latency, password, hashed)
+
+    def shutdown(self):
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'max_pending': self.max_pending,
+            'rounds': self.rounds,
+            'rejected': self.rejected,
+            'hash_ms': self.hash_latency.snapshot(),
+            'check_ms': self.check_latency.snapshot(),
+            'queue_wait_ms': self.wait_latency.snapshot(),
+        }
@@ -0,0 +1,90 @@
+"""
+Postgres LISTEN on a dedicated connection, so a process can drop cached
+rows that another process or service changed.
+
+    listener = Listener(DATABASE_URL, 'user_changed', on_notify, on_reset)
+    listener.start()
+
+on_notify(payload) runs on the listener thread for every NOTIFY on the
+channel. Notifications sent while the connection is down are lost, so
+after every (re)connect on_reset() runs before `live` turns True again;
+while `live` is False callers should not trust what they cached.
+"""
+
+import logging
+import select
+import threading
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2 import sql
+
+logger = logging.getLogger(__name__)
+
+
+class Listener:
+
+    def __init__(self, dsn, channel, on_notify, on_reset=None, retry=5.0, ping=30.0):
+        self.dsn = dsn
+        self.channel = channel
+        self.on_notify = on_notify
+        self.on_reset = on_reset
+        self.retry = float(retry)
+        self.ping = float(ping)
+        self.live = False
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.connects = 0
+        self.errors = 0
+        self.received = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='listen-' + self.channel, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self._listen()
+            except Exception as e:
+                self.errors += 1
+                logger.warning('LISTEN %s failed: %s', self.channel, e)
+            self._stop.wait(self.retry)
+
+    def _listen(self):
+        conn = psycopg2.connect(self.dsn)
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cur = conn.cursor()
+            cur.execute(sql.SQL('LISTEN {}').format(sql.Identifier(self.channel)))
+            if self.on_reset is not None:
+                self.on_reset()
+            self.connects += 1
+            self.live = True
+            while not self._stop.is_set():
+                if select.select([conn], [], [], self.ping)[0]:
+                    conn.poll()
+                else:
+                    # a quiet channel: make sure the server is still there
+                    cur.execute('SELECT 1')
+                while conn.notifies:
+                    self.on_notify(conn.notifies.pop(0).payload)
+                    self.received += 1
+        finally:
+            self.live = False
+            conn.close()
+
+    def stats(self):
+        return {
+            'channel': self.channel,
+            'live': self.live,
+            'connects': self.connects,
+            'errors': self.errors,
+            'received': self.received,
+        }
@@ -0,0 +1,62 @@
+"""
+Response bodies compressed once and served many times.
+
+PrecompressedBody keeps the identity bytes plus gzip and (when the brotli
+package is installed) br variants, and answers each request with the
+smallest variant its Accept-Encoding allows. Every variant has its own
+strong ETag so caches never mix them up.
+"""
+
+import gzip
+import hashlib
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class PrecompressedBody:
+
+    def __init__(self, body, mimetype):
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        self.variants = {'identity': body}
+        compressed = {'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            compressed['br'] = brotli.compress(body, quality=11)
+        for encoding, data in compressed.items():
+            if len(data) < len(body):
+                self.variants[encoding] = data
+
+    def choose(self, accept_encodings):
+        """Best encoding for a werkzeug Accept-Encoding header."""
+        best, best_key = 'identity', None
+        for encoding, data in self.variants.items():
+            if encoding == 'identity':
+                continue
+            quality = accept_encodings.quality(encoding)
+            if quality <= 0:
+                continue
+            key = (quality, -len(data))
+            if best_key is None or key > best_key:
+                best, best_key = encoding, key
+        return best
+
+    def respond(self, max_age=0):
+        encoding = self.choose(request.accept_encodings)
+        response = current_app.response_class(self.variants[encoding], mimetype=self.mimetype)
+        if encoding == 'identity':
+            response.set_etag(self.etag)
+        else:
+            response.headers['Content-Encoding'] = encoding
+            response.set_etag(f'{self.etag}-{encoding}')
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        return response.make_conditional(request)
+
+    def stats(self):
+        return {encoding: len(data) for encoding, data in self.variants.items()}
@@ -0,0 +1,83 @@
+"""
+Who is online, answered from memory.
+
+Users are kept in time buckets (ONLINE_BUCKET seconds each) by their last
+heartbeat; a user lives in exactly one bucket, so the online count is the
+size of the user index once buckets older than the window have been
+dropped. Nothing here touches the database; services persist heartbeats
+to online_users and seed the tracker from it on startup and then every
+ONLINE_RESEED_INTERVAL seconds.
+
+The tracker is per process: behind several workers, the re-seeding is
+what brings in the heartbeats the other workers received, so a count lags
+by up to the heartbeat flush interval plus the re-seed interval.
+"""
+
+import os
+import threading
+import time
+from datetime import timezone
+
+
+class PresenceTracker:
+
+    def __init__(self, window=None, bucket=None):
+        self.window = float(window if window is not None else os.environ.get('ONLINE_WINDOW', 300))
+        self.bucket = float(bucket if bucket is not None else os.environ.get('ONLINE_BUCKET', 10))
+        self._slots = max(1, int(round(self.window / self.bucket)))
+        self._buckets = {}  # bucket index -> set of user ids
+        self._where = {}    # user id -> bucket index
+        self._lock = threading.Lock()
+        self._expired_before = None
+
+    def _index(self, ts):
+        return int(ts // self.bucket)
+
+    def _expire(self, now):
+        oldest = self._index(now) - self._slots
+        if self._expired_before == oldest:
+            return
+        for index in [i for i in self._buckets if i < oldest]:
+            for user_id in self._buckets.pop(index):
+                del self._where[user_id]
+        self._expired_before = oldest
+
+    def touch(self, user_id, ts=None):
+        now = time.time()
+        index = self._index(now if ts is None else ts)
+        if index < self._index(now) - self._slots:
+            return
+        with self._lock:
+            previous = self._where.get(user_id)
+            if previous is not None:
+                if previous >= index:
+                    return
+                self._buckets[previous].discard(user_id)
+            self._buckets.setdefault(index, set()).add(user_id)
+            self._where[user_id] = index
+            self._expire(now)
+
+    def seed(self, rows):
+        """Load (user_id, last_seen datetime) pairs, e.g. from online_users."""
+        for user_id, last_seen in rows:
+            if last_seen.tzinfo is None:
+                last_seen = last_seen.replace(tzinfo=timezone.utc)
+            self.touch(user_id, last_seen.timestamp())
+
+    def is_online(self, user_id):
+        with self._lock:
+            self._expire(time.time())
+            return user_id in self._where
+
+    def count(self):
+        with self._lock:
+            self._expire(time.time())
+            return len(self._where)
+
+    def stats(self):
+        return {
+            'online': self.count(),
+            'window_s': self.window,
+            'bucket_s': self.bucket,
+            'buckets': len(self._buckets),
+        }
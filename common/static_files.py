@@ -0,0 +1,234 @@
+"""
+Static files served from an index built at startup.
+
+StaticIndex walks the directory once and records, per file, its size,
+mtime, a content hash (used as the ETag) and any
+precompressed siblings (file.br / file.gz, ignored when older than the
+file). Requests never touch the filesystem to find a file, only to send
+it; Flask's send_file and run_services.py both hand the open file to
+sendfile().
+
+Cache policy: hashed file names like app.3f2a9c1b.js are immutable for a
+year; everything else must be revalidated, which is a cheap 304.
+
+Create the compressed siblings after changing web_frontend:
+
+    python -m common.static_files compress web_frontend
+"""
+
+import argparse
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'public, max-age=0, must-revalidate'
+
+# preferred first on equal quality
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+COMPRESSIBLE = {'.html', '.css', '.js', '.mjs', '.jsx', '.json', '.map', '.svg', '.txt', '.xml'}
+HASHED_NAME = re.compile(r'\.[0-9a-f]{8,}\.[A-Za-z0-9]+$')
+
+mimetypes.add_type('text/javascript', '.jsx')
+mimetypes.add_type('text/javascript', '.mjs')
+
+
+class StaticAsset:
+    __slots__ = ('path', 'size', 'mtime', 'etag', 'mimetype', 'variants')
+
+    def __init__(self, path, size, mtime, etag, mimetype, variants):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.etag = etag
+        self.mimetype = mimetype
+        self.variants = variants
+
+
+def _file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+class StaticIndex:
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.assets = {}
+        self.refresh()
+
+    def refresh(self):
+        assets = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith(('.br', '.gz')):
+                    continue
+                full = os.path.join(dirpath, name)
+                rel = os.path.relpath(full, self.root).replace(os.sep, '/')
+                assets[rel] = self._asset(full)
+        self.assets = assets
+
+    def _asset(self, full):
+        st = os.stat(full)
+        variants = {}
+        for encoding, suffix in ENCODINGS:
+            try:
+                if os.stat(full + suffix).st_mtime >= st.st_mtime:
+                    variants[encoding] = full + suffix
+            except FileNotFoundError:
+                pass
+        mimetype = mimetypes.guess_type(full)[0] or 'application/octet-stream'
+        if mimetype.startswith('text/') or mimetype in ('application/javascript', 'application/json'):
+            mimetype += '; charset=utf-8'
+        return StaticAsset(full, st.st_size, st.st_mtime, _file_hash(full), mimetype, variants)
+
+    def get(self, path):
+        return self.assets.get(path.lstrip('/'))
+
+    def stats(self):
+        return {
+            'files': len(self.assets),
+            'bytes': sum(a.size for a in self.assets.values()),
+            'precompressed': sum(1 for a in self.assets.values() if a.variants),
+        }
+
+
+def cache_control(path):
+    if HASHED_NAME.search(path):
+        return IMMUTABLE
+    return REVALIDATE
+
+
+def choose_encoding(asset, quality):
+    """Best precompressed variant; quality(encoding) -> q from Accept-Encoding."""
+    best, best_q = None, 0
+    for encoding, _ in ENCODINGS:
+        if encoding in asset.variants and quality(encoding) > best_q:
+            best, best_q = encoding, quality(encoding)
+    return best
+
+
+def parse_accept_encoding(header):
+    """Accept-Encoding header -> quality function, for servers without werkzeug."""
+    qualities = {}
+    for part in (header or '').split(','):
+        name, _, params = part.strip().partition(';')
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        qualities[name.strip().lower()] = q
+    return lambda encoding: qualities.get(encoding, qualities.get('*', 0.0))
+
+
+def parse_range(header, size):
+    """Single 'bytes=' range -> (start, end inclusive); None to send the whole
+    file; ValueError when unsatisfiable."""
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[6:].strip().partition('-')
+    try:
+        if first == '':
+            length = int(last)
+            if length <= 0:
+                raise ValueError('empty suffix range')
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        raise ValueError('bad range')
+    if start >= size or end < start:
+        raise ValueError('range not satisfiable')
+    return start, min(end, size - 1)
+
+
+def http_date(ts):
+    return formatdate(ts, usegmt=True)
+
+
+def not_modified(asset, etag, if_none_match, if_modified_since):
+    if if_none_match:
+        tags = [t.strip() for t in if_none_match.split(',')]
+        return '*' in tags or f'"{etag}"' in tags or f'W/"{etag}"' in tags
+    if if_modified_since:
+        try:
+            return int(asset.mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def send_asset(index, path):
+    """Flask response for path from index, or None when it is not indexed.
+
+    Range and conditional requests are handled by send_file, which passes
+    the file to the WSGI server's file wrapper (sendfile under gunicorn).
+    """
+    from flask import request, send_file
+
+    asset = index.get(path)
+    if asset is None:
+        return None
+    encoding = None
+    # byte ranges are only offered on the identity body
+    if 'Range' not in request.headers:
+        encoding = choose_encoding(asset, request.accept_encodings.quality)
+    etag = f'{asset.etag}-{encoding}' if encoding else asset.etag
+    response = send_file(
+        asset.variants[encoding] if encoding else asset.path,
+        mimetype=asset.mimetype,
+        etag=etag,
+        last_modified=asset.mtime,
+        conditional=True
+    )
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if asset.variants:
+        response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = cache_control(path)
+    return response
+
+
+def compress_tree(root, min_size=1024):
+    """Write .gz (and .br with brotli installed) next to compressible files."""
+    written = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            full = os.path.join(dirpath, name)
+            if os.path.splitext(name)[1].lower() not in COMPRESSIBLE or os.path.getsize(full) < min_size:
+                continue
+            with open(full, 'rb') as f:
+                data = f.read()
+            outputs = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+            if brotli is not None:
+                outputs['.br'] = brotli.compress(data, quality=11)
+            for suffix, compressed in outputs.items():
+                if len(compressed) < len(data):
+                    with open(full + suffix, 'wb') as out:
+                        out.write(compressed)
+                    written += 1
+    return written
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='Static asset tools')
+    p.add_argument('command', choices=['compress'])
+    p.add_argument('root', nargs='?', default='web_frontend')
+    args = p.parse_args()
+    print('Wrote', compress_tree(args.root), 'compressed files')
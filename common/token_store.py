@@ -0,0 +1,150 @@
+"""
+Token -> user id stores with expiry.
+
+    create_token_store('memory')
+    create_token_store('redis://redis:6379/0')
+    create_token_store('sqlite:///var/lib/isleborn/tokens.db')
+
+All backends answer get() with a single key lookup. The Redis and SQLite
+backends survive restarts and can be shared by several worker processes
+(Redis also across hosts).
+"""
+
+import heapq
+import os
+import sqlite3
+import threading
+import time
+
+
+class MemoryTokenStore:
+    """Process-local store; tokens are lost on restart."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._tokens = {}
+        # (expires, token) min-heap; entries a later set() or delete() made
+        # stale are skipped when they come up
+        self._expiry = []
+        self._lock = threading.Lock()
+
+    def _purge(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            expires, token = heapq.heappop(self._expiry)
+            entry = self._tokens.get(token)
+            if entry is not None and entry[1] == expires:
+                del self._tokens[token]
+
+    def set(self, token, user_id, ttl=None):
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            expires = now + (ttl or self.ttl)
+            self._tokens[token] = (user_id, expires)
+            heapq.heappush(self._expiry, (expires, token))
+
+    def get(self, token):
+        with self._lock:
+            entry = self._tokens.get(token)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._tokens[token]
+                return None
+            return entry[0]
+
+    def delete(self, token):
+        with self._lock:
+            self._tokens.pop(token, None)
+
+    def __len__(self):
+        return len(self._tokens)
+
+
+class RedisTokenStore:
+    """Shared store backed by Redis keys with EXPIRE."""
+
+    def __init__(self, url, ttl, prefix='payment:token:'):
+        import redis
+        self.ttl = ttl
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+
+    def set(self, token, user_id, ttl=None):
+        self._redis.set(self.prefix + token, user_id, ex=int(ttl or self.ttl))
+
+    def get(self, token):
+        return self._redis.get(self.prefix + token)
+
+    def delete(self, token):
+        self._redis.delete(self.prefix + token)
+
+
+class SQLiteTokenStore:
+    """Single-box store in a local SQLite file, shared by worker processes."""
+
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS tokens (
+                token TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_tokens_expires_at ON tokens (expires_at)')
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def set(self, token, user_id, ttl=None):
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            'INSERT OR REPLACE INTO tokens (token, user_id, expires_at) VALUES (?, ?, ?)',
+            (token, str(user_id), now + (ttl or self.ttl))
+        )
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            conn.execute('DELETE FROM tokens WHERE expires_at <= ?', (now,))
+        conn.commit()
+
+    def get(self, token):
+        row = self._conn().execute(
+            'SELECT user_id FROM tokens WHERE token = ? AND expires_at > ?',
+            (token, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def delete(self, token):
+        conn = self._conn()
+        conn.execute('DELETE FROM tokens WHERE token = ?', (token,))
+        conn.commit()
+
+
+def create_token_store(url=None, ttl=None):
+    """Build a store from a URL (default: env TOKEN_STORE, else memory)."""
+    url = url or os.environ.get('TOKEN_STORE', 'memory')
+    ttl = float(ttl or os.environ.get('TOKEN_TTL', 7 * 24 * 3600))
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisTokenStore(url, ttl)
+    if url.startswith('sqlite:///'):
+        return SQLiteTokenStore(url[len('sqlite:///'):], ttl)
+    if url == 'memory':
+        return MemoryTokenStore(ttl)
+    raise ValueError(f'unsupported TOKEN_STORE: {url}')
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 """migrate_islands.py
-Reads JSON files from godot_server/islands/ and upserts them into Postgres table `islands`.
+Reads JSON files from godot_server/islands/ (flat island_<owner>.json files and the
+hash-sharded <xx>/ subdirectories of common/island_files.py) and upserts them into
+Postgres table `islands`.
 
 Usage:
   pip install psycopg2-binary
@@ -10,16 +12,17 @@ Usage:
 This script is idempotent and uses ON CONFLICT DO UPDATE.
 """
 import os, json, argparse, psycopg2, glob
+from urllib.parse import unquote
 from psycopg2.extras import Json
 
 def load_files(source):
-    files = glob.glob(os.path.join(source, 'island_*.json'))
+    files = glob.glob(os.path.join(source, 'island_*.json')) + glob.glob(os.path.join(source, '??', 'island_*.json'))
     out = []
     for f in files:
         with open(f, 'r', encoding='utf-8') as fh:
             try:
                 data = json.load(fh)
-                owner = os.path.splitext(os.path.basename(f))[0].replace('island_', '')
+                owner = unquote(os.path.splitext(os.path.basename(f))[0][len('island_'):])
                 out.append((owner, data))
             except Exception as e:
                 print('Failed to parse', f, e)
@@ -42,6 +45,9 @@ def migrate(db_url, source):
               owner_name = EXCLUDED.owner_name,
               level = EXCLUDED.level,
               json_state = EXCLUDED.json_state,
+              state_zstd = NULL,
+              state_dict = NULL,
+              version = islands.version + 1,
               updated_at = now();
         """, (owner, owner_name, level, Json(data)))
         print('Upserted island', owner)
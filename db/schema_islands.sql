@@ -9,3 +9,27 @@ CREATE TABLE IF NOT EXISTS islands (
 
 -- Index on updated_at for querying active islands
 CREATE INDEX IF NOT EXISTS idx_islands_updated_at ON islands (updated_at DESC);
+
+-- bumped on every write; returned by POST/PUT/PATCH /island
+ALTER TABLE islands ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 1;
+
+-- Optional compressed storage (common/island_storage.py): large documents are
+-- kept as zstd-compressed JSON in state_zstd with json_state NULL. Queries that
+-- look inside json_state only see uncompressed rows.
+CREATE TABLE IF NOT EXISTS island_zstd_dicts (
+  id SERIAL PRIMARY KEY,
+  schema TEXT NOT NULL,
+  dict BYTEA NOT NULL,
+  samples INTEGER,
+  created_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+);
+
+ALTER TABLE islands ADD COLUMN IF NOT EXISTS state_zstd BYTEA;
+ALTER TABLE islands ADD COLUMN IF NOT EXISTS state_dict INTEGER REFERENCES island_zstd_dicts (id);
+ALTER TABLE islands ALTER COLUMN json_state DROP NOT NULL;
+
+DO $$ BEGIN
+  ALTER TABLE islands ADD CONSTRAINT islands_state_present
+    CHECK (json_state IS NOT NULL OR state_zstd IS NOT NULL);
+EXCEPTION WHEN duplicate_object THEN NULL;
+END $$;
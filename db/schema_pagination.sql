@@ -0,0 +1,11 @@
+-- composite indexes backing keyset (cursor) pagination
+-- run outside a transaction block, like schema_sessions.sql:
+--   psql "$DATABASE_URL" -f db/schema_pagination.sql
+
+-- main.py /api/admin/users: WHERE (created_at, id) < (...) ORDER BY created_at DESC, id DESC
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_created_at_id ON users (created_at DESC, id DESC);
+
+-- both /api/leaderboard routes page the in-memory board (common/leaderboard.py),
+-- loaded with a full scan, so no query used these; drop them where they were created
+DROP INDEX CONCURRENTLY IF EXISTS idx_leaderboard_score_user_id;
+DROP INDEX CONCURRENTLY IF EXISTS idx_users_level_experience_id;
@@ -0,0 +1,10 @@
+-- indexes for the sessions table used by main.py
+-- CONCURRENTLY keeps the table writable while the index builds; run each
+-- statement outside a transaction block (psql does this by default):
+--   psql "$DATABASE_URL" -f db/schema_sessions.sql
+
+-- token lookups on every authenticated request (get_user_by_token, logout)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sessions_token ON sessions (token);
+
+-- range scans of the background sweeper that purges expired sessions
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at);
@@ -0,0 +1,18 @@
+-- idempotency keys for POST /api/stats/ingest (main.py)
+-- a batch id is claimed (with a random per-request token) before the batch
+-- is acknowledged, so a retry is recognised after restarts and across
+-- workers; applied_at is set in the same transaction as the deltas, so a
+-- batch replayed from a worker's journal after a crash is applied once
+--   psql "$DATABASE_URL" -f db/schema_stats.sql
+
+CREATE TABLE IF NOT EXISTS stat_batches (
+    batch_id TEXT PRIMARY KEY,
+    received_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+ALTER TABLE stat_batches ADD COLUMN IF NOT EXISTS claim TEXT;
+ALTER TABLE stat_batches ADD COLUMN IF NOT EXISTS applied_at TIMESTAMPTZ;
+
+-- retries only arrive within minutes, so old keys can be dropped, e.g. daily:
+--   DELETE FROM stat_batches WHERE received_at < now() - interval '7 days';
+CREATE INDEX IF NOT EXISTS idx_stat_batches_received_at ON stat_batches (received_at);
@@ -0,0 +1,23 @@
+-- NOTIFY user_changed <id> whenever a users row that server.py caches changes,
+-- whichever service wrote it (main.py admin toggles, payment_service pearls, ...).
+-- server.py LISTENs and drops its cached copy (common/pg_listen.py):
+--   psql "$DATABASE_URL" -f db/schema_users.sql
+
+CREATE OR REPLACE FUNCTION notify_user_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('user_changed', OLD.id::text);
+    ELSE
+        PERFORM pg_notify('user_changed', NEW.id::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- the columns of server.py USER_PROJECTION_FIELDS; last_login and friends stay quiet
+DROP TRIGGER IF EXISTS users_notify_changed ON users;
+CREATE TRIGGER users_notify_changed
+    AFTER UPDATE OF email, username, is_admin, pearls, level, experience, playtime_minutes,
+                    pvp_wins, pve_kills, achievements, islands_count
+    OR DELETE ON users
+    FOR EACH ROW EXECUTE FUNCTION notify_user_changed();
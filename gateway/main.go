@@ -7,6 +7,9 @@ package main
 //  RATE_LIMIT_RPS=5
 //  RATE_LIMIT_BURST=10
 //  METRICS_PATH=/metrics (default)
+//  JWKS_URL=http://api:5000/.well-known/jwks.json -> verify tokens locally
+//    (tokens without a "kid" header, i.e. HS256 ones server.py signs with
+//    SESSION_SECRET, still go through the Nakama RPC validation below)
 //
 // Prometheus metrics exposed on /metrics
 //
@@ -30,6 +33,7 @@ import (
         "github.com/go-redis/redis/v8"
         "github.com/gorilla/websocket"
         "github.com/lestrrat-go/jwx/v2/jwk"
+        "github.com/lestrrat-go/jwx/v2/jws"
         "github.com/lestrrat-go/jwx/v2/jwt"
         "github.com/prometheus/client_golang/prometheus"
         "github.com/prometheus/client_golang/prometheus/promhttp"
@@ -102,6 +106,11 @@ func (c *JWKSClient) ValidateToken(ctx context.Context, tokenString string) (jwt
         if c.url == "" {
                 return nil, nil
         }
+        // the key set only holds asymmetric keys; leave kid-less (HS256) tokens to the RPC path
+        if msg, err := jws.Parse([]byte(tokenString)); err == nil && len(msg.Signatures()) > 0 &&
+                msg.Signatures()[0].ProtectedHeaders().KeyID() == "" {
+                return nil, nil
+        }
         set, err := c.get(ctx)
         if err != nil {
                 return nil, fmt.Errorf("jwks fetch: %w", err)
@@ -256,6 +265,20 @@ func main() {
         }
 
         jwksClient := NewJWKSClient(jwksURL, 5*time.Minute)
+
+        var batcher *SessionBatcher = nil
+        if batchURL := os.Getenv("VALIDATE_BATCH_URL"); batchURL != "" {
+                maxBatch := 256
+                if v := os.Getenv("VALIDATE_BATCH_MAX"); v != "" {
+                        if n, err := strconv.Atoi(v); err == nil { maxBatch = n }
+                }
+                waitMs := 5
+                if v := os.Getenv("VALIDATE_BATCH_WAIT_MS"); v != "" {
+                        if n, err := strconv.Atoi(v); err == nil { waitMs = n }
+                }
+                batcher = NewSessionBatcher(batchURL, maxBatch, time.Duration(waitMs)*time.Millisecond)
+                log.Println("batched session validation enabled:", batchURL)
+        }
         memRL := NewRateLimiterStore(rate.Limit(rps), burst)
 
         r := chi.NewRouter()
@@ -320,8 +343,16 @@ func main() {
                 if tok != nil {
                         sub, _ = tok.Get("sub")
                         username, _ = tok.Get("name")
+                        if username == nil {
+                                username, _ = tok.Get("username")
+                        }
                 } else {
-                        out, err := callNakamaValidate(nakamaRPCUrl, nakamaHttpKey, token)
+                        var out map[string]interface{}
+                        if batcher != nil {
+                                out, err = batcher.Validate(r.Context(), token)
+                        } else {
+                                out, err = callNakamaValidate(nakamaRPCUrl, nakamaHttpKey, token)
+                        }
                         if err != nil {
                                 http.Error(w, "nakama validate failed: "+err.Error(), http.StatusUnauthorized)
                                 tokenValidationFailures.Inc()
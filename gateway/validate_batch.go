@@ -0,0 +1,126 @@
+package main
+
+// Coalesces concurrent session validations into one request to main.py's
+// batch endpoint (/v2/rpc/validate_sessions, next to the validate_session that
+// NAKAMA_RPC_URL points at), so a reconnect storm costs one round-trip per
+// batch instead of one per player. server.py (compose `api`) has no such route.
+//
+// Env vars:
+//  VALIDATE_BATCH_URL=http://localhost:5000/v2/rpc/validate_sessions -> enable batching
+//  VALIDATE_BATCH_MAX=256      max tokens per request
+//  VALIDATE_BATCH_WAIT_MS=5    how long the first token waits for company
+//
+import (
+        "bytes"
+        "context"
+        "encoding/json"
+        "fmt"
+        "io/ioutil"
+        "net/http"
+        "time"
+)
+
+type batchRequest struct {
+        token string
+        resp  chan batchResult
+}
+
+type batchResult struct {
+        claims map[string]interface{}
+        err    error
+}
+
+type SessionBatcher struct {
+        url      string
+        maxBatch int
+        maxWait  time.Duration
+        client   *http.Client
+        reqs     chan batchRequest
+}
+
+func NewSessionBatcher(url string, maxBatch int, maxWait time.Duration) *SessionBatcher {
+        if maxBatch < 1 {
+                maxBatch = 1
+        }
+        b := &SessionBatcher{
+                url:      url,
+                maxBatch: maxBatch,
+                maxWait:  maxWait,
+                client:   &http.Client{Timeout: 5 * time.Second},
+                reqs:     make(chan batchRequest, maxBatch*4),
+        }
+        go b.loop()
+        return b
+}
+
+// Validate returns the per-token result object ({"valid": ..., "sub": ..., "username": ...}).
+func (b *SessionBatcher) Validate(ctx context.Context, token string) (map[string]interface{}, error) {
+        req := batchRequest{token: token, resp: make(chan batchResult, 1)}
+        select {
+        case b.reqs <- req:
+        case <-ctx.Done():
+                return nil, ctx.Err()
+        }
+        select {
+        case res := <-req.resp:
+                return res.claims, res.err
+        case <-ctx.Done():
+                return nil, ctx.Err()
+        }
+}
+
+func (b *SessionBatcher) loop() {
+        for first := range b.reqs {
+                batch := []batchRequest{first}
+                timer := time.NewTimer(b.maxWait)
+        collect:
+                for len(batch) < b.maxBatch {
+                        select {
+                        case r := <-b.reqs:
+                                batch = append(batch, r)
+                        case <-timer.C:
+                                break collect
+                        }
+                }
+                timer.Stop()
+                go b.flush(batch)
+        }
+}
+
+func (b *SessionBatcher) flush(batch []batchRequest) {
+        results, err := b.post(batch)
+        for i, r := range batch {
+                if err != nil {
+                        r.resp <- batchResult{err: err}
+                } else {
+                        r.resp <- batchResult{claims: results[i]}
+                }
+        }
+}
+
+func (b *SessionBatcher) post(batch []batchRequest) ([]map[string]interface{}, error) {
+        tokens := make([]string, len(batch))
+        for i, r := range batch {
+                tokens[i] = r.token
+        }
+        body, _ := json.Marshal(map[string][]string{"tokens": tokens})
+        resp, err := b.client.Post(b.url, "application/json", bytes.NewReader(body))
+        if err != nil {
+                return nil, err
+        }
+        defer resp.Body.Close()
+        if resp.StatusCode != 200 {
+                msg, _ := ioutil.ReadAll(resp.Body)
+                return nil, fmt.Errorf("validate batch status=%d body=%s", resp.StatusCode, string(msg))
+        }
+        var out struct {
+                Results []map[string]interface{} `json:"results"`
+        }
+        if err := json.NewDecoder(resp.Body).Decode(&out); err != nil {
+                return nil, err
+        }
+        if len(out.Results) != len(batch) {
+                return nil, fmt.Errorf("validate batch: got %d results for %d tokens", len(out.Results), len(batch))
+        }
+        return out.Results, nil
+}
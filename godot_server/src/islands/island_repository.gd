@@ -8,6 +8,11 @@ var island_service_url: String = "http://island_service:5000"
 
 var _http_request: HTTPRequest
 
+## Last document and ETag per owner; load_island revalidates with If-None-Match
+## and reuses the cached copy on 304 Not Modified.
+var _cached := {}
+var _etags := {}
+
 func setup(http_request: HTTPRequest, base_url: String) -> void:
 	_http_request = http_request
 	island_service_url = base_url
@@ -17,33 +22,82 @@ func load_island(owner: String) -> Dictionary:
 	if _http_request == null:
 		return {}
 	var url := island_service_url + "/island/" + owner
-	var err := _http_request.request(url, [], true, HTTPClient.METHOD_GET)
+	var headers := []
+	if _etags.has(owner):
+		headers.append("If-None-Match: " + _etags[owner])
+	var err := _http_request.request(url, headers, true, HTTPClient.METHOD_GET)
 	if err != OK:
 		print("IslandRepository.load_island: request failed", err)
 		return {}
-	yield(_http_request, "request_completed")
-	var body := _http_request.get_response_body()
+	var response = yield(_http_request, "request_completed")
+	if response[1] == 304 and _cached.has(owner):
+		return _cached[owner]
+	var body: PoolByteArray = response[3]
 	if body.size() == 0:
 		return {}
 	var txt := body.get_string_from_utf8()
 	var parsed := JSON.parse(txt)
-	if typeof(parsed) == TYPE_DICTIONARY:
-		return parsed
+	if parsed.error == OK and typeof(parsed.result) == TYPE_DICTIONARY:
+		for header in response[2]:
+			if header.to_lower().begins_with("etag:"):
+				_etags[owner] = header.substr(5).strip_edges()
+				_cached[owner] = parsed.result
+		return parsed.result
+	return {}
+
+
+## Load several islands (neighbours, guild members) in one request.
+## Returns {owner: island}; owners without an island are left out.
+func load_islands(owners: Array) -> Dictionary:
+	if _http_request == null or owners.empty():
+		return {}
+	var url := island_service_url + "/islands"
+	var txt := JSON.print({"owners": owners})
+	var headers := ["Content-Type: application/json"]
+	var err := _http_request.request(url, headers, true, HTTPClient.METHOD_POST, txt.to_utf8())
+	if err != OK:
+		print("IslandRepository.load_islands: request failed", err)
+		return {}
+	var response = yield(_http_request, "request_completed")
+	if response[1] != 200:
+		return {}
+	var body: PoolByteArray = response[3]
+	var parsed := JSON.parse(body.get_string_from_utf8())
+	if parsed.error == OK and typeof(parsed.result) == TYPE_DICTIONARY:
+		return parsed.result.get("islands", {})
 	return {}
 
 
-func save_island(owner: String, island: Dictionary) -> bool:
+## Pass expected_version (the "version" of the last load/save) to only
+## overwrite that version; the save then fails if another writer got there first.
+func save_island(owner: String, island: Dictionary, expected_version: int = -1) -> bool:
 	if _http_request == null:
 		return false
 	var url := island_service_url + "/island/" + owner
 	var payload := {"island": island}
 	var txt := JSON.print(payload)
 	var headers := ["Content-Type: application/json"]
+	if expected_version >= 0:
+		headers.append("If-Match: \"v%d\"" % expected_version)
 	var err := _http_request.request(url, headers, true, HTTPClient.METHOD_PUT, txt.to_utf8())
 	if err != OK:
 		print("IslandRepository.save_island: request failed", err)
 		return false
-	yield(_http_request, "request_completed")
-	return true
+	var response = yield(_http_request, "request_completed")
+	return response[1] < 300
 
 
+## Send only the changed parts of an island as RFC 6902 operations, e.g.
+## [{"op": "add", "path": "/buildings/-", "value": building}].
+func patch_island(owner: String, operations: Array) -> bool:
+	if _http_request == null:
+		return false
+	var url := island_service_url + "/island/" + owner
+	var txt := JSON.print(operations)
+	var headers := ["Content-Type: application/json-patch+json"]
+	var err := _http_request.request(url, headers, true, HTTPClient.METHOD_PATCH, txt.to_utf8())
+	if err != OK:
+		print("IslandRepository.patch_island: request failed", err)
+		return false
+	var response = yield(_http_request, "request_completed")
+	return response[1] < 300
@@ -1,9 +1,23 @@
-from flask import Flask, request, jsonify, abort
+from flask import Flask, request, jsonify, abort, current_app
 from flask_cors import CORS
-import os, json
+import os, sys, json
 from urllib.parse import urljoin
-import psycopg2
-from psycopg2.extras import Json, RealDictCursor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import island_codec
+from common.background import PeriodicWorker
+from common.buffer import CoalescingBuffer
+from common.cache import TTLCache
+from common.db import ConnectionPool
+from common.island_cache import IslandCache, etag_for
+from common.island_files import IslandFileStore
+from common.island_preconditions import conflict_response, expected_version, storage_unavailable
+from common.islands import (
+    VersionConflict, default_storage, fetch_islands, load_island, patch_island, replay_islands,
+    upsert_island, upsert_islands,
+)
+from common.journal import Journal
+from common.json_patch import PatchError
 
 app = Flask(__name__)
 CORS(app)
@@ -25,33 +39,243 @@ if REDIS_ENABLED:
 
 DATABASE_URL = os.environ.get('DATABASE_URL')
 
+db_pool = ConnectionPool(DATABASE_URL)
+
 def get_conn():
-    return psycopg2.connect(DATABASE_URL)
+    return db_pool.connection()
+
+# serialized island documents; the local LRU is per process, Redis (if enabled) is shared
+island_cache = IslandCache(
+    maxsize=int(os.environ.get('ISLAND_CACHE_SIZE', '1000')),
+    ttl=float(os.environ.get('ISLAND_CACHE_TTL', '10')),
+    redis_client=redis_client,
+    redis_ttl=int(os.environ.get('ISLAND_CACHE_REDIS_TTL', '300')),
+)
+
+# Fallback store for when Postgres is down; writes made there are replayed
+# into Postgres every ISLAND_REPLAY_INTERVAL seconds once it is back
+island_files = IslandFileStore(os.environ.get('ISLAND_FILES_DIR', os.path.join('godot_server', 'islands')))
+
+def replay_fallback_islands(rows):
+    with get_conn() as conn:
+        versions = replay_islands(conn, rows)
+    for owner, version in versions.items():
+        island_cache.invalidate(owner, version)
+    return len(versions)
+
+island_replayer = PeriodicWorker(
+    'island-replay',
+    float(os.environ.get('ISLAND_REPLAY_INTERVAL', '30')),
+    lambda: island_files.replay(replay_fallback_islands),
+).start()
+
+def stored(owner, version):
+    # Postgres now has the latest copy: drop cached and fallback ones
+    island_cache.invalidate(owner, version)
+    if version is not None:
+        island_files.discard(owner)
+
+# Write-behind: POST/PUT are acknowledged (202) once queued; only the latest
+# document per owner is kept and dirty islands are upserted in batches every
+# ISLAND_FLUSH_INTERVAL seconds or ISLAND_FLUSH_MAX owners. Set ISLAND_JOURNAL
+# to a file path so queued saves survive a crash (fsync'd unless
+# ISLAND_JOURNAL_FSYNC=false); they are replayed on startup.
+ISLAND_WRITE_BEHIND = os.environ.get('ISLAND_WRITE_BEHIND', 'false').lower() == 'true'
+ISLAND_JOURNAL = os.environ.get('ISLAND_JOURNAL', '')
+
+def flush_islands(items):
+    rows = [(owner, doc['owner_name'], doc['island']) for owner, doc in items]
+    with get_conn() as conn:
+        versions = upsert_islands(conn, rows)
+    for owner, version in versions.items():
+        stored(owner, version)
+
+island_buffer = None
+if ISLAND_WRITE_BEHIND:
+    island_journal = None
+    if ISLAND_JOURNAL:
+        island_journal = Journal(
+            ISLAND_JOURNAL,
+            fsync=os.environ.get('ISLAND_JOURNAL_FSYNC', 'true').lower() == 'true',
+        )
+    island_buffer = CoalescingBuffer(
+        'islands', flush_islands,
+        interval=float(os.environ.get('ISLAND_FLUSH_INTERVAL', '2')),
+        max_items=int(os.environ.get('ISLAND_FLUSH_MAX', '500')),
+        journal=island_journal,
+    )
+    recovered = island_buffer.recover()
+    if recovered:
+        app.logger.info('Replayed %d journaled island saves', recovered)
+    island_buffer.start()
+
+def queue_island(owner, owner_name, island):
+    island_buffer.put(owner, {'owner_name': owner_name, 'island': island})
+    return jsonify({'status': 'queued', 'owner': owner, 'version': None}), 202
+
+def flush_queued(owner):
+    # conditional writes and patches apply to the stored row, so write a queued or fallback save first
+    if island_buffer is not None and island_buffer.get(owner) is not None:
+        island_buffer.flush()
+    if island_files.has_pending(owner):
+        island_files.replay(replay_fallback_islands)
+
+# MessagePack bodies (Accept: application/msgpack), keyed by (owner, etag) of the JSON document
+island_binary = TTLCache(
+    maxsize=int(os.environ.get('ISLAND_CACHE_SIZE', '1000')),
+    ttl=float(os.environ.get('ISLAND_CACHE_TTL', '10')),
+)
+
+def msgpack_body(owner, body, etag):
+    data = island_binary.get((owner, etag))
+    if data is None:
+        data = island_codec.encode(json.loads(body))
+        island_binary.set((owner, etag), data)
+    return data
+
+def request_payload():
+    if request.mimetype in island_codec.MSGPACK_TYPES:
+        try:
+            payload = island_codec.decode(request.get_data())
+        except island_codec.DecodeError:
+            abort(400)  # the same answer as a malformed JSON body
+    else:
+        payload = request.get_json(force=True)
+    if not isinstance(payload, dict):
+        abort(400, 'request body must be an object')
+    return payload
+
+def island_response(owner, body, etag):
+    mimetype = 'application/json'
+    if island_codec.wants_msgpack(request.accept_mimetypes):
+        body, etag, mimetype = msgpack_body(owner, body, etag), f'{etag}-msgpack', island_codec.MSGPACK
+    # no-cache: clients keep the body but revalidate with If-None-Match every time
+    resp = current_app.response_class(body, mimetype=mimetype)
+    resp.set_etag(etag)
+    resp.cache_control.no_cache = True
+    resp.vary.add('Accept')
+    return resp.make_conditional(request)
 
 @app.route('/island/<owner>', methods=['GET'])
 def get_island(owner):
+    if island_buffer is not None:
+        queued = island_buffer.get(owner)
+        if queued is not None:
+            body = jsonify(queued['island']).get_data()
+            return island_response(owner, body, etag_for(body))
+    entry = island_cache.get(owner)
+    if entry is not None:
+        return island_response(owner, *entry)
+    generation = island_cache.generation(owner)
+    state = version = None
+    if island_files.has_pending(owner):
+        # saved while Postgres was down and not replayed yet: newer than the row
+        state = island_files.get(owner)
     # Try DB first
-    try:
-        conn = get_conn()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute('SELECT json_state FROM islands WHERE owner = %s', (owner,))
-        row = cur.fetchone()
-        cur.close()
-        conn.close()
-        if row:
-            return jsonify(row['json_state'])
-    except Exception as e:
-        app.logger.warn('DB read failed: %s', e)
-    # Fallback to file
-    path = os.path.join('godot_server', 'islands', f'island_{owner}.json')
-    if os.path.exists(path):
-        with open(path, 'r', encoding='utf-8') as f:
-            return jsonify(json.load(f))
-    return abort(404)
+    if state is None:
+        try:
+            with get_conn() as conn:
+                row = load_island(conn, owner)
+            if row:
+                state, version = row
+        except Exception as e:
+            app.logger.warn('DB read failed: %s', e)
+    if state is None:
+        # Fallback to file
+        state = island_files.get(owner)
+        if state is None:
+            return abort(404)
+    body = jsonify(state).get_data()
+    return island_response(owner, *island_cache.put(owner, body, version, generation))
+
+ISLAND_BULK_MAX = int(os.environ.get('ISLAND_BULK_MAX', '500'))
+
+def requested_owners():
+    """The de-duplicated owners of a bulk request; aborts with 400 on a
+    malformed list or one longer than ISLAND_BULK_MAX."""
+    if request.method == 'POST':
+        payload = request.get_json(force=True, silent=True)
+        owners = payload.get('owners') if isinstance(payload, dict) else None
+        if not isinstance(owners, list) or not all(isinstance(owner, str) and owner.strip() for owner in owners):
+            abort(400, 'owners must be a list of owner names')
+    else:
+        owners = [owner for owner in request.args.get('owners', '').split(',') if owner.strip()]
+    if not owners:
+        abort(400, 'owners required')
+    if len(owners) > ISLAND_BULK_MAX:
+        abort(400, f'at most {ISLAND_BULK_MAX} owners per request')
+    return list(dict.fromkeys(owner.strip() for owner in owners))
+
+@app.route('/islands', methods=['GET', 'POST'])
+def get_islands():
+    """Several islands in one round-trip: ?owners=a,b,c or a JSON body
+    {"owners": [...]} for long lists. Returns {"islands": {owner: state},
+    "missing": [owners not found]}, as MessagePack if the client asks."""
+    owners = requested_owners()
+
+    bodies = {}
+    if island_buffer is not None:
+        for owner in owners:
+            queued = island_buffer.get(owner)
+            if queued is not None:
+                bodies[owner] = (json.dumps(queued['island'], separators=(',', ':')).encode('utf-8'), None)
+    for owner in owners:
+        if owner not in bodies and island_files.has_pending(owner):
+            bodies[owner] = (json.dumps(island_files.get(owner), separators=(',', ':')).encode('utf-8'), None)
+    bodies.update(island_cache.get_many([owner for owner in owners if owner not in bodies]))
+
+    misses = [owner for owner in owners if owner not in bodies]
+    if misses:
+        generations = {owner: island_cache.generation(owner) for owner in misses}
+        try:
+            with get_conn() as conn:
+                rows = fetch_islands(conn, misses)
+            for owner, text, version in rows:
+                body = text.encode('utf-8')
+                bodies[owner] = island_cache.put(owner, body, version, generations[owner])
+        except Exception as e:
+            app.logger.warn('DB bulk read failed: %s', e)
+        # Fallback to file, only for owners the DB did not have
+        for owner in misses:
+            if owner in bodies or owner not in island_files:
+                continue
+            state = island_files.get(owner)
+            if state is not None:
+                bodies[owner] = (json.dumps(state, separators=(',', ':')).encode('utf-8'), None)
+
+    missing = [owner for owner in owners if owner not in bodies]
+
+    def generate():
+        # stored documents are spliced in as-is instead of being re-serialized
+        yield b'{"islands":{'
+        sep = b''
+        for owner in owners:
+            entry = bodies.get(owner)
+            if entry is not None:
+                yield sep + json.dumps(owner).encode('utf-8') + b':' + entry[0]
+                sep = b','
+        yield b'},"missing":' + json.dumps(missing).encode('utf-8') + b'}'
+
+    def generate_msgpack():
+        yield island_codec.map_header(2) + island_codec.encode('islands') + island_codec.map_header(len(bodies))
+        # encoded bodies are shared with GET /island/<owner>, per (owner, etag)
+        for owner in owners:
+            entry = bodies.get(owner)
+            if entry is not None:
+                body, etag = entry
+                yield island_codec.encode(owner) + msgpack_body(owner, body, etag or etag_for(body))
+        yield island_codec.encode('missing') + island_codec.encode(missing)
+
+    if island_codec.wants_msgpack(request.accept_mimetypes):
+        resp = current_app.response_class(generate_msgpack(), mimetype=island_codec.MSGPACK)
+    else:
+        resp = current_app.response_class(generate(), mimetype='application/json')
+    resp.vary.add('Accept')
+    return resp
 
 @app.route('/island', methods=['POST'])
 def create_island():
-    payload = request.get_json(force=True)
+    payload = request_payload()
     owner = payload.get('owner')
     if not owner:
         return abort(400, 'owner required')
@@ -59,69 +283,95 @@ def create_island():
     island = payload.get('island')
     if not island:
         return abort(400, 'island payload required')
+    expected = expected_version(payload)
+    if island_buffer is not None and expected is None:
+        return queue_island(owner, owner_name, island)
     # upsert into DB
+    version = None
     try:
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO islands (owner, owner_name, level, json_state, updated_at)
-            VALUES (%s, %s, %s, %s, now())
-            ON CONFLICT (owner) DO UPDATE SET
-              owner_name = EXCLUDED.owner_name,
-              level = EXCLUDED.level,
-              json_state = EXCLUDED.json_state,
-              updated_at = now();
-        """, (owner, owner_name, island.get('level',1), Json(island)))
-        conn.commit()
-        cur.close()
-        conn.close()
+        if expected is not None:
+            flush_queued(owner)
+        with get_conn() as conn:
+            version = upsert_island(conn, owner, owner_name, island, expected)
+    except VersionConflict as e:
+        return conflict_response(e)
     except Exception as e:
         app.logger.warn('DB upsert failed: %s', e)
+        if expected is not None:
+            return storage_unavailable()
         # fallback to file
-        path = os.path.join('godot_server', 'islands', f'island_{owner}.json')
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(island, f, indent=2)
-    return jsonify({'status':'ok','owner':owner})
+        island_files.put(owner, island)
+    stored(owner, version)
+    return jsonify({'status':'ok','owner':owner,'version':version})
 
 @app.route('/health', methods=['GET'])
 def health():
     return jsonify({'status': 'ok', 'service': 'island_service'})
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({
+        'db_pool': db_pool.stats(),
+        'island_cache': island_cache.stats(),
+        'island_binary': island_binary.stats(),
+        'island_buffer': island_buffer.stats() if island_buffer is not None else None,
+        'island_files': island_files.stats(),
+        'island_storage': default_storage.stats(),
+        'island_replay': island_replayer.stats(),
+    })
+
 @app.route('/island/<owner>', methods=['PUT'])
 def update_island(owner):
-    if redis_client:
-        lock_key = f'lock:island:{owner}'
-        if not redis_client.set(lock_key, '1', nx=True, ex=10):
-            return jsonify({'status': 'busy'}), 409
-
-    payload = request.get_json(force=True)
+    """Replace the island. Send If-Match: "v<n>" (or expected_version) to
+    only overwrite the version the client read; a conflict returns 412/409
+    with the current version instead of waiting on a lock."""
+    payload = request_payload()
     island = payload.get('island')
     if not island:
         return abort(400, 'island payload required')
+    expected = expected_version(payload)
+    if island_buffer is not None and expected is None:
+        return queue_island(owner, island.get('owner_name', owner), island)
     # upsert same as create
+    version = None
     try:
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO islands (owner, owner_name, level, json_state, updated_at)
-            VALUES (%s, %s, %s, %s, now())
-            ON CONFLICT (owner) DO UPDATE SET
-              owner_name = EXCLUDED.owner_name,
-              level = EXCLUDED.level,
-              json_state = EXCLUDED.json_state,
-              updated_at = now();
-        """, (owner, island.get('owner_name', owner), island.get('level',1), Json(island)))
-        conn.commit()
-        cur.close()
-        conn.close()
+        if expected is not None:
+            flush_queued(owner)
+        with get_conn() as conn:
+            version = upsert_island(conn, owner, island.get('owner_name', owner), island, expected)
+    except VersionConflict as e:
+        return conflict_response(e)
     except Exception as e:
         app.logger.warn('DB update failed: %s', e)
-        path = os.path.join('godot_server', 'islands', f'island_{owner}.json')
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(island, f, indent=2)
-    return jsonify({'status':'ok','owner':owner})
+        if expected is not None:
+            return storage_unavailable()
+        island_files.put(owner, island)
+    stored(owner, version)
+    return jsonify({'status':'ok','owner':owner,'version':version})
+
+@app.route('/island/<owner>', methods=['PATCH'])
+def apply_island_patch(owner):
+    """RFC 6902 JSON Patch (array body or application/json-patch+json) or
+    RFC 7396 merge patch (object body); returns the new version. Honours
+    If-Match like PUT."""
+    patch = request.get_json(force=True, silent=True)
+    if patch is None:
+        return abort(400, 'patch body required')
+    try:
+        flush_queued(owner)
+        with get_conn() as conn:
+            result = patch_island(conn, owner, patch, request.content_type, expected_version())
+    except VersionConflict as e:
+        return conflict_response(e)
+    except PatchError as e:
+        return jsonify({'status': 'error', 'error': str(e)}), 422
+    except Exception as e:
+        app.logger.warn('DB patch failed: %s', e)
+        return storage_unavailable()
+    if result is None:
+        return abort(404)
+    stored(owner, result[1])
+    return jsonify({'status': 'ok', 'owner': owner, 'version': result[1]})
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', '5000')))
@@ -4,19 +4,35 @@ Unified server for Isleborn Online
 Serves web frontend and provides API endpoints for authentication, payments, and game services
 """
 
-from flask import Flask, request, jsonify, send_from_directory, abort
+from flask import Flask, request, jsonify, abort
 from flask_cors import CORS
 import os
 import json
-import bcrypt
 import jwt
 import secrets
+import threading
 from datetime import datetime, timedelta
-import psycopg2
-from psycopg2.extras import RealDictCursor, Json
+from psycopg2.extras import RealDictCursor, execute_values
 from functools import wraps
 
-app = Flask(__name__, static_folder='web_frontend', static_url_path='')
+from common.background import PeriodicWorker
+from common.buffer import CoalescingBuffer
+from common.cache import TTLCache
+from common.http_cache import ResponseCache
+from common.db import ConnectionPool
+from common.island_files import IslandFileStore
+from common.journal import Journal
+from common.island_preconditions import conflict_response, expected_version, storage_unavailable
+from common.islands import VersionConflict, default_storage, load_island, patch_island, replay_islands, upsert_island
+from common.json_patch import PatchError
+from common.leaderboard import Leaderboard
+from common.pagination import InvalidCursor, decode_cursor, encode_cursor
+from common.passwords import HashPoolBusy, PasswordHasher
+from common.precompressed import PrecompressedBody
+from common.presence import PresenceTracker
+from common.static_files import StaticIndex, send_asset
+
+app = Flask(__name__, static_folder=None)
 CORS(app, origins="*", supports_credentials=True)
 
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -30,26 +46,294 @@ PEARL_PACKAGES = {
     "pearls_5000": {"pearls": 5000, "price_rub": 2499, "bonus": 1500}
 }
 
+db_pool = ConnectionPool(DATABASE_URL, cursor_factory=RealDictCursor)
+password_hasher = PasswordHasher()
+
+# token -> users row; entries never outlive the session's expires_at
+session_cache = TTLCache(
+    maxsize=int(os.environ.get('SESSION_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('SESSION_CACHE_TTL', 60))
+)
+
 def get_db():
-    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+    return db_pool.connection()
+
+def cache_session(token, row):
+    """Cache a users row joined with session_expires_at; returns the user."""
+    user = dict(row)
+    expires_at = user.pop('session_expires_at', None)
+    if expires_at is not None:
+        now = datetime.now(expires_at.tzinfo) if expires_at.tzinfo else datetime.utcnow()
+        ttl = (expires_at - now).total_seconds()
+    else:
+        ttl = None
+    session_cache.set(token, user, ttl=ttl, tag=user['id'])
+    return user
 
 def get_user_by_token(token):
+    cached = session_cache.get(token)
+    if cached is not None:
+        return dict(cached)
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT u.* FROM users u
-            JOIN sessions s ON u.id = s.user_id
-            WHERE s.token = %s AND s.expires_at > now()
-        ''', (token,))
-        user = cur.fetchone()
-        cur.close()
-        conn.close()
-        return dict(user) if user else None
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute('''
+                SELECT u.*, s.expires_at AS session_expires_at FROM users u
+                JOIN sessions s ON u.id = s.user_id
+                WHERE s.token = %s AND s.expires_at > now()
+            ''', (token,))
+            user = cur.fetchone()
+        if not user:
+            return None
+        return dict(cache_session(token, user))
     except Exception as e:
         app.logger.error(f'get_user_by_token error: {e}')
         return None
 
+def invalidate_user_sessions(user_id):
+    """Drop cached sessions of a user after their row has changed."""
+    session_cache.invalidate_tag(user_id)
+
+SESSION_SWEEP_BATCH = int(os.environ.get('SESSION_SWEEP_BATCH', 1000))
+SESSION_SWEEP_MAX_BATCHES = int(os.environ.get('SESSION_SWEEP_MAX_BATCHES', 50))
+session_sweep_stats = {'rows_purged': 0, 'last_rows_purged': 0}
+
+def sweep_expired_sessions():
+    """Delete expired sessions in small batches, committing after each one
+    so no sweep holds row locks for long (see db/schema_sessions.sql)."""
+    purged = 0
+    for _ in range(SESSION_SWEEP_MAX_BATCHES):
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute('''
+                DELETE FROM sessions WHERE ctid = ANY(ARRAY(
+                    SELECT ctid FROM sessions
+                    WHERE expires_at < now()
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                ))
+            ''', (SESSION_SWEEP_BATCH,))
+            deleted = cur.rowcount
+            conn.commit()
+        purged += deleted
+        if deleted < SESSION_SWEEP_BATCH:
+            break
+    session_sweep_stats['rows_purged'] += purged
+    session_sweep_stats['last_rows_purged'] = purged
+    return purged
+
+session_sweeper = PeriodicWorker(
+    'session-sweeper',
+    float(os.environ.get('SESSION_SWEEP_INTERVAL', 300)),
+    sweep_expired_sessions
+)
+
+def flush_heartbeats(rows):
+    with get_db() as conn:
+        cur = conn.cursor()
+        execute_values(cur, '''
+            INSERT INTO online_users (user_id, last_seen) VALUES %s
+            ON CONFLICT (user_id) DO UPDATE
+            SET last_seen = GREATEST(online_users.last_seen, EXCLUDED.last_seen)
+        ''', rows, page_size=1000)
+        conn.commit()
+
+# last heartbeat per user, written to online_users every few seconds
+heartbeat_buffer = CoalescingBuffer(
+    'heartbeats',
+    flush_heartbeats,
+    interval=float(os.environ.get('HEARTBEAT_FLUSH_INTERVAL', 5)),
+    max_items=int(os.environ.get('HEARTBEAT_BUFFER_MAX', 10000))
+)
+
+presence = PresenceTracker()
+
+def load_presence():
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT user_id, last_seen FROM online_users
+            WHERE last_seen > now() - make_interval(secs => %s)
+        ''', (presence.window,))
+        presence.seed((row['user_id'], row['last_seen']) for row in cur.fetchall())
+
+def seed_presence():
+    try:
+        load_presence()
+    except Exception as e:
+        print(f'Presence seed error: {e}')
+
+# every worker flushes its heartbeats to online_users; reading them back makes
+# each worker's count include the users the other workers saw
+presence_reseeder = PeriodicWorker(
+    'presence-reseed',
+    float(os.environ.get('ONLINE_RESEED_INTERVAL', 15)),
+    load_presence
+)
+
+
+def record_heartbeat(user_id):
+    presence.touch(user_id)
+    heartbeat_buffer.put(user_id, datetime.utcnow())
+
+leaderboard = Leaderboard(key=lambda row: (row['score'],))
+
+def load_leaderboard():
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT l.user_id, u.username, u.level, l.score, l.pvp_kills, l.pve_kills
+            FROM leaderboard l
+            JOIN users u ON l.user_id = u.id
+        ''')
+        leaderboard.load(cur.fetchall())
+
+STAT_FIELDS = ('experience', 'score', 'pvp_kills', 'pve_kills')
+SCORE_FIELDS = ('score', 'pvp_kills', 'pve_kills')
+INGEST_TOKEN = os.environ.get('INGEST_TOKEN')
+INGEST_BATCH_MAX = int(os.environ.get('INGEST_BATCH_MAX', 5000))
+
+def sum_deltas(a, b):
+    return {k: a.get(k, 0) + b.get(k, 0) for k in a.keys() | b.keys()}
+
+def flush_stats(items):
+    """Apply the deltas of the queued batches and mark them applied, in one
+    transaction. A batch is applied only while its claim is still ours and
+    unapplied (or still unclaimed, e.g. queued while Postgres was down);
+    batches another request claimed, or applied before a crash, are dropped."""
+    with get_db() as conn:
+        cur = conn.cursor()
+        applied = execute_values(cur, '''
+            INSERT INTO stat_batches AS b (batch_id, claim, applied_at)
+            SELECT v.batch_id, v.claim, now() FROM (VALUES %s) AS v (batch_id, claim)
+            ON CONFLICT (batch_id) DO UPDATE SET applied_at = EXCLUDED.applied_at
+            WHERE b.claim = EXCLUDED.claim AND b.applied_at IS NULL
+            RETURNING b.batch_id
+        ''', [(batch_id, batch['claim']) for batch_id, batch in items], page_size=1000, fetch=True)
+        applied = {row['batch_id'] for row in applied}
+        totals = {}
+        for batch_id, batch in items:
+            if batch_id in applied:
+                for user_id, d in batch['users']:
+                    totals[user_id] = sum_deltas(totals.get(user_id, {}), d)
+        experience = [(user_id, d['experience']) for user_id, d in totals.items() if d.get('experience')]
+        scores = [
+            (user_id, d.get('score', 0), d.get('pvp_kills', 0), d.get('pve_kills', 0))
+            for user_id, d in totals.items() if any(d.get(k) for k in SCORE_FIELDS)
+        ]
+        if experience:
+            execute_values(cur, '''
+                UPDATE users AS u SET experience = u.experience + v.experience
+                FROM (VALUES %s) AS v (id, experience)
+                WHERE u.id = v.id
+            ''', experience, page_size=1000)
+        if scores:
+            # unknown user ids are dropped rather than failing the whole flush
+            execute_values(cur, '''
+                INSERT INTO leaderboard (user_id, score, pvp_kills, pve_kills)
+                SELECT v.user_id, v.score, v.pvp_kills, v.pve_kills
+                FROM (VALUES %s) AS v (user_id, score, pvp_kills, pve_kills)
+                WHERE EXISTS (SELECT 1 FROM users u WHERE u.id = v.user_id)
+                ON CONFLICT (user_id) DO UPDATE
+                SET score = leaderboard.score + EXCLUDED.score,
+                    pvp_kills = leaderboard.pvp_kills + EXCLUDED.pvp_kills,
+                    pve_kills = leaderboard.pve_kills + EXCLUDED.pve_kills
+            ''', scores, page_size=1000)
+        conn.commit()
+
+# batch id -> {'claim': token, 'users': [[user_id, deltas], ...]}, summed per
+# user at flush time. Journaled (STATS_JOURNAL, one file per worker) before the
+# batch is claimed, so an acknowledged batch survives a crash; recovered ones
+# are applied only if their claim is still ours (see flush_stats).
+STATS_JOURNAL = os.environ.get('STATS_JOURNAL', os.path.join(app.root_path, 'data', 'journal', 'stats.journal'))
+
+stats_buffer = CoalescingBuffer(
+    'stats',
+    flush_stats,
+    interval=float(os.environ.get('STATS_FLUSH_INTERVAL', 5)),
+    merge=lambda queued, retried: queued
+)
+
+def claim_batch(batch_id, claim):
+    """(ours, new): whether stat_batches holds claim for batch_id, and
+    whether this call inserted it."""
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            INSERT INTO stat_batches (batch_id, claim) VALUES (%s, %s)
+            ON CONFLICT (batch_id) DO NOTHING
+            RETURNING batch_id
+        ''', (batch_id, claim))
+        new = cur.fetchone() is not None
+        conn.commit()
+        if new:
+            return True, True
+        # a flush may have claimed our queued batch first
+        cur.execute('SELECT claim FROM stat_batches WHERE batch_id = %s', (batch_id,))
+        row = cur.fetchone()
+        return row is not None and row['claim'] == claim, False
+
+# batch ids ingest_stats has added to the in-memory board; refresh_leaderboard
+# replays only these, so a batch whose add lands after the reload counts once
+board_batches = set()
+board_lock = threading.Lock()
+
+def refresh_leaderboard():
+    """Re-read the table (game servers may write it too), replaying unflushed deltas."""
+    global board_batches
+    stats_buffer.flush()
+    # no flush may commit between the SELECT and the snapshot, or its deltas
+    # would be in neither
+    with board_lock, stats_buffer.hold():
+        load_leaderboard()
+        pending = [(batch_id, batch) for batch_id, batch in stats_buffer.pending() if batch_id in board_batches]
+        board_batches = {batch_id for batch_id, _ in pending}
+        for _, batch in pending:
+            for user_id, d in batch['users']:
+                leaderboard.add(user_id, **{k: d.get(k, 0) for k in SCORE_FIELDS})
+
+# the board is loaded once and ingest_stats applies deltas as they arrive, so
+# the full re-read is opt-in: set LEADERBOARD_RELOAD (seconds) when something
+# else writes the leaderboard table or several workers each keep a board
+leaderboard_reloader = PeriodicWorker(
+    'leaderboard-reload',
+    float(os.environ.get('LEADERBOARD_RELOAD', 0)),
+    refresh_leaderboard
+)
+
+try:
+    import markdown
+except ImportError:
+    markdown = None
+
+GUIDES_PATH = os.environ.get('GUIDES_PATH', os.path.join(app.root_path, 'data', 'guides.json'))
+GUIDES_MAX_AGE = int(os.environ.get('GUIDES_MAX_AGE', 300))
+guides_payloads = {}
+
+def load_guides():
+    """Read GUIDES_PATH and build the compressed bodies served by /api/guides."""
+    global guides_payloads
+    with open(GUIDES_PATH, 'r', encoding='utf-8') as f:
+        guides = json.load(f)
+    
+    variants = {'markdown': guides}
+    if markdown is not None:
+        variants['html'] = [dict(g, content=markdown.markdown(g['content'])) for g in guides]
+    
+    guides_payloads = {
+        name: PrecompressedBody(
+            json.dumps({'guides': data}, ensure_ascii=False, separators=(',', ':')).encode('utf-8'),
+            'application/json'
+        )
+        for name, data in variants.items()
+    }
+    return len(guides)
+
+try:
+    load_guides()
+except Exception as e:
+    print(f'Load guides error: {e}')
+
 def require_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -95,23 +379,48 @@ def require_admin(f):
         return f(*args, **kwargs)
     return decorated
 
+@app.errorhandler(HashPoolBusy)
+def hash_pool_busy(e):
+    response = jsonify({'error': 'Сервер перегружен, попробуйте позже'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+# web_frontend is indexed once; restart (or static_index.refresh()) after deploying assets
+static_index = StaticIndex(os.path.join(app.root_path, 'web_frontend'))
+
 @app.route('/')
 def serve_index():
-    return send_from_directory('web_frontend', 'index.html')
+    return send_asset(static_index, 'index.html') or abort(404)
 
 @app.route('/<path:path>')
 def serve_static(path):
-    try:
-        if os.path.exists(os.path.join('web_frontend', path)):
-            return send_from_directory('web_frontend', path)
-        return send_from_directory('web_frontend', 'index.html')
-    except:
-        return send_from_directory('web_frontend', 'index.html')
+    return send_asset(static_index, path) or send_asset(static_index, 'index.html') or abort(404)
 
 @app.route('/health', methods=['GET'])
 def health():
     return jsonify({"status": "ok", "service": "isleborn_server"})
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({
+        "db_pool": db_pool.stats(),
+        "session_cache": session_cache.stats(),
+        "password_hasher": password_hasher.stats(),
+        "session_sweeper": dict(session_sweeper.stats(), **session_sweep_stats),
+        "heartbeat_buffer": heartbeat_buffer.stats(),
+        "presence": presence.stats(),
+        "content_cache": content_cache.stats(),
+        "presence_reseeder": presence_reseeder.stats(),
+        "leaderboard": dict(leaderboard.stats(), reload=leaderboard_reloader.stats()),
+        "stats_buffer": stats_buffer.stats(),
+        "guides_bytes": {name: p.stats() for name, p in guides_payloads.items()},
+        "static": static_index.stats(),
+        "island_files": island_files.stats(),
+        "island_replay": island_replayer.stats(),
+        "island_storage": default_storage.stats()
+    })
+
 @app.route('/api/auth/register', methods=['POST'])
 def register():
     data = request.get_json()
@@ -132,39 +441,42 @@ def register():
     if len(username) < 2:
         return jsonify({"error": "Имя должно быть минимум 2 символа"}), 400
     
-    password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    password_hash = password_hasher.hash(password)
     
     try:
-        conn = get_db()
-        cur = conn.cursor()
+        with get_db() as conn:
+            cur = conn.cursor()
         
-        cur.execute("SELECT id FROM users WHERE email = %s", (email,))
-        if cur.fetchone():
-            conn.close()
-            return jsonify({"error": "Пользователь с таким email уже существует"}), 400
+            cur.execute("SELECT id FROM users WHERE email = %s", (email,))
+            if cur.fetchone():
+                return jsonify({"error": "Пользователь с таким email уже существует"}), 400
         
-        cur.execute("""
-            INSERT INTO users (email, password_hash, username, pearls, level, experience, playtime, achievements)
-            VALUES (%s, %s, %s, 100, 1, 0, 0, 0)
-            RETURNING id, email, username, pearls, level, experience, playtime, achievements, is_admin
-        """, (email, password_hash, username))
+            cur.execute("""
+                INSERT INTO users (email, password_hash, username, pearls, level, experience, playtime, achievements)
+                VALUES (%s, %s, %s, 100, 1, 0, 0, 0)
+                RETURNING id, email, username, pearls, level, experience, playtime, achievements, is_admin
+            """, (email, password_hash, username))
         
-        user = cur.fetchone()
+            user = cur.fetchone()
         
-        token = secrets.token_urlsafe(32)
-        cur.execute('''
-            INSERT INTO sessions (user_id, token)
-            VALUES (%s, %s)
-        ''', (user['id'], token))
+            token = secrets.token_urlsafe(32)
+            cur.execute('''
+                INSERT INTO sessions (user_id, token)
+                VALUES (%s, %s)
+            ''', (user['id'], token))
         
-        cur.execute('''
-            INSERT INTO leaderboard (user_id, score)
-            VALUES (%s, 0)
-            ON CONFLICT (user_id) DO NOTHING
-        ''', (user['id'],))
+            cur.execute('''
+                INSERT INTO leaderboard (user_id, score)
+                VALUES (%s, 0)
+                ON CONFLICT (user_id) DO NOTHING
+            ''', (user['id'],))
         
-        conn.commit()
-        conn.close()
+            conn.commit()
+        
+        leaderboard.upsert(user['id'], {
+            'username': user['username'], 'level': user['level'],
+            'score': 0, 'pvp_kills': 0, 'pve_kills': 0
+        })
         
         return jsonify({
             "status": "success",
@@ -190,34 +502,28 @@ def login():
         return jsonify({"error": "Введите email и пароль"}), 400
     
     try:
-        conn = get_db()
-        cur = conn.cursor()
+        with get_db() as conn:
+            cur = conn.cursor()
         
-        cur.execute("SELECT * FROM users WHERE email = %s", (email,))
-        user = cur.fetchone()
+            cur.execute("SELECT * FROM users WHERE email = %s", (email,))
+            user = cur.fetchone()
         
         if not user:
-            conn.close()
             return jsonify({"error": "Неверный email или пароль"}), 401
         
-        if not bcrypt.checkpw(password.encode('utf-8'), user['password_hash'].encode('utf-8')):
-            conn.close()
+        if not password_hasher.check(password, user['password_hash']):
             return jsonify({"error": "Неверный email или пароль"}), 401
         
-        token = secrets.token_urlsafe(32)
-        cur.execute('''
-            INSERT INTO sessions (user_id, token)
-            VALUES (%s, %s)
-        ''', (user['id'], token))
-        
-        cur.execute('''
-            INSERT INTO online_users (user_id, last_seen)
-            VALUES (%s, now())
-            ON CONFLICT (user_id) DO UPDATE SET last_seen = now()
-        ''', (user['id'],))
+        with get_db() as conn:
+            cur = conn.cursor()
+            token = secrets.token_urlsafe(32)
+            cur.execute('''
+                INSERT INTO sessions (user_id, token)
+                VALUES (%s, %s)
+            ''', (user['id'], token))
+            conn.commit()
         
-        conn.commit()
-        conn.close()
+        record_heartbeat(user['id'])
         
         user_data = dict(user)
         del user_data['password_hash']
@@ -228,6 +534,8 @@ def login():
             "user": user_data
         })
         
+    except HashPoolBusy:
+        raise
     except Exception as e:
         print(f"Login error: {e}")
         return jsonify({"error": "Ошибка входа"}), 500
@@ -266,12 +574,12 @@ def logout():
             token = auth_header[7:]
     
     if token:
+        session_cache.pop(token)
         try:
-            conn = get_db()
-            cur = conn.cursor()
-            cur.execute('DELETE FROM sessions WHERE token = %s', (token,))
-            conn.commit()
-            conn.close()
+            with get_db() as conn:
+                cur = conn.cursor()
+                cur.execute('DELETE FROM sessions WHERE token = %s', (token,))
+                conn.commit()
         except Exception as e:
             print(f"Logout error: {e}")
     
@@ -291,12 +599,10 @@ def validate_session():
         user_id = payload.get('sub')
         username = payload.get('username', '')
         
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute('SELECT 1 FROM sessions WHERE token = %s', (token,))
-        session = cur.fetchone()
-        cur.close()
-        conn.close()
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT 1 FROM sessions WHERE token = %s', (token,))
+            session = cur.fetchone()
         
         if not session:
             return jsonify({'valid': False, 'error': 'session not found'}), 401
@@ -314,6 +620,69 @@ def validate_session():
         print(f'Validate session error: {e}')
         return jsonify({'valid': False, 'error': 'validation failed'}), 500
 
+VALIDATE_BATCH_MAX = int(os.environ.get('VALIDATE_BATCH_MAX', 1000))
+
+@app.route('/v2/rpc/validate_sessions', methods=['POST'])
+def validate_sessions():
+    """Batch variant of validate_session for the gateway.
+    
+    Body: {"tokens": [...]}. Results come back in the same order. Tokens not
+    in the session cache are resolved with one query for the whole batch.
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    tokens = data.get('tokens')
+    if not isinstance(tokens, list) or not tokens:
+        return jsonify({'error': 'tokens required'}), 400
+    if len(tokens) > VALIDATE_BATCH_MAX:
+        return jsonify({'error': f'at most {VALIDATE_BATCH_MAX} tokens per batch'}), 413
+    
+    results = [None] * len(tokens)
+    pending = {}
+    for i, token in enumerate(tokens):
+        if not isinstance(token, str) or not token:
+            results[i] = {'valid': False, 'error': 'no token'}
+            continue
+        try:
+            payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
+        except jwt.ExpiredSignatureError:
+            results[i] = {'valid': False, 'error': 'token expired'}
+            continue
+        except jwt.InvalidTokenError as e:
+            results[i] = {'valid': False, 'error': str(e)}
+            continue
+        claims = {'valid': True, 'sub': payload.get('sub'), 'username': payload.get('username', '')}
+        if session_cache.get(token) is not None:
+            results[i] = claims
+        else:
+            pending.setdefault(token, []).append((i, claims))
+    
+    if pending:
+        try:
+            with get_db() as conn:
+                cur = conn.cursor()
+                cur.execute('''
+                    SELECT u.*, s.token AS session_token, s.expires_at AS session_expires_at
+                    FROM sessions s
+                    JOIN users u ON u.id = s.user_id
+                    WHERE s.token = ANY(%s) AND s.expires_at > now()
+                ''', (list(pending),))
+                rows = cur.fetchall()
+        except Exception as e:
+            print(f'Validate sessions error: {e}')
+            return jsonify({'error': 'validation failed'}), 500
+        
+        found = set()
+        for row in rows:
+            row = dict(row)
+            token = row.pop('session_token')
+            cache_session(token, row)
+            found.add(token)
+        for token, entries in pending.items():
+            for i, claims in entries:
+                results[i] = claims if token in found else {'valid': False, 'error': 'session not found'}
+    
+    return jsonify({'results': results})
+
 @app.route('/v2/account/authenticate/email', methods=['POST'])
 def nakama_compat_auth():
     data = request.get_json(force=True)
@@ -325,15 +694,22 @@ def nakama_compat_auth():
         return jsonify({'error': 'email and password required'}), 400
     
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        
-        cur.execute('SELECT * FROM users WHERE email = %s', (email,))
-        user = cur.fetchone()
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT * FROM users WHERE email = %s', (email,))
+            user = cur.fetchone()
         
+        password_hash = None
         if not user:
-            if create:
-                password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+            if not create:
+                return jsonify({'error': 'user not found'}), 404
+            password_hash = password_hasher.hash(password)
+        elif not password_hasher.check(password, user['password_hash']):
+            return jsonify({'error': 'invalid credentials'}), 401
+        
+        with get_db() as conn:
+            cur = conn.cursor()
+            if password_hash:
                 username = email.split('@')[0]
                 cur.execute('''
                     INSERT INTO users (email, password_hash, username, pearls, level)
@@ -341,39 +717,29 @@ def nakama_compat_auth():
                     RETURNING id, email, username
                 ''', (email, password_hash, username))
                 user = cur.fetchone()
-                conn.commit()
-            else:
-                cur.close()
-                conn.close()
-                return jsonify({'error': 'user not found'}), 404
-        else:
-            if not bcrypt.checkpw(password.encode('utf-8'), user['password_hash'].encode('utf-8')):
-                cur.close()
-                conn.close()
-                return jsonify({'error': 'invalid credentials'}), 401
-        
-        expires_at = datetime.utcnow() + timedelta(days=7)
-        token_payload = {
-            'sub': str(user['id']),
-            'username': user['username'],
-            'email': user['email'],
-            'exp': expires_at.timestamp()
-        }
-        token = jwt.encode(token_payload, JWT_SECRET, algorithm='HS256')
         
-        cur.execute('''
-            INSERT INTO sessions (user_id, token, expires_at)
-            VALUES (%s, %s, %s)
-        ''', (user['id'], token, expires_at))
-        conn.commit()
-        cur.close()
-        conn.close()
+            expires_at = datetime.utcnow() + timedelta(days=7)
+            token_payload = {
+                'sub': str(user['id']),
+                'username': user['username'],
+                'email': user['email'],
+                'exp': expires_at.timestamp()
+            }
+            token = jwt.encode(token_payload, JWT_SECRET, algorithm='HS256')
+        
+            cur.execute('''
+                INSERT INTO sessions (user_id, token, expires_at)
+                VALUES (%s, %s, %s)
+            ''', (user['id'], token, expires_at))
+            conn.commit()
         
         return jsonify({
             'token': token,
             'username': user['username'],
             'user_id': str(user['id'])
         })
+    except HashPoolBusy:
+        raise
     except Exception as e:
         print(f'Nakama compat auth error: {e}')
         return jsonify({'error': 'auth failed'}), 500
@@ -408,12 +774,12 @@ def update_profile():
     username = data.get('username', '').strip()
     if username and len(username) >= 2:
         try:
-            conn = get_db()
-            cur = conn.cursor()
-            cur.execute('UPDATE users SET username = %s, updated_at = now() WHERE id = %s', (username, user['id']))
-            conn.commit()
-            cur.close()
-            conn.close()
+            with get_db() as conn:
+                cur = conn.cursor()
+                cur.execute('UPDATE users SET username = %s, updated_at = now() WHERE id = %s', (username, user['id']))
+                conn.commit()
+            invalidate_user_sessions(user['id'])
+            leaderboard.update(user['id'], username=username)
         except Exception as e:
             print(f'Update profile error: {e}')
             return jsonify({'error': 'Ошибка обновления профиля'}), 500
@@ -438,18 +804,18 @@ def purchase_pearls():
     total_pearls = package["pearls"] + package["bonus"]
     
     try:
-        conn = get_db()
-        cur = conn.cursor()
+        with get_db() as conn:
+            cur = conn.cursor()
         
-        cur.execute("""
-            UPDATE users SET pearls = pearls + %s, updated_at = now()
-            WHERE id = %s
-            RETURNING pearls
-        """, (total_pearls, user['id']))
+            cur.execute("""
+                UPDATE users SET pearls = pearls + %s, updated_at = now()
+                WHERE id = %s
+                RETURNING pearls
+            """, (total_pearls, user['id']))
         
-        result = cur.fetchone()
-        conn.commit()
-        conn.close()
+            result = cur.fetchone()
+            conn.commit()
+        invalidate_user_sessions(user['id'])
         
         if not result:
             return jsonify({"error": "Пользователь не найден"}), 404
@@ -466,10 +832,20 @@ def purchase_pearls():
         print(f"Purchase error: {e}")
         return jsonify({"error": "Ошибка покупки"}), 500
 
+# serialized /api/news body, dropped when admins add or delete news
+content_cache = ResponseCache(ttl=float(os.environ.get('CONTENT_CACHE_TTL', 60)))
+CONTENT_MAX_AGE = int(os.environ.get('CONTENT_MAX_AGE', 30))
+
 @app.route('/api/news', methods=['GET'])
 def get_news():
     try:
-        conn = get_db()
+        return content_cache.respond('news', load_news, max_age=CONTENT_MAX_AGE)
+    except Exception as e:
+        print(f'Get news error: {e}')
+        return jsonify({'news': []})
+
+def load_news():
+    with get_db() as conn:
         cur = conn.cursor()
         cur.execute('''
             SELECT id, title, content, news_type, is_new, created_at
@@ -478,24 +854,18 @@ def get_news():
             LIMIT 20
         ''')
         news = cur.fetchall()
-        cur.close()
-        conn.close()
-        
-        result = []
-        for n in news:
-            result.append({
-                'id': n['id'],
-                'title': n['title'],
-                'content': n['content'],
-                'type': n['news_type'],
-                'isNew': n['is_new'],
-                'date': n['created_at'].strftime('%Y-%m-%d') if n['created_at'] else ''
-            })
-        
-        return jsonify({'news': result})
-    except Exception as e:
-        print(f'Get news error: {e}')
-        return jsonify({'news': []})
+    
+    result = []
+    for n in news:
+        result.append({
+            'id': n['id'],
+            'title': n['title'],
+            'content': n['content'],
+            'type': n['news_type'],
+            'isNew': n['is_new'],
+            'date': n['created_at'].strftime('%Y-%m-%d') if n['created_at'] else ''
+        })
+    return {'news': result}
 
 @app.route('/api/admin/news', methods=['POST'])
 @require_admin
@@ -509,17 +879,16 @@ def create_news():
         return jsonify({'error': 'Заполните заголовок и содержание'}), 400
     
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute('''
-            INSERT INTO news (title, content, news_type)
-            VALUES (%s, %s, %s)
-            RETURNING id, title, content, news_type, is_new, created_at
-        ''', (title, content, news_type))
-        news = cur.fetchone()
-        conn.commit()
-        cur.close()
-        conn.close()
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute('''
+                INSERT INTO news (title, content, news_type)
+                VALUES (%s, %s, %s)
+                RETURNING id, title, content, news_type, is_new, created_at
+            ''', (title, content, news_type))
+            news = cur.fetchone()
+            conn.commit()
+        content_cache.invalidate('news')
         
         return jsonify({'news': dict(news)})
     except Exception as e:
@@ -530,232 +899,203 @@ def create_news():
 @require_admin
 def delete_news(news_id):
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute('DELETE FROM news WHERE id = %s', (news_id,))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute('DELETE FROM news WHERE id = %s', (news_id,))
+            conn.commit()
+        content_cache.invalidate('news')
         return jsonify({'status': 'ok'})
     except Exception as e:
         print(f'Delete news error: {e}')
         return jsonify({'error': 'Ошибка удаления'}), 500
 
+def leaderboard_entry(rank, l):
+    return {
+        'rank': rank,
+        'username': l['username'],
+        'level': l['level'],
+        'score': l['score'],
+        'pvp_kills': l['pvp_kills'],
+        'pve_kills': l['pve_kills']
+    }
+
 @app.route('/api/leaderboard', methods=['GET'])
 def get_leaderboard():
-    limit = min(int(request.args.get('limit', 50)), 100)
+    limit = max(1, min(request.args.get('limit', 50, type=int), 100))
+    cursor = request.args.get('cursor')
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT u.username, u.level, l.score, l.pvp_kills, l.pve_kills
-            FROM leaderboard l
-            JOIN users u ON l.user_id = u.id
-            ORDER BY l.score DESC
-            LIMIT %s
-        ''', (limit,))
-        leaders = cur.fetchall()
-        cur.close()
-        conn.close()
-        
-        result = []
-        for i, l in enumerate(leaders):
-            result.append({
-                'rank': i + 1,
-                'username': l['username'],
-                'level': l['level'],
-                'score': l['score'],
-                'pvp_kills': l['pvp_kills'],
-                'pve_kills': l['pve_kills']
-            })
-        
-        return jsonify({'leaderboard': result})
+        after = decode_cursor(cursor, int, int) if cursor else None
+    except InvalidCursor:
+        return jsonify({'error': 'Неверный курсор'}), 400
+    
+    try:
+        if not leaderboard.loaded:
+            load_leaderboard()
+        
+        # (score, user_id) keyset: one extra row tells whether a next page exists
+        if after:
+            rows = leaderboard.page_after(after, limit + 1)
+        else:
+            rows = leaderboard.top(limit + 1)
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(*leaderboard.cursor_values(rows[-1][1]))
+        
+        result = [leaderboard_entry(rank, l) for rank, l in rows]
+        return jsonify({'leaderboard': result, 'next_cursor': next_cursor})
     except Exception as e:
         print(f'Get leaderboard error: {e}')
-        return jsonify({'leaderboard': []})
+        return jsonify({'leaderboard': [], 'next_cursor': None})
 
-@app.route('/api/online', methods=['GET'])
-def get_online_count():
+@app.route('/api/leaderboard/me', methods=['GET'])
+@require_auth
+def get_my_rank():
+    user = request.current_user
+    around = max(0, min(request.args.get('around', 5, type=int), 50))
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT COUNT(*) as count FROM online_users
-            WHERE last_seen > now() - interval '5 minutes'
-        ''')
-        result = cur.fetchone()
-        count = result['count'] if result else 0
-        cur.close()
-        conn.close()
-        return jsonify({'online': count})
+        if not leaderboard.loaded:
+            load_leaderboard()
+        rank, entries = leaderboard.around(user['id'], around)
+    except Exception as e:
+        print(f'Get rank error: {e}')
+        return jsonify({'error': 'Рейтинг недоступен'}), 503
+    
+    if rank is None:
+        return jsonify({'error': 'Игрок не найден в рейтинге'}), 404
+    
+    return jsonify({
+        'rank': rank,
+        'total': len(leaderboard),
+        'leaderboard': [leaderboard_entry(r, l) for r, l in entries]
+    })
+
+@app.route('/api/stats/ingest', methods=['POST'])
+def ingest_stats():
+    """Stat deltas from the world servers.
+
+    {"batch_id": "...", "events": [{"user_id": 1, "experience": 40, "pve_kills": 1}, ...]}
+
+    The batch id (or an Idempotency-Key header) makes retries safe: a batch
+    that was already accepted is acknowledged without being counted again.
+    Accepted batches are journaled and claimed in stat_batches before the
+    202; without Postgres the answer is 503 and the client should retry.
+    """
+    auth = request.headers.get('Authorization', '').encode('utf-8')
+    if not INGEST_TOKEN or not secrets.compare_digest(auth, f'Bearer {INGEST_TOKEN}'.encode('utf-8')):
+        return jsonify({'error': 'Доступ запрещён'}), 403
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Требуются batch_id и events'}), 400
+    batch_id = request.headers.get('Idempotency-Key') or data.get('batch_id')
+    events = data.get('events')
+    if not batch_id or not isinstance(batch_id, str) or not isinstance(events, list):
+        return jsonify({'error': 'Требуются batch_id и events'}), 400
+    if len(events) > INGEST_BATCH_MAX:
+        return jsonify({'error': f'Не больше {INGEST_BATCH_MAX} событий за раз'}), 400
+    
+    totals = {}
+    for event in events:
+        try:
+            user_id = int(event['user_id'])
+            delta = {k: int(event.get(k, 0)) for k in STAT_FIELDS}
+        except (KeyError, TypeError, ValueError):
+            return jsonify({'error': 'Неверное событие'}), 400
+        totals[user_id] = sum_deltas(totals.get(user_id, {}), delta)
+    
+    # queue (and journal) first, then claim: an acknowledged batch is always on disk
+    queued = stats_buffer.get(batch_id)
+    if queued is None:
+        claim = secrets.token_hex(8)
+        stats_buffer.put(batch_id, {'claim': claim, 'users': [[user_id, d] for user_id, d in totals.items()]})
+    else:
+        # a retry of a batch this process still holds: its deltas are queued already
+        claim = queued['claim']
+    try:
+        ours, new = claim_batch(batch_id, claim)
     except Exception as e:
-        print(f'Get online error: {e}')
-        return jsonify({'online': 0})
+        print(f'Stat batch claim error: {e}')
+        return jsonify({'error': 'Хранилище недоступно'}), 503
+    if not ours or (queued is not None and not new):
+        return jsonify({'status': 'duplicate', 'batch_id': batch_id})
+    
+    with board_lock:
+        for user_id, d in totals.items():
+            leaderboard.add(user_id, **{k: d[k] for k in SCORE_FIELDS})
+        board_batches.add(batch_id)
+    
+    return jsonify({'status': 'accepted', 'batch_id': batch_id, 'users': len(totals)}), 202
+
+@app.route('/api/online', methods=['GET'])
+def get_online_count():
+    return jsonify({'online': presence.count()})
 
 @app.route('/api/online/heartbeat', methods=['POST'])
 @require_auth
 def heartbeat():
     user = request.current_user
-    try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute('''
-            INSERT INTO online_users (user_id, last_seen)
-            VALUES (%s, now())
-            ON CONFLICT (user_id) DO UPDATE SET last_seen = now()
-        ''', (user['id'],))
-        conn.commit()
-        cur.close()
-        conn.close()
-    except Exception as e:
-        print(f'Heartbeat error: {e}')
+    record_heartbeat(user['id'])
     return jsonify({'status': 'ok'})
 
 @app.route('/api/guides', methods=['GET'])
 def get_guides():
-    guides = [
-        {
-            'id': 1,
-            'title': 'Начало игры',
-            'category': 'beginner',
-            'icon': '🏝️',
-            'content': '''## Добро пожаловать в Isleborn Online!
-
-Вы начинаете игру на маленьком острове 5x5 метров. Ваша цель - выжить, развить свой остров и стать властелином океана!
-
-### Первые шаги:
-1. **Осмотритесь** - на вашем острове есть пальма и камень для добычи ресурсов
-2. **Соберите ресурсы** - подойдите к объекту и нажмите E для сбора
-3. **Постройте костёр** - это защитит вас ночью и позволит готовить еду
-4. **Сделайте лодку** - соберите достаточно древесины и отправляйтесь исследовать океан
-
-### Управление:
-- WASD - движение
-- E - взаимодействие
-- I - инвентарь
-- M - карта
-- Tab - статистика'''
-        },
-        {
-            'id': 2,
-            'title': 'Система островов',
-            'category': 'islands',
-            'icon': '🌴',
-            'content': '''## Система островов
-
-Ваш остров - ваша крепость! Он растёт вместе с вами.
-
-### Уровни острова:
-- **Уровень 1**: 5x5 м - начальный остров
-- **Уровень 2**: 10x10 м - разблокируется на 5 уровне персонажа
-- **Уровень 3**: 25x25 м - разблокируется на 15 уровне
-- **Уровень 4**: 50x50 м - разблокируется на 30 уровне
-- **Уровень 5**: 100x100 м - разблокируется на 50 уровне
-- **Максимум**: 250x250 м - для элитных игроков
-
-### Постройки:
-- Костёр - базовая защита
-- Верстак - крафт инструментов
-- Печь - готовка и плавка
-- Верфь - строительство кораблей
-- Склад - хранение ресурсов'''
-        },
-        {
-            'id': 3,
-            'title': 'Морские путешествия',
-            'category': 'ships',
-            'icon': '⛵',
-            'content': '''## Морские путешествия
-
-Океан полон опасностей и сокровищ!
-
-### Типы кораблей:
-- **Плот** - простой, медленный, но доступный
-- **Лодка** - быстрее плота, вмещает больше груза
-- **Шлюп** - маленький боевой корабль
-- **Бригантина** - средний корабль для торговли
-- **Галеон** - большой боевой корабль
-- **Фрегат** - быстрый военный корабль
-
-### Опасности:
-- Монстры глубин - атакуют корабли
-- Штормы - могут потопить слабые суда
-- Пираты - игроки в PvP режиме
-- Левиафаны - мировые боссы'''
-        },
-        {
-            'id': 4,
-            'title': 'PvP и PvE',
-            'category': 'combat',
-            'icon': '⚔️',
-            'content': '''## Боевая система
-
-### PvE (Против монстров):
-- Монстры появляются в океане
-- Глубоководные существа опаснее
-- Убийство даёт опыт и ресурсы
-- Мировые боссы появляются по расписанию
-
-### PvP (Против игроков):
-- Включите PvP режим командой /pvp
-- Атакуйте корабли других игроков
-- Захватывайте ресурсы
-- За убийство получаете очки славы
-- При смерти теряете часть ресурсов
-
-### Советы:
-- Не включайте PvP на слабом корабле
-- Объединяйтесь в гильдии для защиты
-- Используйте течения для побега'''
-        },
-        {
-            'id': 5,
-            'title': 'Крафт и ресурсы',
-            'category': 'crafting',
-            'icon': '🔨',
-            'content': '''## Крафт и ресурсы
-
-### Основные ресурсы:
-- **Древесина** - из пальм, для построек и кораблей
-- **Камень** - для инструментов и фундаментов
-- **Железо** - редкий ресурс для оружия
-- **Ткань** - для парусов и одежды
-- **Рыба** - еда и приманка
-
-### Рабочие станции:
-1. **Костёр** - готовка еды
-2. **Верстак** - базовые инструменты
-3. **Наковальня** - металлические предметы
-4. **Ткацкий станок** - паруса и одежда
-5. **Верфь** - корабли
-
-### Советы:
-- Собирайте всё на начальном этапе
-- Храните ресурсы в сундуках
-- Изучайте рецепты через книги'''
-        }
-    ]
-    return jsonify({'guides': guides})
+    if not guides_payloads:
+        return jsonify({'guides': []})
+    payload = guides_payloads.get(request.args.get('format', 'markdown'))
+    if payload is None:
+        return jsonify({'error': 'Формат недоступен'}), 400
+    return payload.respond(max_age=GUIDES_MAX_AGE)
+
+@app.route('/api/admin/guides/reload', methods=['POST'])
+@require_admin
+def reload_guides():
+    try:
+        count = load_guides()
+    except Exception as e:
+        print(f'Reload guides error: {e}')
+        return jsonify({'error': 'Ошибка загрузки гайдов'}), 500
+    return jsonify({'status': 'ok', 'guides': count})
 
 @app.route('/api/admin/users', methods=['GET'])
 @require_admin
 def admin_get_users():
+    limit = max(1, min(request.args.get('limit', 100, type=int), 100))
+    cursor = request.args.get('cursor')
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT id, email, username, level, pearls, is_admin, created_at
-            FROM users
-            ORDER BY created_at DESC
-            LIMIT 100
-        ''')
-        users = cur.fetchall()
-        cur.close()
-        conn.close()
-        return jsonify({'users': [dict(u) for u in users]})
+        after = decode_cursor(cursor, datetime, int) if cursor else None
+    except InvalidCursor:
+        return jsonify({'error': 'Неверный курсор'}), 400
+    
+    try:
+        with get_db() as conn:
+            cur = conn.cursor()
+            # (created_at, id) keyset, served by idx_users_created_at_id
+            if after:
+                cur.execute('''
+                    SELECT id, email, username, level, pearls, is_admin, created_at
+                    FROM users
+                    WHERE (created_at, id) < (%s, %s)
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT %s
+                ''', (after[0], after[1], limit + 1))
+            else:
+                cur.execute('''
+                    SELECT id, email, username, level, pearls, is_admin, created_at
+                    FROM users
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT %s
+                ''', (limit + 1,))
+            users = cur.fetchall()
+        
+        next_cursor = None
+        if len(users) > limit:
+            users = users[:limit]
+            next_cursor = encode_cursor(users[-1]['created_at'], users[-1]['id'])
+        return jsonify({'users': [dict(u) for u in users], 'next_cursor': next_cursor})
     except Exception as e:
         print(f'Admin get users error: {e}')
-        return jsonify({'users': []})
+        return jsonify({'users': [], 'next_cursor': None})
 
 @app.route('/api/admin/user/<int:user_id>/toggle-admin', methods=['POST'])
 @require_admin
@@ -764,12 +1104,11 @@ def toggle_admin(user_id):
         return jsonify({'error': 'Нельзя изменить свой статус'}), 400
     
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute('UPDATE users SET is_admin = NOT is_admin WHERE id = %s', (user_id,))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute('UPDATE users SET is_admin = NOT is_admin WHERE id = %s', (user_id,))
+            conn.commit()
+        invalidate_user_sessions(user_id)
         return jsonify({'status': 'ok'})
     except Exception as e:
         print(f'Toggle admin error: {e}')
@@ -779,48 +1118,55 @@ def toggle_admin(user_id):
 @require_admin
 def admin_stats():
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        
-        cur.execute('SELECT COUNT(*) as count FROM users')
-        total_users = cur.fetchone()['count']
-        
-        cur.execute('SELECT COUNT(*) as count FROM online_users WHERE last_seen > now() - interval \'5 minutes\'')
-        online_users = cur.fetchone()['count']
+        with get_db() as conn:
+            cur = conn.cursor()
         
-        cur.execute('SELECT COUNT(*) as count FROM islands')
-        total_islands = cur.fetchone()['count']
+            cur.execute('SELECT COUNT(*) as count FROM users')
+            total_users = cur.fetchone()['count']
         
-        cur.close()
-        conn.close()
+            cur.execute('SELECT COUNT(*) as count FROM islands')
+            total_islands = cur.fetchone()['count']
         
         return jsonify({
             'total_users': total_users,
-            'online_users': online_users,
+            'online_users': presence.count(),
             'total_islands': total_islands
         })
     except Exception as e:
         print(f'Admin stats error: {e}')
         return jsonify({'total_users': 0, 'online_users': 0, 'total_islands': 0})
 
+# Fallback store for when Postgres is down; replayed into Postgres once it is back
+island_files = IslandFileStore(os.environ.get('ISLAND_FILES_DIR', os.path.join('godot_server', 'islands')))
+
+def replay_fallback_islands(rows):
+    with get_db() as conn:
+        return len(replay_islands(conn, rows))
+
+island_replayer = PeriodicWorker(
+    'island-replay',
+    float(os.environ.get('ISLAND_REPLAY_INTERVAL', '30')),
+    lambda: island_files.replay(replay_fallback_islands),
+)
+
 @app.route('/island/<owner>', methods=['GET'])
 def get_island(owner):
+    if island_files.has_pending(owner):
+        # saved while Postgres was down and not replayed yet: newer than the row
+        state = island_files.get(owner)
+        if state is not None:
+            return jsonify(state)
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute('SELECT json_state FROM islands WHERE owner = %s', (owner,))
-        row = cur.fetchone()
-        cur.close()
-        conn.close()
+        with get_db() as conn:
+            row = load_island(conn, owner)
         if row:
-            return jsonify(row['json_state'])
+            return jsonify(row[0])
     except Exception as e:
         print(f'DB read failed: {e}')
     
-    path = os.path.join('godot_server', 'islands', f'island_{owner}.json')
-    if os.path.exists(path):
-        with open(path, 'r', encoding='utf-8') as f:
-            return jsonify(json.load(f))
+    state = island_files.get(owner)
+    if state is not None:
+        return jsonify(state)
     return abort(404)
 
 @app.route('/island', methods=['POST'])
@@ -833,28 +1179,24 @@ def create_island():
     island = payload.get('island')
     if not island:
         return abort(400, 'island payload required')
+    expected = expected_version(payload)
+    version = None
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO islands (owner, owner_name, level, json_state, updated_at)
-            VALUES (%s, %s, %s, %s, now())
-            ON CONFLICT (owner) DO UPDATE SET
-              owner_name = EXCLUDED.owner_name,
-              level = EXCLUDED.level,
-              json_state = EXCLUDED.json_state,
-              updated_at = now();
-        """, (owner, owner_name, island.get('level',1), Json(island)))
-        conn.commit()
-        cur.close()
-        conn.close()
+        if expected is not None and island_files.has_pending(owner):
+            island_files.replay(replay_fallback_islands)
+        with get_db() as conn:
+            version = upsert_island(conn, owner, owner_name, island, expected)
+    except VersionConflict as e:
+        return conflict_response(e)
     except Exception as e:
         print(f'DB upsert failed: {e}')
-        path = os.path.join('godot_server', 'islands', f'island_{owner}.json')
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(island, f, indent=2)
-    return jsonify({'status':'ok','owner':owner})
+        if expected is not None:
+            # the file store cannot check the precondition
+            return storage_unavailable()
+        island_files.put(owner, island)
+    else:
+        island_files.discard(owner)
+    return jsonify({'status':'ok','owner':owner,'version':version})
 
 @app.route('/island/<owner>', methods=['PUT'])
 def update_island(owner):
@@ -862,29 +1204,74 @@ def update_island(owner):
     island = payload.get('island')
     if not island:
         return abort(400, 'island payload required')
+    expected = expected_version(payload)
+    version = None
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO islands (owner, owner_name, level, json_state, updated_at)
-            VALUES (%s, %s, %s, %s, now())
-            ON CONFLICT (owner) DO UPDATE SET
-              owner_name = EXCLUDED.owner_name,
-              level = EXCLUDED.level,
-              json_state = EXCLUDED.json_state,
-              updated_at = now();
-        """, (owner, island.get('owner_name', owner), island.get('level',1), Json(island)))
-        conn.commit()
-        cur.close()
-        conn.close()
+        if expected is not None and island_files.has_pending(owner):
+            island_files.replay(replay_fallback_islands)
+        with get_db() as conn:
+            version = upsert_island(conn, owner, island.get('owner_name', owner), island, expected)
+    except VersionConflict as e:
+        return conflict_response(e)
     except Exception as e:
         print(f'DB update failed: {e}')
-        path = os.path.join('godot_server', 'islands', f'island_{owner}.json')
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(island, f, indent=2)
-    return jsonify({'status':'ok','owner':owner})
+        if expected is not None:
+            return storage_unavailable()
+        island_files.put(owner, island)
+    else:
+        island_files.discard(owner)
+    return jsonify({'status':'ok','owner':owner,'version':version})
+
+@app.route('/island/<owner>', methods=['PATCH'])
+def apply_island_patch(owner):
+    """RFC 6902 JSON Patch (array body or application/json-patch+json) or
+    RFC 7396 merge patch (object body); returns the new version. Honours
+    If-Match like PUT."""
+    patch = request.get_json(force=True, silent=True)
+    if patch is None:
+        return abort(400, 'patch body required')
+    try:
+        if island_files.has_pending(owner):
+            # the patch applies to the stored row, so replay a fallback save first
+            island_files.replay(replay_fallback_islands)
+        with get_db() as conn:
+            result = patch_island(conn, owner, patch, request.content_type, expected_version())
+    except VersionConflict as e:
+        return conflict_response(e)
+    except PatchError as e:
+        return jsonify({'status': 'error', 'error': str(e)}), 422
+    except Exception as e:
+        print(f'DB patch failed: {e}')
+        return storage_unavailable()
+    if result is None:
+        return abort(404)
+    island_files.discard(owner)
+    return jsonify({'status': 'ok', 'owner': owner, 'version': result[1]})
+
+def start_background():
+    """Seed in-memory state and start the periodic workers. Runs in the
+    serving process only: password pool helpers re-import this file as
+    __mp_main__ and must not sweep, flush or replay a second time."""
+    seed_presence()
+    presence_reseeder.start()
+    session_sweeper.start()
+    heartbeat_buffer.start()
+    if STATS_JOURNAL:
+        stats_buffer.journal = Journal.claim(
+            STATS_JOURNAL,
+            fsync=os.environ.get('STATS_JOURNAL_FSYNC', 'true').lower() == 'true',
+        )
+        recovered = stats_buffer.recover()
+        if recovered:
+            print(f'Replayed {recovered} journaled stat batches')
+    stats_buffer.start()
+    leaderboard_reloader.start()
+    island_replayer.start()
 
 if __name__ == '__main__':
+    start_background()
     port = int(os.getenv("PORT", 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
+elif __name__ != '__mp_main__':
+    # imported by a WSGI server (gunicorn main:app)
+    start_background()
@@ -7,13 +7,16 @@ Payment Service для Isleborn Online
 from flask import Flask, request, jsonify, abort
 from flask_cors import CORS
 import os
+import sys
 import json
 import hashlib
 import secrets
-from datetime import datetime
-import psycopg2
 from psycopg2.extras import RealDictCursor
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.db import ConnectionPool
+from common.token_store import create_token_store
+
 app = Flask(__name__)
 CORS(app)
 
@@ -27,10 +30,13 @@ PEARL_PACKAGES = {
     "pearls_5000": {"pearls": 5000, "price_rub": 2499, "bonus": 1500}
 }
 
-active_tokens = {}
+# TOKEN_STORE=memory | redis://host:6379/0 | sqlite:///path/tokens.db
+token_store = create_token_store()
+
+db_pool = ConnectionPool(DATABASE_URL, cursor_factory=RealDictCursor)
 
 def get_db():
-    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+    return db_pool.connection()
 
 def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode()).hexdigest()
@@ -42,6 +48,10 @@ def generate_token() -> str:
 def health():
     return jsonify({"status": "ok", "service": "payment_service"})
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({"db_pool": db_pool.stats()})
+
 @app.route('/api/auth/register', methods=['POST'])
 def register():
     """Регистрация нового пользователя"""
@@ -64,30 +74,27 @@ def register():
         return jsonify({"error": "Имя пользователя должно быть не менее 2 символов"}), 400
     
     try:
-        conn = get_db()
-        cur = conn.cursor()
+        with get_db() as conn:
+            cur = conn.cursor()
         
-        cur.execute("SELECT id FROM users WHERE email = %s", (email,))
-        if cur.fetchone():
-            conn.close()
-            return jsonify({"error": "Пользователь с таким email уже существует"}), 400
+            cur.execute("SELECT id FROM users WHERE email = %s", (email,))
+            if cur.fetchone():
+                return jsonify({"error": "Пользователь с таким email уже существует"}), 400
         
-        user_id = f"user_{secrets.token_hex(8)}"
-        password_hash = hash_password(password)
+            user_id = f"user_{secrets.token_hex(8)}"
+            password_hash = hash_password(password)
         
-        cur.execute("""
-            INSERT INTO users (id, username, email, password_hash, pearls, level, playtime, islands, achievements)
-            VALUES (%s, %s, %s, %s, 100, 1, 0, 1, 0)
-            RETURNING id, username, email, pearls, level, playtime, islands, achievements
-        """, (user_id, username, email, password_hash))
+            cur.execute("""
+                INSERT INTO users (id, username, email, password_hash, pearls, level, playtime, islands, achievements)
+                VALUES (%s, %s, %s, %s, 100, 1, 0, 1, 0)
+                RETURNING id, username, email, pearls, level, playtime, islands, achievements
+            """, (user_id, username, email, password_hash))
         
-        user = cur.fetchone()
-        conn.commit()
-        
-        token = generate_token()
-        active_tokens[token] = user_id
+            user = cur.fetchone()
+            conn.commit()
         
-        conn.close()
+            token = generate_token()
+            token_store.set(token, user_id)
         
         return jsonify({
             "status": "success",
@@ -123,24 +130,23 @@ def login():
         return jsonify({"error": "Введите email и пароль"}), 400
     
     try:
-        conn = get_db()
-        cur = conn.cursor()
+        with get_db() as conn:
+            cur = conn.cursor()
         
-        password_hash = hash_password(password)
+            password_hash = hash_password(password)
         
-        cur.execute("""
-            SELECT id, username, email, pearls, level, playtime, islands, achievements
-            FROM users WHERE email = %s AND password_hash = %s
-        """, (email, password_hash))
+            cur.execute("""
+                SELECT id, username, email, pearls, level, playtime, islands, achievements
+                FROM users WHERE email = %s AND password_hash = %s
+            """, (email, password_hash))
         
-        user = cur.fetchone()
-        conn.close()
+            user = cur.fetchone()
         
         if not user:
             return jsonify({"error": "Неверный email или пароль"}), 401
         
         token = generate_token()
-        active_tokens[token] = user["id"]
+        token_store.set(token, user["id"])
         
         return jsonify({
             "status": "success",
@@ -172,25 +178,23 @@ def verify_token():
         if auth_header.startswith("Bearer "):
             token = auth_header[7:]
     
-    if not token or token not in active_tokens:
+    user_id = token_store.get(token) if token else None
+    if not user_id:
         return jsonify({"error": "Недействительный токен"}), 401
     
-    user_id = active_tokens[token]
-    
     try:
-        conn = get_db()
-        cur = conn.cursor()
+        with get_db() as conn:
+            cur = conn.cursor()
         
-        cur.execute("""
-            SELECT id, username, email, pearls, level, playtime, islands, achievements
-            FROM users WHERE id = %s
-        """, (user_id,))
+            cur.execute("""
+                SELECT id, username, email, pearls, level, playtime, islands, achievements
+                FROM users WHERE id = %s
+            """, (user_id,))
         
-        user = cur.fetchone()
-        conn.close()
+            user = cur.fetchone()
         
         if not user:
-            del active_tokens[token]
+            token_store.delete(token)
             return jsonify({"error": "Пользователь не найден"}), 401
         
         return jsonify({
@@ -222,8 +226,8 @@ def logout():
         if auth_header.startswith("Bearer "):
             token = auth_header[7:]
     
-    if token and token in active_tokens:
-        del active_tokens[token]
+    if token:
+        token_store.delete(token)
     
     return jsonify({"status": "success"})
 
@@ -238,18 +242,16 @@ def get_user_pearls():
     auth_header = request.headers.get("Authorization", "")
     token = auth_header[7:] if auth_header.startswith("Bearer ") else None
     
-    if not token or token not in active_tokens:
+    user_id = token_store.get(token) if token else None
+    if not user_id:
         return jsonify({"error": "Требуется авторизация"}), 401
     
-    user_id = active_tokens[token]
-    
     try:
-        conn = get_db()
-        cur = conn.cursor()
+        with get_db() as conn:
+            cur = conn.cursor()
         
-        cur.execute("SELECT pearls FROM users WHERE id = %s", (user_id,))
-        user = cur.fetchone()
-        conn.close()
+            cur.execute("SELECT pearls FROM users WHERE id = %s", (user_id,))
+            user = cur.fetchone()
         
         if not user:
             return jsonify({"error": "Пользователь не найден"}), 404
@@ -269,10 +271,9 @@ def purchase_pearls():
     auth_header = request.headers.get("Authorization", "")
     token = auth_header[7:] if auth_header.startswith("Bearer ") else None
     
-    if not token or token not in active_tokens:
+    user_id = token_store.get(token) if token else None
+    if not user_id:
         return jsonify({"error": "Требуется авторизация"}), 401
-    
-    user_id = active_tokens[token]
     data = request.get_json()
     
     if not data:
@@ -287,18 +288,17 @@ def purchase_pearls():
     total_pearls = package["pearls"] + package["bonus"]
     
     try:
-        conn = get_db()
-        cur = conn.cursor()
+        with get_db() as conn:
+            cur = conn.cursor()
         
-        cur.execute("""
-            UPDATE users SET pearls = pearls + %s, updated_at = CURRENT_TIMESTAMP
-            WHERE id = %s
-            RETURNING pearls
-        """, (total_pearls, user_id))
+            cur.execute("""
+                UPDATE users SET pearls = pearls + %s, updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+                RETURNING pearls
+            """, (total_pearls, user_id))
         
-        result = cur.fetchone()
-        conn.commit()
-        conn.close()
+            result = cur.fetchone()
+            conn.commit()
         
         if not result:
             return jsonify({"error": "Пользователь не найден"}), 404
@@ -334,18 +334,17 @@ def confirm_payment():
     total_pearls = package["pearls"] + package["bonus"]
     
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        
-        cur.execute("""
-            UPDATE users SET pearls = pearls + %s, updated_at = CURRENT_TIMESTAMP
-            WHERE id = %s
-            RETURNING pearls
-        """, (total_pearls, user_id))
-        
-        result = cur.fetchone()
-        conn.commit()
-        conn.close()
+        with get_db() as conn:
+            cur = conn.cursor()
+        
+            cur.execute("""
+                UPDATE users SET pearls = pearls + %s, updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+                RETURNING pearls
+            """, (total_pearls, user_id))
+        
+            result = cur.fetchone()
+            conn.commit()
         
         if not result:
             return jsonify({"error": "Пользователь не найден"}), 404
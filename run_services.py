@@ -7,28 +7,93 @@ import sys
 import subprocess
 import threading
 import time
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote, urlsplit
 import signal
 
+from common.static_files import (
+    StaticIndex, cache_control, choose_encoding, http_date, not_modified,
+    parse_accept_encoding, parse_range
+)
 
-class CORSHTTPRequestHandler(SimpleHTTPRequestHandler):
-    """HTTP handler with CORS support and no caching"""
+
+class StaticRequestHandler(BaseHTTPRequestHandler):
+    """Serves web_frontend from a prebuilt index with CORS, ETags, Range and sendfile"""
     
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, directory='web_frontend', **kwargs)
+    protocol_version = 'HTTP/1.1'
+    index = None
     
     def end_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', '*')
-        self.send_header('Cache-Control', 'no-store, no-cache, must-revalidate, max-age=0')
-        self.send_header('Pragma', 'no-cache')
-        self.send_header('Expires', '0')
         super().end_headers()
     
     def do_OPTIONS(self):
         self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def do_HEAD(self):
+        self.serve(send_body=False)
+    
+    def do_GET(self):
+        self.serve(send_body=True)
+    
+    def serve(self, send_body):
+        url = urlsplit(self.path)
+        path = unquote(url.path).lstrip('/')
+        if path == '' or path.endswith('/'):
+            path += 'index.html'
+        asset = self.index.get(path)
+        if asset is None:
+            self.send_error(404)
+            return
+        
+        range_header = self.headers.get('Range')
+        encoding = None
+        if not range_header:
+            encoding = choose_encoding(asset, parse_accept_encoding(self.headers.get('Accept-Encoding')))
+        etag = f'{asset.etag}-{encoding}' if encoding else asset.etag
+        file_path = asset.variants[encoding] if encoding else asset.path
+        size = os.path.getsize(file_path) if encoding else asset.size
+        
+        status, start, length = 200, 0, size
+        if not_modified(asset, etag, self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since')):
+            status, length = 304, 0
+        elif range_header and self.headers.get('If-Range', f'"{etag}"') == f'"{etag}"':
+            try:
+                byte_range = parse_range(range_header, size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if byte_range:
+                start, end = byte_range
+                status, length = 206, end - start + 1
+        
+        self.send_response(status)
+        self.send_header('ETag', f'"{etag}"')
+        self.send_header('Last-Modified', http_date(asset.mtime))
+        self.send_header('Cache-Control', cache_control(path))
+        self.send_header('Accept-Ranges', 'bytes')
+        if asset.variants:
+            self.send_header('Vary', 'Accept-Encoding')
+        if status != 304:
+            self.send_header('Content-Type', asset.mimetype)
+            if encoding:
+                self.send_header('Content-Encoding', encoding)
+            if status == 206:
+                self.send_header('Content-Range', f'bytes {start}-{start + length - 1}/{size}')
+        self.send_header('Content-Length', str(length))
         self.end_headers()
+        
+        if send_body and length:
+            self.wfile.flush()
+            with open(file_path, 'rb') as f:
+                self.connection.sendfile(f, offset=start, count=length)
     
     def log_message(self, format, *args):
         print(f"[WebFrontend] {args[0]}")
@@ -85,7 +150,8 @@ def main():
     print("  - Godot WS:        ws://localhost:8090")
     print("=" * 60)
     
-    httpd = HTTPServer(('0.0.0.0', 5000), CORSHTTPRequestHandler)
+    StaticRequestHandler.index = StaticIndex(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web_frontend'))
+    httpd = ThreadingHTTPServer(('0.0.0.0', 5000), StaticRequestHandler)
     
     def signal_handler(sig, frame):
         print("\nShutting down...")
@@ -4,25 +4,44 @@ Main server for Isleborn Online - единый API сервер
 Обслуживает web_frontend и предоставляет API для авторизации, островов, новостей и рейтингов
 """
 
-from flask import Flask, request, jsonify, send_from_directory, abort
+from flask import Flask, request, jsonify, abort
 from flask_cors import CORS
 import os
-import json
-import bcrypt
 import jwt
 import secrets
 from datetime import datetime, timedelta
 from functools import wraps
-import psycopg2
-from psycopg2.extras import Json, RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 import threading
 import asyncio
 
-app = Flask(__name__, static_folder='web_frontend', static_url_path='')
+from common.background import PeriodicWorker
+from common.buffer import CoalescingBuffer
+from common.cache import Generations, TTLCache
+from common.http_cache import ResponseCache
+from common.db import ConnectionPool
+from common.island_files import IslandFileStore
+from common.island_preconditions import conflict_response, expected_version, storage_unavailable
+from common.islands import VersionConflict, default_storage, load_island, patch_island, replay_islands, upsert_island
+from common.json_patch import PatchError
+from common.jwt_keys import KeyRing
+from common.leaderboard import Leaderboard
+from common.pagination import InvalidCursor, decode_cursor, encode_cursor
+from common.passwords import HashPoolBusy, PasswordHasher
+from common.pg_listen import Listener
+from common.presence import PresenceTracker
+from common.static_files import StaticIndex, send_asset
+
+app = Flask(__name__, static_folder=None)
 CORS(app, origins="*", supports_credentials=True)
 
 app.config['SECRET_KEY'] = os.environ.get('SESSION_SECRET', secrets.token_hex(32))
 
+# With JWT_KEYS_DIR, RS256/EdDSA signing keys published on /.well-known/jwks.json;
+# HS256 tokens issued before the switch still verify against SECRET_KEY until
+# they expire. Without it, tokens stay HS256 signed with SECRET_KEY.
+jwt_keys = KeyRing(legacy_secret=app.config['SECRET_KEY'])
+
 DATABASE_URL = os.environ.get('DATABASE_URL')
 
 PEARL_PACKAGES = {
@@ -33,8 +52,193 @@ PEARL_PACKAGES = {
     "pearls_5000": {"pearls": 5000, "price_rub": 2499, "bonus": 1500}
 }
 
+USER_PROJECTION_FIELDS = (
+    'id', 'email', 'username', 'is_admin', 'pearls', 'level', 'experience',
+    'playtime_minutes', 'pvp_wins', 'pve_kills', 'achievements', 'islands_count'
+)
+
+db_pool = ConnectionPool(DATABASE_URL)
+password_hasher = PasswordHasher()
+
+# user id -> projection of the users row (no password_hash). Any service may
+# change a row (main.py toggles admins, payment_service adds pearls), so the
+# cache is only used while user_listener is connected: the users trigger
+# (db/schema_users.sql) NOTIFYs user_changed and every worker drops its copy.
+# USER_CACHE_TTL=0 turns the fast path off and reads the row on every request.
+user_cache = TTLCache(
+    maxsize=int(os.environ.get('USER_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('USER_CACHE_TTL', 30))
+)
+user_versions = Generations(maxsize=user_cache.maxsize)
+user_versions_lock = threading.Lock()
+
+# serialized /api/news and /api/guides bodies, dropped when admins edit them
+content_cache = ResponseCache(ttl=float(os.environ.get('CONTENT_CACHE_TTL', 60)))
+CONTENT_MAX_AGE = int(os.environ.get('CONTENT_MAX_AGE', 30))
+
 def get_conn():
-    return psycopg2.connect(DATABASE_URL)
+    return db_pool.connection()
+
+def bump_user_version(user_id):
+    """Mark a user's cached projection stale after their row changed."""
+    with user_versions_lock:
+        user_versions.bump(user_id)
+        user_cache.pop(user_id)
+
+def reset_user_cache():
+    # (re)connected: changes made while the listener was down were missed
+    with user_versions_lock:
+        user_versions.bump_all()
+        user_cache.clear()
+    leaderboard.loaded = False
+
+def on_user_changed(payload):
+    user_id = int(payload)
+    bump_user_version(user_id)
+    with leaderboard_dirty_lock:
+        leaderboard_dirty.add(user_id)
+
+user_listener = Listener(DATABASE_URL, 'user_changed', on_user_changed, on_reset=reset_user_cache)
+
+def load_user(user_id):
+    if user_listener.live:
+        cached = user_cache.get(user_id)
+        if cached is not None:
+            return dict(cached)
+    
+    with user_versions_lock:
+        version = user_versions.current(user_id)
+    
+    with get_conn() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute(f'SELECT {", ".join(USER_PROJECTION_FIELDS)} FROM users WHERE id = %s', (user_id,))
+        user = cur.fetchone()
+    
+    if not user:
+        return None
+    user = dict(user)
+    # a concurrent bump means this row may predate the change, so don't cache it
+    with user_versions_lock:
+        if user_listener.live and user_versions.current(user_id) == version:
+            user_cache.set(user_id, user)
+    return dict(user)
+
+def flush_heartbeats(rows):
+    with get_conn() as conn:
+        cur = conn.cursor()
+        execute_values(cur, '''
+            INSERT INTO online_users (user_id, last_ping) VALUES %s
+            ON CONFLICT (user_id) DO UPDATE
+            SET last_ping = GREATEST(online_users.last_ping, EXCLUDED.last_ping)
+        ''', rows, page_size=1000)
+        conn.commit()
+
+# /api/stats/ping only records into memory; pings are written in batches
+heartbeat_buffer = CoalescingBuffer(
+    'heartbeats',
+    flush_heartbeats,
+    interval=float(os.environ.get('HEARTBEAT_FLUSH_INTERVAL', 5)),
+    max_items=int(os.environ.get('HEARTBEAT_BUFFER_MAX', 10000))
+)
+
+presence = PresenceTracker()
+
+def load_presence():
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT user_id, last_ping FROM online_users
+            WHERE last_ping > now() - make_interval(secs => %s)
+        ''', (presence.window,))
+        presence.seed(cur.fetchall())
+
+def seed_presence():
+    try:
+        load_presence()
+    except Exception as e:
+        print(f'Presence seed error: {e}')
+
+# every worker flushes its heartbeats to online_users; reading them back makes
+# each worker's count include the users the other workers saw
+presence_reseeder = PeriodicWorker(
+    'presence-reseed',
+    float(os.environ.get('ONLINE_RESEED_INTERVAL', 15)),
+    load_presence
+)
+
+def prune_online_users():
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute('DELETE FROM online_users WHERE last_ping < %s',
+                    (datetime.utcnow() - timedelta(seconds=presence.window),))
+        conn.commit()
+
+online_pruner = PeriodicWorker(
+    'online-pruner',
+    float(os.environ.get('ONLINE_PRUNE_INTERVAL', 300)),
+    prune_online_users
+)
+
+LEADERBOARD_FIELDS = ('username', 'level', 'experience', 'pvp_wins', 'pve_kills')
+
+# non-admin users ranked by level, then experience
+leaderboard = Leaderboard(key=lambda row: (row['level'], row['experience']))
+
+def load_leaderboard():
+    with get_conn() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute(f'''
+            SELECT id AS user_id, {", ".join(LEADERBOARD_FIELDS)}
+            FROM users
+            WHERE is_admin = FALSE
+        ''')
+        leaderboard.load(cur.fetchall())
+
+# users whose row changed since the last sync, from user_listener
+leaderboard_dirty = set()
+leaderboard_dirty_lock = threading.Lock()
+
+def sync_leaderboard():
+    """Re-read only the users the users trigger reported (db/schema_users.sql)."""
+    global leaderboard_dirty
+    with leaderboard_dirty_lock:
+        # until a full load finishes, keep them: it may have read their old rows
+        if not leaderboard_dirty or not leaderboard.loaded:
+            return
+        dirty, leaderboard_dirty = leaderboard_dirty, set()
+    try:
+        with get_conn() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute(f'''
+                SELECT id AS user_id, is_admin, {", ".join(LEADERBOARD_FIELDS)}
+                FROM users
+                WHERE id = ANY(%s)
+            ''', (list(dirty),))
+            rows = {row['user_id']: row for row in cur.fetchall()}
+    except Exception:
+        with leaderboard_dirty_lock:
+            leaderboard_dirty |= dirty
+        raise
+    for user_id in dirty:
+        row = rows.get(user_id)
+        if row is None or row['is_admin']:
+            leaderboard.remove(user_id)
+        else:
+            leaderboard.upsert(user_id, {k: row[k] for k in LEADERBOARD_FIELDS})
+
+leaderboard_sync = PeriodicWorker(
+    'leaderboard-sync',
+    float(os.environ.get('LEADERBOARD_SYNC_INTERVAL', 5)),
+    sync_leaderboard
+)
+
+# levels and experience change through the trigger above, so the full re-read
+# is opt-in (LEADERBOARD_RELOAD seconds), e.g. for a database without the trigger
+leaderboard_reloader = PeriodicWorker(
+    'leaderboard-reload',
+    float(os.environ.get('LEADERBOARD_RELOAD', 0)),
+    load_leaderboard
+)
 
 def token_required(f):
     @wraps(f)
@@ -49,13 +253,8 @@ def token_required(f):
             return jsonify({'error': 'Токен не предоставлен'}), 401
         
         try:
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-            conn = get_conn()
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            cur.execute('SELECT * FROM users WHERE id = %s', (data['user_id'],))
-            current_user = cur.fetchone()
-            cur.close()
-            conn.close()
+            data = jwt_keys.decode(token)
+            current_user = load_user(data['user_id'])
             
             if not current_user:
                 return jsonify({'error': 'Пользователь не найден'}), 401
@@ -78,22 +277,49 @@ def admin_required(f):
         return f(current_user, *args, **kwargs)
     return decorated
 
+# web_frontend is indexed once; restart (or static_index.refresh()) after deploying assets
+static_index = StaticIndex(os.path.join(app.root_path, 'web_frontend'))
+
 @app.route('/')
 def serve_index():
-    return send_from_directory('web_frontend', 'index.html')
+    return send_asset(static_index, 'index.html') or abort(404)
 
 @app.route('/<path:path>')
 def serve_static(path):
     if path.startswith('api/') or path.startswith('island') or path.startswith('v2/'):
         return jsonify({'error': 'Not found'}), 404
-    if os.path.exists(os.path.join('web_frontend', path)):
-        return send_from_directory('web_frontend', path)
-    return send_from_directory('web_frontend', 'index.html')
+    return send_asset(static_index, path) or send_asset(static_index, 'index.html') or abort(404)
 
 @app.route('/health', methods=['GET'])
 def health():
     return jsonify({'status': 'ok', 'service': 'isleborn_api', 'version': '0.1.0'})
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({
+        'db_pool': db_pool.stats(),
+        'user_cache': user_cache.stats(),
+        'user_listener': user_listener.stats(),
+        'password_hasher': password_hasher.stats(),
+        'heartbeat_buffer': heartbeat_buffer.stats(),
+        'presence': presence.stats(),
+        'presence_reseeder': presence_reseeder.stats(),
+        'online_pruner': online_pruner.stats(),
+        'leaderboard': dict(leaderboard.stats(), sync=leaderboard_sync.stats(), reload=leaderboard_reloader.stats()),
+        'content_cache': content_cache.stats(),
+        'static': static_index.stats(),
+        'island_files': island_files.stats(),
+        'island_replay': island_replayer.stats(),
+        'island_storage': default_storage.stats()
+    })
+
+@app.route('/.well-known/jwks.json', methods=['GET'])
+def jwks():
+    response = jsonify(jwt_keys.jwks())
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    return response
+
 @app.route('/api/health', methods=['GET'])
 def api_health():
     return jsonify({
@@ -122,38 +348,37 @@ def register():
         if len(username) < 3:
             return jsonify({'error': 'Имя игрока должно быть минимум 3 символа'}), 400
         
-        password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        password_hash = password_hasher.hash(password)
         
-        conn = get_conn()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
+        with get_conn() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
         
-        cur.execute('SELECT id FROM users WHERE email = %s', (email,))
-        if cur.fetchone():
-            cur.close()
-            conn.close()
-            return jsonify({'error': 'Email уже зарегистрирован'}), 400
+            cur.execute('SELECT id FROM users WHERE email = %s', (email,))
+            if cur.fetchone():
+                return jsonify({'error': 'Email уже зарегистрирован'}), 400
         
-        cur.execute('SELECT id FROM users WHERE username = %s', (username,))
-        if cur.fetchone():
-            cur.close()
-            conn.close()
-            return jsonify({'error': 'Имя игрока уже занято'}), 400
+            cur.execute('SELECT id FROM users WHERE username = %s', (username,))
+            if cur.fetchone():
+                return jsonify({'error': 'Имя игрока уже занято'}), 400
         
-        cur.execute('''
-            INSERT INTO users (email, username, password_hash, pearls)
-            VALUES (%s, %s, %s, 100)
-            RETURNING id, email, username, is_admin, pearls, level, experience, playtime_minutes, pvp_wins, pve_kills, achievements, islands_count
-        ''', (email, username, password_hash))
+            cur.execute('''
+                INSERT INTO users (email, username, password_hash, pearls)
+                VALUES (%s, %s, %s, 100)
+                RETURNING id, email, username, is_admin, pearls, level, experience, playtime_minutes, pvp_wins, pve_kills, achievements, islands_count
+            ''', (email, username, password_hash))
         
-        user = cur.fetchone()
-        conn.commit()
-        cur.close()
-        conn.close()
+            user = cur.fetchone()
+            conn.commit()
+        
+        if not user['is_admin']:
+            leaderboard.upsert(user['id'], {k: user[k] for k in LEADERBOARD_FIELDS})
         
-        token = jwt.encode({
+        token = jwt_keys.encode({
             'user_id': user['id'],
+            'sub': str(user['id']),
+            'username': user['username'],
             'exp': datetime.utcnow() + timedelta(days=30)
-        }, app.config['SECRET_KEY'], algorithm='HS256')
+        })
         
         return jsonify({
             'status': 'success',
@@ -176,6 +401,8 @@ def register():
             }
         })
         
+    except HashPoolBusy:
+        raise
     except Exception as e:
         app.logger.error(f'Register error: {e}')
         return jsonify({'error': 'Ошибка регистрации'}), 500
@@ -190,31 +417,29 @@ def login():
         if not email or not password:
             return jsonify({'error': 'Заполните все поля'}), 400
         
-        conn = get_conn()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
+        with get_conn() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
         
-        cur.execute('SELECT * FROM users WHERE email = %s', (email,))
-        user = cur.fetchone()
+            cur.execute('SELECT * FROM users WHERE email = %s', (email,))
+            user = cur.fetchone()
         
         if not user:
-            cur.close()
-            conn.close()
             return jsonify({'error': 'Неверный email или пароль'}), 401
         
-        if not bcrypt.checkpw(password.encode('utf-8'), user['password_hash'].encode('utf-8')):
-            cur.close()
-            conn.close()
+        if not password_hasher.check(password, user['password_hash']):
             return jsonify({'error': 'Неверный email или пароль'}), 401
         
-        cur.execute('UPDATE users SET last_login = now() WHERE id = %s', (user['id'],))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute('UPDATE users SET last_login = now() WHERE id = %s', (user['id'],))
+            conn.commit()
         
-        token = jwt.encode({
+        token = jwt_keys.encode({
             'user_id': user['id'],
+            'sub': str(user['id']),
+            'username': user['username'],
             'exp': datetime.utcnow() + timedelta(days=30)
-        }, app.config['SECRET_KEY'], algorithm='HS256')
+        })
         
         return jsonify({
             'status': 'success',
@@ -237,6 +462,8 @@ def login():
             }
         })
         
+    except HashPoolBusy:
+        raise
     except Exception as e:
         app.logger.error(f'Login error: {e}')
         return jsonify({'error': 'Ошибка входа'}), 500
@@ -257,13 +484,8 @@ def verify_token():
         return jsonify({'valid': False, 'error': 'Токен не предоставлен'}), 401
     
     try:
-        data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-        conn = get_conn()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute('SELECT id, username, email, is_admin, pearls, level FROM users WHERE id = %s', (data['user_id'],))
-        user = cur.fetchone()
-        cur.close()
-        conn.close()
+        data = jwt_keys.decode(token)
+        user = load_user(data['user_id'])
         
         if user:
             return jsonify({
@@ -272,7 +494,7 @@ def verify_token():
                 'sub': str(user['id']),
                 'username': user['username'],
                 'email': user['email'],
-                'user': user
+                'user': {k: user[k] for k in ('id', 'username', 'email', 'is_admin', 'pearls', 'level')}
             })
         else:
             return jsonify({'valid': False, 'error': 'Пользователь не найден'}), 401
@@ -314,19 +536,17 @@ def update_user(current_user):
         username = data.get('username', '').strip()
         
         if username and len(username) >= 3:
-            conn = get_conn()
-            cur = conn.cursor()
+            with get_conn() as conn:
+                cur = conn.cursor()
             
-            cur.execute('SELECT id FROM users WHERE username = %s AND id != %s', (username, current_user['id']))
-            if cur.fetchone():
-                cur.close()
-                conn.close()
-                return jsonify({'error': 'Имя игрока уже занято'}), 400
+                cur.execute('SELECT id FROM users WHERE username = %s AND id != %s', (username, current_user['id']))
+                if cur.fetchone():
+                    return jsonify({'error': 'Имя игрока уже занято'}), 400
             
-            cur.execute('UPDATE users SET username = %s WHERE id = %s', (username, current_user['id']))
-            conn.commit()
-            cur.close()
-            conn.close()
+                cur.execute('UPDATE users SET username = %s WHERE id = %s', (username, current_user['id']))
+                conn.commit()
+            bump_user_version(current_user['id'])
+            leaderboard.update(current_user['id'], username=username)
         
         return jsonify({'status': 'ok'})
     except Exception as e:
@@ -346,19 +566,25 @@ def change_password(current_user):
         if len(new_password) < 6:
             return jsonify({'error': 'Новый пароль должен быть минимум 6 символов'}), 400
         
-        if not bcrypt.checkpw(current_password.encode('utf-8'), current_user['password_hash'].encode('utf-8')):
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT password_hash FROM users WHERE id = %s', (current_user['id'],))
+            row = cur.fetchone()
+        
+        if not row or not password_hasher.check(current_password, row[0]):
             return jsonify({'error': 'Неверный текущий пароль'}), 401
         
-        new_hash = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        new_hash = password_hasher.hash(new_password)
         
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute('UPDATE users SET password_hash = %s WHERE id = %s', (new_hash, current_user['id']))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute('UPDATE users SET password_hash = %s WHERE id = %s', (new_hash, current_user['id']))
+            conn.commit()
+        bump_user_version(current_user['id'])
         
         return jsonify({'status': 'ok'})
+    except HashPoolBusy:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -372,45 +598,24 @@ def get_user_pearls(current_user):
 
 @app.route('/api/stats/online', methods=['GET'])
 def get_online_count():
-    try:
-        conn = get_conn()
-        cur = conn.cursor()
-        
-        five_min_ago = datetime.utcnow() - timedelta(minutes=5)
-        cur.execute('DELETE FROM online_users WHERE last_ping < %s', (five_min_ago,))
-        cur.execute('SELECT COUNT(*) FROM online_users')
-        count = cur.fetchone()[0]
-        
-        conn.commit()
-        cur.close()
-        conn.close()
-        
-        return jsonify({'online': count})
-    except Exception as e:
-        return jsonify({'online': 0})
+    return jsonify({'online': presence.count()})
 
 @app.route('/api/stats/ping', methods=['POST'])
 @token_required
 def ping_online(current_user):
-    try:
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute('''
-            INSERT INTO online_users (user_id, last_ping)
-            VALUES (%s, now())
-            ON CONFLICT (user_id) DO UPDATE SET last_ping = now()
-        ''', (current_user['id'],))
-        conn.commit()
-        cur.close()
-        conn.close()
-        return jsonify({'status': 'ok'})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    presence.touch(current_user['id'])
+    heartbeat_buffer.put(current_user['id'], datetime.utcnow())
+    return jsonify({'status': 'ok'})
 
 @app.route('/api/news', methods=['GET'])
 def get_news():
     try:
-        conn = get_conn()
+        return content_cache.respond('news', load_news, max_age=CONTENT_MAX_AGE)
+    except Exception as e:
+        return jsonify([])
+
+def load_news():
+    with get_conn() as conn:
         cur = conn.cursor(cursor_factory=RealDictCursor)
         cur.execute('''
             SELECT id, title, content, badge, created_at
@@ -419,16 +624,11 @@ def get_news():
             LIMIT 20
         ''')
         news = cur.fetchall()
-        cur.close()
-        conn.close()
-        
-        for item in news:
-            if item['created_at']:
-                item['created_at'] = item['created_at'].isoformat()
-        
-        return jsonify(news)
-    except Exception as e:
-        return jsonify([])
+    
+    for item in news:
+        if item['created_at']:
+            item['created_at'] = item['created_at'].isoformat()
+    return news
 
 @app.route('/api/news', methods=['POST'])
 @token_required
@@ -443,17 +643,16 @@ def create_news(current_user):
         if not title or not content:
             return jsonify({'error': 'Заполните все поля'}), 400
         
-        conn = get_conn()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute('''
-            INSERT INTO news (title, content, badge, author_id)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id, title, content, badge, created_at
-        ''', (title, content, badge, current_user['id']))
-        news_item = cur.fetchone()
-        conn.commit()
-        cur.close()
-        conn.close()
+        with get_conn() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute('''
+                INSERT INTO news (title, content, badge, author_id)
+                VALUES (%s, %s, %s, %s)
+                RETURNING id, title, content, badge, created_at
+            ''', (title, content, badge, current_user['id']))
+            news_item = cur.fetchone()
+            conn.commit()
+        content_cache.invalidate('news')
         
         if news_item['created_at']:
             news_item['created_at'] = news_item['created_at'].isoformat()
@@ -467,12 +666,11 @@ def create_news(current_user):
 @admin_required
 def delete_news(current_user, news_id):
     try:
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute('DELETE FROM news WHERE id = %s', (news_id,))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute('DELETE FROM news WHERE id = %s', (news_id,))
+            conn.commit()
+        content_cache.invalidate('news')
         return jsonify({'status': 'ok'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -480,19 +678,19 @@ def delete_news(current_user, news_id):
 @app.route('/api/guides', methods=['GET'])
 def get_guides():
     try:
-        conn = get_conn()
+        return content_cache.respond('guides', load_guides, max_age=CONTENT_MAX_AGE)
+    except Exception as e:
+        return jsonify([])
+
+def load_guides():
+    with get_conn() as conn:
         cur = conn.cursor(cursor_factory=RealDictCursor)
         cur.execute('''
             SELECT id, title, icon, description, content, category
             FROM guides
             ORDER BY id
         ''')
-        guides = cur.fetchall()
-        cur.close()
-        conn.close()
-        return jsonify(guides)
-    except Exception as e:
-        return jsonify([])
+        return cur.fetchall()
 
 @app.route('/api/guides', methods=['POST'])
 @token_required
@@ -509,53 +707,77 @@ def create_guide(current_user):
         if not title or not content:
             return jsonify({'error': 'Заполните обязательные поля'}), 400
         
-        conn = get_conn()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute('''
-            INSERT INTO guides (title, icon, description, content, category)
-            VALUES (%s, %s, %s, %s, %s)
-            RETURNING id, title, icon, description, content, category
-        ''', (title, icon, description, content, category))
-        guide = cur.fetchone()
-        conn.commit()
-        cur.close()
-        conn.close()
+        with get_conn() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute('''
+                INSERT INTO guides (title, icon, description, content, category)
+                VALUES (%s, %s, %s, %s, %s)
+                RETURNING id, title, icon, description, content, category
+            ''', (title, icon, description, content, category))
+            guide = cur.fetchone()
+            conn.commit()
+        content_cache.invalidate('guides')
         
         return jsonify(guide)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def leaderboard_entry(rank, player):
+    return {
+        'rank': rank,
+        'username': player['username'],
+        'level': player['level'],
+        'score': player['experience'],
+        'pvp': player['pvp_wins'],
+        'pve': player['pve_kills']
+    }
+
 @app.route('/api/leaderboard', methods=['GET'])
 def get_leaderboard():
+    limit = max(1, min(request.args.get('limit', 100, type=int), 100))
+    cursor = request.args.get('cursor')
     try:
-        conn = get_conn()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute('''
-            SELECT username, level, experience, pvp_wins, pve_kills
-            FROM users
-            WHERE is_admin = FALSE
-            ORDER BY level DESC, experience DESC
-            LIMIT 100
-        ''')
-        players = cur.fetchall()
-        cur.close()
-        conn.close()
-        
-        result = []
-        for i, player in enumerate(players):
-            result.append({
-                'rank': i + 1,
-                'username': player['username'],
-                'level': player['level'],
-                'score': player['experience'],
-                'pvp': player['pvp_wins'],
-                'pve': player['pve_kills']
-            })
+        after = decode_cursor(cursor, int, int, int) if cursor else None
+    except InvalidCursor:
+        return jsonify({'error': 'Неверный курсор'}), 400
+    
+    try:
+        if not leaderboard.loaded:
+            load_leaderboard()
         
-        return jsonify(result)
+        # (level, experience, user_id) keyset; the body stays a plain list,
+        # so the cursor for the next page goes in a header
+        if after:
+            rows = leaderboard.page_after(after, limit + 1)
+        else:
+            rows = leaderboard.top(limit + 1)
+        response = jsonify([leaderboard_entry(rank, player) for rank, player in rows[:limit]])
+        if len(rows) > limit:
+            response.headers['X-Next-Cursor'] = encode_cursor(*leaderboard.cursor_values(rows[limit - 1][1]))
+        return response
     except Exception as e:
         return jsonify([])
 
+@app.route('/api/leaderboard/me', methods=['GET'])
+@token_required
+def get_my_rank(current_user):
+    around = max(0, min(request.args.get('around', 5, type=int), 50))
+    try:
+        if not leaderboard.loaded:
+            load_leaderboard()
+        rank, entries = leaderboard.around(current_user['id'], around)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    if rank is None:
+        return jsonify({'error': 'Игрок не найден в рейтинге'}), 404
+    
+    return jsonify({
+        'rank': rank,
+        'total': len(leaderboard),
+        'leaderboard': [leaderboard_entry(r, player) for r, player in entries]
+    })
+
 @app.route('/api/packages', methods=['GET'])
 def get_packages():
     return jsonify({"packages": PEARL_PACKAGES})
@@ -575,19 +797,18 @@ def purchase_pearls(current_user):
     total_pearls = package["pearls"] + package["bonus"]
     
     try:
-        conn = get_conn()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
+        with get_conn() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
         
-        cur.execute('''
-            UPDATE users SET pearls = pearls + %s
-            WHERE id = %s
-            RETURNING pearls
-        ''', (total_pearls, current_user['id']))
+            cur.execute('''
+                UPDATE users SET pearls = pearls + %s
+                WHERE id = %s
+                RETURNING pearls
+            ''', (total_pearls, current_user['id']))
         
-        result = cur.fetchone()
-        conn.commit()
-        cur.close()
-        conn.close()
+            result = cur.fetchone()
+            conn.commit()
+        bump_user_version(current_user['id'])
         
         return jsonify({
             "status": "success",
@@ -600,24 +821,37 @@ def purchase_pearls(current_user):
     except Exception as e:
         return jsonify({"error": "Ошибка покупки"}), 500
 
+# Fallback store for when Postgres is down; replayed into Postgres once it is back
+island_files = IslandFileStore(os.environ.get('ISLAND_FILES_DIR', os.path.join('godot_server', 'islands')))
+
+def replay_fallback_islands(rows):
+    with get_conn() as conn:
+        return len(replay_islands(conn, rows))
+
+island_replayer = PeriodicWorker(
+    'island-replay',
+    float(os.environ.get('ISLAND_REPLAY_INTERVAL', '30')),
+    lambda: island_files.replay(replay_fallback_islands),
+)
+
 @app.route('/island/<owner>', methods=['GET'])
 def get_island(owner):
+    if island_files.has_pending(owner):
+        # saved while Postgres was down and not replayed yet: newer than the row
+        state = island_files.get(owner)
+        if state is not None:
+            return jsonify(state)
     try:
-        conn = get_conn()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute('SELECT json_state FROM islands WHERE owner = %s', (owner,))
-        row = cur.fetchone()
-        cur.close()
-        conn.close()
+        with get_conn() as conn:
+            row = load_island(conn, owner)
         if row:
-            return jsonify(row['json_state'])
+            return jsonify(row[0])
     except Exception as e:
         app.logger.warn('DB read failed: %s', e)
     
-    path = os.path.join('godot_server', 'islands', f'island_{owner}.json')
-    if os.path.exists(path):
-        with open(path, 'r', encoding='utf-8') as f:
-            return jsonify(json.load(f))
+    state = island_files.get(owner)
+    if state is not None:
+        return jsonify(state)
     return abort(404)
 
 @app.route('/island', methods=['POST'])
@@ -631,28 +865,24 @@ def create_island():
     if not island:
         return abort(400, 'island payload required')
     
+    expected = expected_version(payload)
+    version = None
     try:
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO islands (owner, owner_name, level, json_state, updated_at)
-            VALUES (%s, %s, %s, %s, now())
-            ON CONFLICT (owner) DO UPDATE SET
-              owner_name = EXCLUDED.owner_name,
-              level = EXCLUDED.level,
-              json_state = EXCLUDED.json_state,
-              updated_at = now();
-        """, (owner, owner_name, island.get('level', 1), Json(island)))
-        conn.commit()
-        cur.close()
-        conn.close()
+        if expected is not None and island_files.has_pending(owner):
+            island_files.replay(replay_fallback_islands)
+        with get_conn() as conn:
+            version = upsert_island(conn, owner, owner_name, island, expected)
+    except VersionConflict as e:
+        return conflict_response(e)
     except Exception as e:
         app.logger.warn('DB upsert failed: %s', e)
-        path = os.path.join('godot_server', 'islands', f'island_{owner}.json')
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(island, f, indent=2)
-    return jsonify({'status': 'ok', 'owner': owner})
+        if expected is not None:
+            # the file store cannot check the precondition
+            return storage_unavailable()
+        island_files.put(owner, island)
+    else:
+        island_files.discard(owner)
+    return jsonify({'status': 'ok', 'owner': owner, 'version': version})
 
 @app.route('/island/<owner>', methods=['PUT'])
 def update_island(owner):
@@ -661,28 +891,49 @@ def update_island(owner):
     if not island:
         return abort(400, 'island payload required')
     
+    expected = expected_version(payload)
+    version = None
     try:
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO islands (owner, owner_name, level, json_state, updated_at)
-            VALUES (%s, %s, %s, %s, now())
-            ON CONFLICT (owner) DO UPDATE SET
-              owner_name = EXCLUDED.owner_name,
-              level = EXCLUDED.level,
-              json_state = EXCLUDED.json_state,
-              updated_at = now();
-        """, (owner, island.get('owner_name', owner), island.get('level', 1), Json(island)))
-        conn.commit()
-        cur.close()
-        conn.close()
+        if expected is not None and island_files.has_pending(owner):
+            island_files.replay(replay_fallback_islands)
+        with get_conn() as conn:
+            version = upsert_island(conn, owner, island.get('owner_name', owner), island, expected)
+    except VersionConflict as e:
+        return conflict_response(e)
     except Exception as e:
         app.logger.warn('DB update failed: %s', e)
-        path = os.path.join('godot_server', 'islands', f'island_{owner}.json')
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(island, f, indent=2)
-    return jsonify({'status': 'ok', 'owner': owner})
+        if expected is not None:
+            return storage_unavailable()
+        island_files.put(owner, island)
+    else:
+        island_files.discard(owner)
+    return jsonify({'status': 'ok', 'owner': owner, 'version': version})
+
+@app.route('/island/<owner>', methods=['PATCH'])
+def apply_island_patch(owner):
+    """RFC 6902 JSON Patch (array body or application/json-patch+json) or
+    RFC 7396 merge patch (object body); returns the new version. Honours
+    If-Match like PUT."""
+    patch = request.get_json(force=True, silent=True)
+    if patch is None:
+        return abort(400, 'patch body required')
+    try:
+        if island_files.has_pending(owner):
+            # the patch applies to the stored row, so replay a fallback save first
+            island_files.replay(replay_fallback_islands)
+        with get_conn() as conn:
+            result = patch_island(conn, owner, patch, request.content_type, expected_version())
+    except VersionConflict as e:
+        return conflict_response(e)
+    except PatchError as e:
+        return jsonify({'status': 'error', 'error': str(e)}), 422
+    except Exception as e:
+        app.logger.warn('DB patch failed: %s', e)
+        return storage_unavailable()
+    if result is None:
+        return abort(404)
+    island_files.discard(owner)
+    return jsonify({'status': 'ok', 'owner': owner, 'version': result[1]})
 
 @app.route('/v2/account/authenticate/email', methods=['POST'])
 def nakama_compatible_auth():
@@ -696,44 +947,38 @@ def nakama_compatible_auth():
         if not email or not password:
             return jsonify({'error': 'Email and password required'}), 400
         
-        conn = get_conn()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cur.execute('SELECT * FROM users WHERE email = %s', (email,))
-        user = cur.fetchone()
+        with get_conn() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute('SELECT * FROM users WHERE email = %s', (email,))
+            user = cur.fetchone()
         
+        password_hash = None
         if not user:
-            if create:
+            if not create:
+                return jsonify({'error': 'User not found', 'code': 5}), 404
+            password_hash = password_hasher.hash(password)
+        elif not password_hasher.check(password, user['password_hash']):
+            return jsonify({'error': 'Invalid credentials', 'code': 4}), 401
+        
+        with get_conn() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            if password_hash:
                 username = email.split('@')[0]
-                password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
                 cur.execute('''
                     INSERT INTO users (email, username, password_hash)
                     VALUES (%s, %s, %s)
                     RETURNING *
                 ''', (email, username, password_hash))
                 user = cur.fetchone()
-                conn.commit()
-            else:
-                cur.close()
-                conn.close()
-                return jsonify({'error': 'User not found', 'code': 5}), 404
-        else:
-            if not bcrypt.checkpw(password.encode('utf-8'), user['password_hash'].encode('utf-8')):
-                cur.close()
-                conn.close()
-                return jsonify({'error': 'Invalid credentials', 'code': 4}), 401
-        
-        cur.execute('UPDATE users SET last_login = now() WHERE id = %s', (user['id'],))
-        conn.commit()
-        cur.close()
-        conn.close()
+            cur.execute('UPDATE users SET last_login = now() WHERE id = %s', (user['id'],))
+            conn.commit()
         
-        token = jwt.encode({
+        token = jwt_keys.encode({
             'user_id': user['id'],
             'sub': str(user['id']),
             'username': user['username'],
             'exp': datetime.utcnow() + timedelta(days=30)
-        }, app.config['SECRET_KEY'], algorithm='HS256')
+        })
         
         return jsonify({
             'token': token,
@@ -742,15 +987,25 @@ def nakama_compatible_auth():
             'created': False
         })
         
+    except HashPoolBusy:
+        raise
     except Exception as e:
         app.logger.error(f'Nakama auth error: {e}')
         return jsonify({'error': str(e)}), 500
 
+@app.errorhandler(HashPoolBusy)
+def hash_pool_busy(e):
+    response = jsonify({'error': 'Сервер перегружен, попробуйте позже'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
 @app.after_request
 def add_headers(response):
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
+    if response.cache_control.max_age is None:
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '0'
     response.headers['Access-Control-Allow-Origin'] = '*'
     response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
     response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
@@ -760,7 +1015,21 @@ def add_headers(response):
 def logout():
     return jsonify({'status': 'success'})
 
+def start_background():
+    """Seed in-memory state and start the periodic workers. Runs in the
+    serving process only: password pool helpers re-import this file as
+    __mp_main__ and must not flush, prune or replay a second time."""
+    seed_presence()
+    presence_reseeder.start()
+    user_listener.start()
+    heartbeat_buffer.start()
+    online_pruner.start()
+    leaderboard_sync.start()
+    leaderboard_reloader.start()
+    island_replayer.start()
+
 if __name__ == '__main__':
+    start_background()
     port = int(os.environ.get('PORT', 5000))
     print("=" * 60)
     print("  Isleborn Online API Server")
@@ -768,3 +1037,6 @@ if __name__ == '__main__':
     print(f"  Running on http://0.0.0.0:{port}")
     print("=" * 60)
     app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
+elif __name__ != '__mp_main__':
+    # imported by a WSGI server (gunicorn server:app)
+    start_background()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+bench_island_codec.py
+Compares the JSON island encodings with common/island_codec.py (MessagePack
+with packed float arrays): payload size (raw and gzip) and encode/decode
+time per document, for islands of level 1..5, and checks that the binary
+encoding round-trips exactly.
+
+Usage:
+  python tools/bench_island_codec.py [--levels 1,3,5] [--repeat 50]
+"""
+import argparse, gzip, json, os, random, sys, timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import msgpack
+from common import island_codec
+from generate_island import generate
+
+BUILDING_TYPES = ["hut", "campfire", "storage", "dock", "workshop", "farm"]
+
+def grow(level, seed=1000):
+    """A generated island padded to level-sized content (level 5: 100x100)."""
+    radius = 10.0 * level
+    island = generate("bench", "Bench", seed, radius)
+    rnd = random.Random(seed)
+    island["level"] = level
+    for i in range(80 * level * level):
+        island["resources"].append({
+            "type": rnd.choice(["palm_tree", "stone_node", "fish_school"]),
+            "pos": [round(rnd.uniform(-radius, radius), 3), 0.0, round(rnd.uniform(-radius, radius), 3)],
+            "amount": rnd.randint(1, 9),
+        })
+    for i in range(20 * level * level):
+        island["buildings"].append({
+            "type": rnd.choice(BUILDING_TYPES),
+            "pos": [round(rnd.uniform(-radius, radius), 3), 0.0, round(rnd.uniform(-radius, radius), 3)],
+            "rot": round(rnd.uniform(0, 6.283), 3),
+            "level": rnd.randint(1, 5),
+        })
+    return island
+
+def same(a, b):
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(same(a[k], b[k]) for k in a)
+    if isinstance(a, list):
+        return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    if isinstance(a, float):
+        return a.hex() == b.hex()
+    return a == b
+
+CODECS = [
+    ("json indent=2", lambda d: json.dumps(d, indent=2).encode("utf-8"), json.loads),
+    ("json compact", lambda d: json.dumps(d, separators=(",", ":")).encode("utf-8"), json.loads),
+    ("msgpack", msgpack.packb, msgpack.unpackb),
+    ("island_codec", island_codec.encode, island_codec.decode),
+]
+
+def per_call_us(fn, arg, repeat):
+    return min(timeit.repeat(lambda: fn(arg), number=repeat, repeat=3)) / repeat * 1e6
+
+def bench(levels, repeat):
+    print(f"{'level':>5} {'codec':<14} {'bytes':>9} {'gzip':>8} {'encode us':>10} {'decode us':>10}")
+    for level in levels:
+        island = grow(level)
+        for name, enc, dec in CODECS:
+            data = enc(island)
+            if not same(dec(data), island):
+                raise SystemExit(f"{name}: level {level} does not round-trip exactly")
+            print(f"{level:>5} {name:<14} {len(data):>9} {len(gzip.compress(data, 6)):>8} "
+                  f"{per_call_us(enc, island, repeat):>10.1f} {per_call_us(dec, data, repeat):>10.1f}")
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--levels", default="1,2,3,4,5")
+    p.add_argument("--repeat", type=int, default=50)
+    args = p.parse_args()
+    bench([int(x) for x in args.levels.split(",")], args.repeat)